@@ -19,11 +19,3 @@ __license__ = "GNU GPL3"
 __platforms__ = "Linux"
 __url__ = "https://github.com/Ilias95/apts"
 __download_url__ = __url__
-
-# set up logging
-
-import logging
-
-logging.basicConfig(level=logging.DEBUG,
-                    format='[%(asctime)s] %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,532 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+apts-client: a TFTP client that runs many transfers concurrently on one
+asyncio event loop.
+
+Usage: apts-client [options] HOST get|put FILE [FILE ...]
+
+Example of the library:
+
+    client = TftpClient('10.0.0.1', block_size=1428, window_size=8)
+    summary = await client.get('pxelinux.0', '/tmp/pxelinux.0')
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import ipaddress
+
+from .errors import PacketParseError, TftpTransferError, TftpTimeoutError
+from .file_rw import TftpFileReader, TftpFileWriter
+from .packets import (RRQPacket, WRQPacket, DataPacket, ACKPacket, ErrorPacket,
+                      OACKPacket, PacketFactory)
+
+
+class TransferEndpoint(asyncio.DatagramProtocol):
+    """
+    Queues the datagrams received by the socket of a transfer.
+    """
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def datagram_received(self, data, address):
+        self.queue.put_nowait((data, address))
+
+    def error_received(self, exc):
+        # E.g. ICMP port unreachable, the next read times out.
+        pass
+
+
+class Transfer:
+    """
+    The state of a single transfer of the client: its socket, the remote
+    transfer ID, the negotiated options and the statistics.
+    """
+    factory = PacketFactory()
+
+    def __init__(self, client, op, filename, mode, options):
+        self.client = client
+        self.op = op
+        self.filename = filename
+        self.mode = mode
+        self.options = options
+
+        self.transport = None
+        self.endpoint = None
+        # The server's address, until it answers from its transfer ID.
+        self.remote_address = None
+        self.tid_locked = False
+
+        self.block_size = 512
+        self.window_size = 1
+        self.tsize = None
+
+        self.last_sent = []
+        self.transferred = 0
+        self.retransmits = 0
+        self.started = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        try:
+            # IP addresses need no lookup, which would take a thread of the
+            # default executor for every transfer.
+            address = ipaddress.ip_address(self.client.host)
+        except ValueError:
+            infos = await loop.getaddrinfo(self.client.host, self.client.port,
+                                           type=socket.SOCK_DGRAM)
+            family, _, _, _, self.remote_address = infos[0]
+        else:
+            family = (socket.AF_INET6 if address.version == 6
+                      else socket.AF_INET)
+            self.remote_address = (self.client.host, self.client.port)
+        self.transport, self.endpoint = await loop.create_datagram_endpoint(
+                TransferEndpoint, family=family)
+        self.started = time.monotonic()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def send(self, packets):
+        """
+        Sends a list of packets to the remote host, and records them to be
+        resent if no answer arrives in time.
+        """
+        self.last_sent = packets
+        for packet in packets:
+            self.transport.sendto(packet.to_wire(), self.remote_address)
+
+    async def receive(self):
+        """
+        Returns the next packet of the remote host. Resends the last sent
+        packets every time the timeout expires without an answer.
+
+        Raises TftpTransferError if the remote host sends an error packet,
+        and TftpTimeoutError if it does not answer after all the retries.
+        """
+        retries = self.client.retries
+        while True:
+            try:
+                data, address = await asyncio.wait_for(
+                        self.endpoint.queue.get(), self.client.timeout)
+            except asyncio.TimeoutError:
+                if retries == 0:
+                    raise TftpTimeoutError()
+                retries -= 1
+                self.retransmits += 1
+                self.send(self.last_sent)
+                continue
+
+            if not self.tid_locked:
+                self.remote_address, self.tid_locked = address, True
+            elif address != self.remote_address:
+                error = ErrorPacket(ErrorPacket.ERR_UNKNOWN_TID)
+                self.transport.sendto(error.to_wire(), address)
+                continue
+
+            try:
+                packet = self.factory.create(data)
+            except PacketParseError:
+                continue
+
+            if isinstance(packet, ErrorPacket):
+                message = packet.error_msg.decode(errors='replace')
+                raise TftpTransferError(message, packet.error_code)
+            return packet
+
+    def accept_options(self, packet):
+        """
+        Applies the options acknowledged by the server in an OACK.
+        """
+        for name, value in packet.options.items():
+            # The server may only acknowledge options that we asked for.
+            if name not in self.options:
+                self.abort(ErrorPacket.ERR_OPTION_NEGOTIATION)
+            try:
+                value = int(value)
+            except ValueError:
+                self.abort(ErrorPacket.ERR_OPTION_NEGOTIATION)
+
+            # The server may grant smaller sizes than we asked for, never
+            # larger ones (RFC 2348, RFC 7440).
+            if name == b'blksize':
+                if not 8 <= value <= int(self.options[name]):
+                    self.abort(ErrorPacket.ERR_OPTION_NEGOTIATION)
+                self.block_size = value
+            elif name == b'windowsize':
+                if not 1 <= value <= int(self.options[name]):
+                    self.abort(ErrorPacket.ERR_OPTION_NEGOTIATION)
+                self.window_size = value
+            elif name == b'tsize':
+                self.tsize = value
+
+    def abort(self, error_code):
+        error = ErrorPacket(error_code)
+        self.transport.sendto(error.to_wire(), self.remote_address)
+        raise TftpTransferError(error.error_msg.decode(), error_code)
+
+    def summary(self):
+        duration = time.monotonic() - self.started
+        return {
+            'op': self.op,
+            'filename': self.filename,
+            'mode': self.mode,
+            'bytes': self.transferred,
+            'duration': duration,
+            'throughput': self.transferred / duration if duration else 0,
+            'retransmits': self.retransmits,
+            'block_size': self.block_size,
+            'window_size': self.window_size,
+            'tsize': self.tsize,
+        }
+
+
+class TftpClient:
+    """
+    A TFTP client for a single server. Its get() and put() coroutines can
+    run concurrently, each transfer on its own socket.
+    """
+    def __init__(self, host, port=69, block_size=None, window_size=None,
+                 tsize=False, timeout=1, retries=5):
+        """
+        Keyword arguments:
+        host        -- host name or IP address of the server
+        port        -- port of the server
+        block_size  -- block size to ask for (RFC 2348), None for the
+                       default of 512 bytes
+        window_size -- window size to ask for (RFC 7440), None for the
+                       default of 1 block
+        tsize       -- if True, exchange the size of the file (RFC 2349)
+        timeout     -- seconds to wait for an answer before resending
+        retries     -- how many times to resend before giving up
+        """
+        self.host = host
+        self.port = port
+        self.block_size = block_size
+        self.window_size = window_size
+        self.tsize = tsize
+        self.timeout = timeout
+        self.retries = retries
+
+    def request_options(self, tsize=None):
+        """
+        Returns the options of a request. tsize is the value of the tsize
+        option, None to not send it.
+        """
+        options = {}
+        if self.block_size is not None:
+            options[b'blksize'] = str(self.block_size).encode()
+        if self.window_size is not None:
+            options[b'windowsize'] = str(self.window_size).encode()
+        if tsize is not None:
+            options[b'tsize'] = str(tsize).encode()
+        return options
+
+    async def get(self, filename, local=None, mode='octet', on_start=None):
+        """
+        Downloads filename from the server.
+
+        Keyword arguments:
+        filename -- name of the file on the server
+        local    -- path or binary file object to write the file to, None
+                    to discard the data
+        mode     -- the transfer mode, 'octet' or 'netascii'
+        on_start -- function called when the server starts sending the file,
+                    with its size if the server told it (tsize), else None
+
+        Returns a dictionary that summarizes the transfer.
+        Raises a TftpTransferError if the transfer fails.
+        """
+        transfer = Transfer(self, 'RRQ', filename, mode,
+                            self.request_options(0 if self.tsize else None))
+        await transfer.open()
+        try:
+            await self._get(transfer, os.devnull if local is None else local,
+                            on_start)
+        finally:
+            transfer.close()
+        return transfer.summary()
+
+    async def _get(self, transfer, local, on_start=None):
+        request = RRQPacket(transfer.filename.encode(), transfer.mode.encode(),
+                            transfer.options)
+        transfer.send([request])
+
+        writer = None
+        expected, in_window = 1, 0
+        # The last block received out of order since the last one received
+        # in order.
+        out_of_order = None
+        while True:
+            packet = await transfer.receive()
+
+            if isinstance(packet, OACKPacket) and writer is None:
+                transfer.accept_options(packet)
+                if on_start is not None:
+                    on_start(transfer.tsize)
+                writer = TftpFileWriter(local, transfer.mode,
+                                        transfer.block_size)
+                transfer.send([ACKPacket(0)])
+                continue
+            if not isinstance(packet, DataPacket):
+                continue
+            if writer is None:
+                # The server ignored our options.
+                if on_start is not None:
+                    on_start(None)
+                writer = TftpFileWriter(local, transfer.mode)
+
+            if packet.blockn != expected % 65536:
+                # A duplicate or a block after a lost one, acknowledge the
+                # last block received in order, once for each gap, as the
+                # server resends its window for every such ACK. A repeat of
+                # the last block received in order is always answered.
+                last, out_of_order = out_of_order, packet.blockn
+                if transfer.window_size == 1 or last is None or \
+                        packet.blockn == (expected - 1) % 65536 or \
+                        (packet.blockn - last) % 65536 >= 32768:
+                    in_window = 0
+                    transfer.send([ACKPacket((expected - 1) % 65536)])
+                continue
+            out_of_order = None
+
+            writer.write_next_block(packet.data)
+            transfer.transferred += len(packet.data)
+            expected += 1
+            in_window += 1
+            is_last = len(packet.data) < transfer.block_size
+            if is_last or in_window == transfer.window_size:
+                in_window = 0
+                transfer.send([ACKPacket(packet.blockn)])
+            else:
+                # On a timeout, acknowledge the blocks received so far.
+                transfer.last_sent = [ACKPacket(packet.blockn)]
+            if is_last:
+                return
+
+    async def put(self, local, filename=None, mode='octet'):
+        """
+        Uploads a file to the server.
+
+        Keyword arguments:
+        local    -- path or binary file object to read the file from
+        filename -- name of the file on the server, the base name of local
+                    if None
+        mode     -- the transfer mode, 'octet' or 'netascii'
+
+        Returns a dictionary that summarizes the transfer.
+        Raises a TftpTransferError if the transfer fails.
+        """
+        if filename is None:
+            filename = os.path.basename(local)
+
+        # The size is only known in advance for files in octet mode.
+        size = None
+        if self.tsize and mode == 'octet' and isinstance(local, str):
+            size = os.path.getsize(local)
+
+        transfer = Transfer(self, 'WRQ', filename, mode,
+                            self.request_options(size))
+        await transfer.open()
+        try:
+            await self._put(transfer, local)
+        finally:
+            transfer.close()
+        return transfer.summary()
+
+    async def _put(self, transfer, local):
+        request = WRQPacket(transfer.filename.encode(), transfer.mode.encode(),
+                            transfer.options)
+        transfer.send([request])
+
+        reader = None
+        window, blockn, read_all = [], 0, False
+        while True:
+            packet = await transfer.receive()
+
+            if reader is None:
+                if isinstance(packet, OACKPacket):
+                    transfer.accept_options(packet)
+                elif not isinstance(packet, ACKPacket) or packet.blockn != 0:
+                    continue
+                reader = TftpFileReader(local, transfer.mode,
+                                        transfer.block_size)
+                packet = None
+            elif not isinstance(packet, ACKPacket):
+                continue
+
+            if packet is not None:
+                acked = [i for i, sent in enumerate(window)
+                         if sent.blockn == packet.blockn]
+                if not acked:
+                    # A duplicate, lost windows are resent on a timeout.
+                    continue
+                del window[:acked[0] + 1]
+
+            if not window and read_all:
+                return
+
+            while len(window) < transfer.window_size and not read_all:
+                data = reader.get_next_block()
+                blockn += 1
+                transfer.transferred += len(data)
+                window.append(DataPacket(blockn % 65536, data,
+                                         transfer.block_size))
+                read_all = window[-1].is_last
+            transfer.send(list(window))
+
+
+async def run_transfers(client, jobs, concurrency=16, mode='octet',
+                        callback=None):
+    """
+    Runs (op, remote, local) jobs, op being 'get' or 'put', with up to
+    concurrency of them at a time, in the given transfer mode.
+
+    Returns a list with the summary dictionary of every job, in the order
+    of the jobs, or the TftpTransferError or OSError it failed with.
+    callback, if given, is called with each job and its result as soon as
+    it finishes.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        op, remote, local = job
+        async with semaphore:
+            try:
+                if op == 'get':
+                    result = await client.get(remote, local, mode)
+                else:
+                    result = await client.put(local, remote, mode)
+            except (TftpTransferError, OSError) as e:
+                result = e
+        if callback is not None:
+            callback(job, result)
+        return result
+
+    return await asyncio.gather(*[run(job) for job in jobs])
+
+
+def format_size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+    return '{:.1f} TB'.format(n)
+
+
+def build_jobs(args):
+    """
+    Returns the (op, remote, local) jobs of the command line arguments.
+    """
+    names = list(args.files)
+    if args.list:
+        with open(args.list) as f:
+            names.extend(line.strip() for line in f if line.strip())
+
+    jobs = []
+    for name in names:
+        if args.op == 'get':
+            local = None
+            if args.directory is not None:
+                local = os.path.join(args.directory, os.path.basename(name))
+            jobs.append(('get', name, local))
+        else:
+            remote = os.path.basename(name)
+            if args.remote_directory:
+                remote = args.remote_directory.rstrip('/') + '/' + remote
+            jobs.append(('put', remote, name))
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            prog='apts-client',
+            description='Get or put files from or to a TFTP server, many of '
+                        'them concurrently.')
+    parser.add_argument('host', help='the TFTP server')
+    parser.add_argument('op', choices=('get', 'put'))
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='files to get from or put to the server')
+    parser.add_argument('-l', '--list',
+                        help='file with more files to transfer, one per line')
+    parser.add_argument('-p', '--port', type=int, default=69,
+                        help='port of the server (default: %(default)s)')
+    parser.add_argument('-d', '--directory', default='.',
+                        help='directory to save the files of get to '
+                             '(default: the current directory)')
+    parser.add_argument('--discard', action='store_true',
+                        help='discard the files of get, e.g. for load tests')
+    parser.add_argument('-r', '--remote-directory',
+                        help='directory on the server to put the files to')
+    parser.add_argument('-m', '--mode', default='octet',
+                        choices=('octet', 'netascii'),
+                        help='transfer mode (default: %(default)s)')
+    parser.add_argument('-b', '--blksize', type=int,
+                        help='block size to negotiate')
+    parser.add_argument('-w', '--windowsize', type=int,
+                        help='window size to negotiate')
+    parser.add_argument('--tsize', action='store_true',
+                        help='exchange the size of the files')
+    parser.add_argument('-j', '--jobs', type=int, default=16,
+                        help='number of concurrent transfers '
+                             '(default: %(default)s)')
+    parser.add_argument('-t', '--timeout', type=float, default=1,
+                        help='seconds before resending (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='times to resend before giving up '
+                             '(default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only print the totals')
+    args = parser.parse_args(argv)
+    if args.discard:
+        args.directory = None
+
+    jobs = build_jobs(args)
+    if not jobs:
+        parser.error('no files to transfer')
+
+    client = TftpClient(args.host, args.port, args.blksize, args.windowsize,
+                        args.tsize, args.timeout, args.retries)
+
+    def report(job, result):
+        if isinstance(result, Exception):
+            print('{} {}: error: {}'.format(job[0], job[1], result),
+                  file=sys.stderr)
+        elif not args.quiet:
+            print('{} {}: {} in {:.2f}s ({}/s)'.format(
+                    job[0], job[1], format_size(result['bytes']),
+                    result['duration'], format_size(result['throughput'])))
+
+    start = time.monotonic()
+    results = asyncio.run(run_transfers(client, jobs, args.jobs, args.mode,
+                                        report))
+    elapsed = time.monotonic() - start
+
+    done = [r for r in results if not isinstance(r, Exception)]
+    total = sum(r['bytes'] for r in done)
+    print('{} of {} transfers complete, {} in {:.2f}s ({}/s)'.format(
+            len(done), len(results), format_size(total), elapsed,
+            format_size(total / elapsed if elapsed else 0)))
+    return 0 if len(done) == len(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
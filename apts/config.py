@@ -1,28 +1,13 @@
-import sys
+import re
 import logging
 import configparser
 
 from .errors import ParseConfigError
+from .congestion import load_controller
 
 
-# Symbolic name, meaning all available interfaces.
-host = ''
-
-# Well-known TFTP port number
-port = 69
-
-# Path of the directory from where we serve files and write files to.
-tftp_root = '/srv/tftp/'
-
-# If True, allow files to written. Else, the server runs on read-only
-# mode and a TFTP client can only read existing files.
-writable = True
-
-# Maximum amount of data to be received at once.
-# Note: For best match with hardware and network realities,
-# the value of bufsize should be a relatively small power of 2.
-bufsize = 2048
-
+# Path of the configuration file read by the apts command.
+CONFIG_FILE = '/etc/conf.d/apts'
 
 # exit codes
 
@@ -32,37 +17,575 @@ EXIT_ROOTDIR_ERROR = 2
 EXIT_PRIVILEGES = 3
 
 
-# parse the configuration file
-
-config_parser = configparser.ConfigParser()
-config_parser.read('/etc/conf.d/apts')
-
-try:
-    try:
-        port = int(config_parser['SERVER']['port'])
-    except ValueError:
-        raise ParseConfigError("Failed to parse port value")
-    except KeyError:
-        pass
-
-    try:
-        tftp_root = config_parser['SERVER']['tftp_root']
-    except KeyError:
-        pass
-
-    try:
-        writable = config_parser['SERVER']['writable']
-    except KeyError:
-        pass
-    else:
-        if writable == 'True':
-            writable = True
-        elif writable == 'False':
-            writable = False
-        else:
+def boolean(value):
+    """
+    Returns the bool of a 'True' or 'False' value of the configuration file.
+    Raises a ValueError for any other value.
+    """
+    if value not in ('True', 'False'):
+        raise ValueError(value)
+    return value == 'True'
+
+
+class ServerConfig:
+    """
+    The configuration of a TftpServer.
+
+    A ServerConfig holds the default value of every option, as documented
+    in conf/apts, unless it is given another one. Nothing is read from the
+    disk until read() or from_file() is called, so that servers can be
+    embedded and started without a configuration file.
+    """
+    def __init__(self, **options):
+        """
+        Keyword arguments:
+        options -- values of the options to change, by attribute name
+
+        Raises a TypeError for an unknown option.
+        """
+        # Symbolic name, meaning all available interfaces. '::' listens on
+        # all the interfaces for both IPv6 and IPv4 requests.
+        self.host = ''
+
+        # If True, a server listening on an IPv6 address serves only IPv6
+        # requests. Else, the same socket serves IPv4 requests as well.
+        self.ipv6_only = False
+
+        # If True, the block size granted to a client is capped so that its
+        # blocks fit the path MTU to the client, and are not fragmented.
+        self.path_mtu = True
+
+        # Well-known TFTP port number
+        self.port = 69
+
+        # Path of the directory from where we serve files and write files to.
+        self.tftp_root = '/srv/tftp/'
+
+        # If True, allow files to written. Else, the server runs on read-only
+        # mode and a TFTP client can only read existing files.
+        self.writable = True
+
+        # Size in bytes of the kernel receive buffer of the listening socket. A
+        # large buffer keeps requests from being dropped when many clients
+        # start at once, e.g. on a boot storm. 0 keeps the system default.
+        self.receive_buffer = 0
+
+        # Seconds a stopping server waits for its running transfers to
+        # finish, e.g. after handing over to a new server process on a
+        # reload.
+        self.drain_timeout = 300
+
+        # Maximum amount of data to be received at once.
+        # Note: For best match with hardware and network realities,
+        # the value of bufsize should be a relatively small power of 2.
+        self.bufsize = 2048
+
+        # Logging level of the server. Each transfer is summarized by a single
+        # record at the INFO level, DEBUG logs every packet as well.
+        self.log_level = logging.INFO
+
+        # File to append the log to. None means the standard error.
+        self.log_file = None
+
+        # File to append a trace of the received requests to, for replaying
+        # them with benchmarks/replay.py. None disables the trace.
+        self.trace_file = None
+
+        # Path of the Unix socket through which local tools talk to the server.
+        # None disables the control socket.
+        self.control_socket = None
+
+        # File the metrics are periodically written to, in the Prometheus text
+        # format, and the number of seconds between writes. None disables it.
+        self.metrics_file = None
+        self.metrics_interval = 15
+
+        # Range of ports used by the transfer sockets, as a (first, last)
+        # tuple. None means that the OS picks a random port for each socket.
+        self.transfer_ports = None
+
+        # Transfer sockets are kept open and reused by later sessions. Keep at
+        # least min_idle_sockets and at most max_idle_sockets unused sockets.
+        self.min_idle_sockets = 0
+        self.max_idle_sockets = 64
+
+        # Maximum number of bytes per second sent by the whole server.
+        # 0 means unlimited.
+        self.rate = 0
+
+        # Maximum number of bytes per second sent to a single client IP.
+        # 0 means unlimited.
+        self.client_rate = 0
+
+        # Maximum number of bytes per second sent to each subnet, as a list of
+        # (network, rate) tuples.
+        self.subnet_rates = []
+
+        # When the global rate is limited, files of up to this many bytes are
+        # sent first. Larger files get a lower priority the larger they are. 0
+        # means that all files have the same priority.
+        self.small_file_size = 0
+
+        # Shell-style patterns of files that are always sent first.
+        self.priority_paths = []
+
+        # Seconds of waiting that make up for one level of priority, so that
+        # large files are delayed but never starved.
+        self.aging = 1.0
+
+        # The congestion controller of read requests: none, paced, aimd or
+        # the dotted path of a CongestionController class.
+        self.congestion = 'none'
+
+        # Maximum number of new sessions per second that a single client IP may
+        # start, and how many it may start at once. 0 means unlimited.
+        self.session_rate = 0
+        self.session_burst = 0
+
+        # Maximum number of concurrent sessions of a single client IP.
+        # 0 means unlimited.
+        self.max_sessions_per_ip = 0
+
+        # Maximum number of bytes that the buffers and caches of the server
+        # may take. 0 means unlimited.
+        self.memory_budget = 0
+
+        # Classes of files with their own bandwidth limit, as a list of
+        # (name, rate, patterns) tuples. A rate of 0 means unlimited.
+        self.file_classes = []
+
+        # (host, port) of the upstream server that RRQs are relayed to. The
+        # files are cached, and RRQs are answered from the cache. None disables
+        # the relay mode.
+        self.relay_upstream = None
+
+        # Directory the relayed files are cached in. None keeps them in memory.
+        self.relay_cache_dir = None
+
+        # Maximum number of bytes in the cache, and the seconds after which a
+        # cached file is fetched again.
+        self.relay_cache_size = 1024 ** 3
+        self.relay_cache_ttl = 3600
+
+        # Block size and window size asked from the upstream server. None keeps
+        # the defaults of RFC 1350.
+        self.relay_block_size = None
+        self.relay_window_size = None
+
+        # If True, the files of the tftp root are indexed in memory, and read
+        # requests are looked up in the index, regardless of case if
+        # index_case_fold is True and with backslashes as separators if
+        # index_backslashes is True. index_aliases is a list of (pattern,
+        # replacement) tuples of regular expressions that rewrite requested
+        # names. The index is rescanned every index_rescan_interval seconds,
+        # 0 means never.
+        self.file_index = False
+        self.index_case_fold = True
+        self.index_backslashes = True
+        self.index_aliases = []
+        self.index_rescan_interval = 60
+
+        # Providers that produce the files of read requests whose names match
+        # a pattern, as a list of (pattern, function) tuples, function being
+        # the dotted path of a Python function. See apts/providers.py. Their
+        # files are cached up to provider_cache_size bytes, for
+        # provider_ttl seconds.
+        self.providers = []
+        self.provider_cache_size = 64 * 1024 ** 2
+        self.provider_ttl = 60
+
+        # If True, the time sessions spend parsing packets, reading and writing
+        # files, sending and waiting for the client is exported as metrics.
+        self.phase_timers = False
+
+        # Directory that profiles are written to, and the seconds a profile
+        # taken on SIGUSR2 lasts. See apts/profiling.py.
+        self.profile_dir = '/tmp'
+        self.profile_seconds = 30
+
+        self.update(**options)
+
+    def update(self, **options):
+        """
+        Changes the values of the given options.
+        Raises a TypeError for an unknown option.
+        """
+        for name, value in options.items():
+            if not hasattr(self, name):
+                raise TypeError('unknown option {}'.format(name))
+            setattr(self, name, value)
+
+    @classmethod
+    def from_file(cls, path=CONFIG_FILE, **options):
+        """
+        Returns a ServerConfig with the options of the configuration file at
+        path, and then the given options.
+
+        Raises a ParseConfigError if the file is not valid.
+        """
+        config = cls()
+        config.read(path)
+        config.update(**options)
+        return config
+
+    def read(self, path):
+        """
+        Updates the options with the ones of the configuration file at path.
+        A missing file changes nothing.
+
+        Raises a ParseConfigError if the file is not valid.
+        """
+        config_parser = configparser.ConfigParser()
+        try:
+            config_parser.read(path)
+        except configparser.Error as e:
+            raise ParseConfigError(str(e).splitlines()[0])
+
+        try:
+            self.port = int(config_parser['SERVER']['port'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse port value")
+        except KeyError:
+            pass
+
+        try:
+            self.tftp_root = config_parser['SERVER']['tftp_root']
+        except KeyError:
+            pass
+
+        try:
+            self.writable = boolean(config_parser['SERVER']['writable'])
+        except ValueError:
             raise ParseConfigError("Failed to parse writable value")
+        except KeyError:
+            pass
+
+        try:
+            self.ipv6_only = boolean(config_parser['SERVER']['ipv6_only'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse ipv6_only value")
+        except KeyError:
+            pass
+
+        try:
+            self.path_mtu = boolean(config_parser['SERVER']['path_mtu'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse path_mtu value")
+        except KeyError:
+            pass
+
+        try:
+            log_level = config_parser['LOGGING']['level'].upper()
+        except KeyError:
+            pass
+        else:
+            if log_level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR',
+                                 'CRITICAL'):
+                raise ParseConfigError("Failed to parse level value")
+            self.log_level = getattr(logging, log_level)
+
+        try:
+            self.log_file = config_parser['LOGGING']['file'] or None
+        except KeyError:
+            pass
+
+        try:
+            self.trace_file = config_parser['LOGGING']['trace'] or None
+        except KeyError:
+            pass
+
+        try:
+            self.control_socket = \
+                    config_parser['SERVER']['control_socket'] or None
+        except KeyError:
+            pass
+
+        try:
+            self.metrics_file = config_parser['METRICS']['file'] or None
+        except KeyError:
+            pass
+
+        try:
+            self.metrics_interval = float(config_parser['METRICS']['interval'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse interval value")
+        except KeyError:
+            pass
+
+        try:
+            self.drain_timeout = float(
+                    config_parser['SERVER']['drain_timeout'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse drain_timeout value")
+        except KeyError:
+            pass
+
+        try:
+            self.receive_buffer = int(
+                    config_parser['SERVER']['receive_buffer'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse receive_buffer value")
+        except KeyError:
+            pass
+
+        try:
+            first, last = config_parser['SERVER']['transfer_ports'].split('-')
+            self.transfer_ports = (int(first), int(last))
+        except ValueError:
+            raise ParseConfigError("Failed to parse transfer_ports value")
+        except KeyError:
+            pass
+
+        try:
+            self.min_idle_sockets = int(
+                    config_parser['SERVER']['min_idle_sockets'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse min_idle_sockets value")
+        except KeyError:
+            pass
+
+        try:
+            self.max_idle_sockets = int(
+                    config_parser['SERVER']['max_idle_sockets'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse max_idle_sockets value")
+        except KeyError:
+            pass
+
+        try:
+            self.rate = int(config_parser['SHAPING']['rate'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse rate value")
+        except KeyError:
+            pass
+
+        try:
+            self.client_rate = int(config_parser['SHAPING']['client_rate'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse client_rate value")
+        except KeyError:
+            pass
+
+        try:
+            subnet_rates = []
+            for token in config_parser['SHAPING']['subnet_rates'].split():
+                network, subnet_rate = token.split('=')
+                subnet_rates.append((network, int(subnet_rate)))
+            self.subnet_rates = subnet_rates
+        except ValueError:
+            raise ParseConfigError("Failed to parse subnet_rates value")
+        except KeyError:
+            pass
+
+        try:
+            self.small_file_size = int(
+                    config_parser['SHAPING']['small_file_size'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse small_file_size value")
+        except KeyError:
+            pass
+
+        try:
+            self.priority_paths = \
+                    config_parser['SHAPING']['priority_paths'].split()
+        except KeyError:
+            pass
+
+        try:
+            self.aging = float(config_parser['SHAPING']['aging'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse aging value")
+        except KeyError:
+            pass
+
+        try:
+            self.congestion = config_parser['SHAPING']['congestion']
+            load_controller(self.congestion)
+        except ValueError as e:
+            raise ParseConfigError(str(e))
+        except KeyError:
+            pass
+
+        try:
+            self.session_rate = float(config_parser['LIMITS']['session_rate'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse session_rate value")
+        except KeyError:
+            pass
+
+        try:
+            self.session_burst = int(config_parser['LIMITS']['session_burst'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse session_burst value")
+        except KeyError:
+            pass
+
+        try:
+            self.max_sessions_per_ip = int(
+                    config_parser['LIMITS']['max_sessions_per_ip'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse max_sessions_per_ip value")
+        except KeyError:
+            pass
+
+        try:
+            self.memory_budget = int(config_parser['LIMITS']['memory_budget'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse memory_budget value")
+        except KeyError:
+            pass
+
+        try:
+            relay_host, _, relay_port = \
+                    config_parser['RELAY']['upstream'].rpartition(':')
+            if not relay_host:
+                relay_host, relay_port = relay_port, 69
+            self.relay_upstream = (relay_host, int(relay_port))
+        except ValueError:
+            raise ParseConfigError("Failed to parse upstream value")
+        except KeyError:
+            pass
+
+        try:
+            self.relay_cache_dir = config_parser['RELAY']['cache_dir'] or None
+        except KeyError:
+            pass
+
+        try:
+            self.relay_cache_size = int(config_parser['RELAY']['cache_size'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse cache_size value")
+        except KeyError:
+            pass
+
+        try:
+            self.relay_cache_ttl = float(config_parser['RELAY']['cache_ttl'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse cache_ttl value")
+        except KeyError:
+            pass
+
+        try:
+            self.relay_block_size = int(config_parser['RELAY']['block_size'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse block_size value")
+        except KeyError:
+            pass
+
+        try:
+            self.relay_window_size = int(config_parser['RELAY']['window_size'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse window_size value")
+        except KeyError:
+            pass
+
+        try:
+            self.file_index = boolean(config_parser['INDEX']['enabled'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse enabled value")
+        except KeyError:
+            pass
+
+        try:
+            self.index_case_fold = boolean(
+                    config_parser['INDEX']['case_fold'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse case_fold value")
+        except KeyError:
+            pass
+
+        try:
+            self.index_backslashes = boolean(
+                    config_parser['INDEX']['backslashes'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse backslashes value")
+        except KeyError:
+            pass
+
+        try:
+            aliases = []
+            for line in config_parser['INDEX']['aliases'].splitlines():
+                if line.strip():
+                    pattern, replacement = line.split()
+                    re.compile(pattern)
+                    aliases.append((pattern, replacement))
+            self.index_aliases = aliases
+        except (ValueError, re.error):
+            raise ParseConfigError("Failed to parse aliases value")
+        except KeyError:
+            pass
+
+        try:
+            self.index_rescan_interval = float(
+                    config_parser['INDEX']['rescan_interval'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse rescan_interval value")
+        except KeyError:
+            pass
+
+        try:
+            providers = []
+            for line in config_parser['PROVIDERS']['files'].splitlines():
+                if line.strip():
+                    pattern, function = line.split()
+                    re.compile(pattern)
+                    providers.append((pattern, function))
+        except (ValueError, re.error):
+            raise ParseConfigError("Failed to parse files value")
+        except KeyError:
+            pass
+        else:
+            # Imported here, as most servers have no providers.
+            from .providers import load_function
+            try:
+                for _, function in providers:
+                    load_function(function)
+            except ValueError as e:
+                raise ParseConfigError(str(e))
+            self.providers = providers
+
+        try:
+            self.provider_cache_size = int(
+                    config_parser['PROVIDERS']['cache_size'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse cache_size value")
+        except KeyError:
+            pass
+
+        try:
+            self.provider_ttl = float(config_parser['PROVIDERS']['cache_ttl'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse cache_ttl value")
+        except KeyError:
+            pass
+
+        try:
+            self.phase_timers = boolean(
+                    config_parser['PROFILING']['phase_timers'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse phase_timers value")
+        except KeyError:
+            pass
+
+        try:
+            self.profile_dir = config_parser['PROFILING']['dir']
+        except KeyError:
+            pass
+
+        try:
+            self.profile_seconds = float(config_parser['PROFILING']['seconds'])
+        except ValueError:
+            raise ParseConfigError("Failed to parse seconds value")
+        except KeyError:
+            pass
 
-except ParseConfigError as e:
-    logging.error("Configuration error: " + str(e))
-    logging.info("Aborting")
-    sys.exit(EXIT_CONF_ERROR)
+        if config_parser.has_section('FILE_CLASSES'):
+            file_classes = []
+            for name, value in config_parser['FILE_CLASSES'].items():
+                try:
+                    class_rate, *patterns = value.split()
+                    file_classes.append((name, int(class_rate), patterns))
+                except ValueError:
+                    raise ParseConfigError(
+                            "Failed to parse file class {}".format(name))
+            self.file_classes = file_classes
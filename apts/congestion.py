@@ -0,0 +1,182 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import importlib
+
+
+class CongestionController:
+    """
+    Decides how fast a session sends the DATA packets of a read request.
+
+    The protocol tells the controller how each window fared, and the
+    session asks it before every DATA packet how long to wait after the
+    previous one. This base class sends every window at once, as fast as
+    the socket takes it.
+
+    A client acknowledges a window only once it has received all of its
+    blocks (RFC 7440), so the number of blocks in flight is always the
+    negotiated window size. Controllers slow a transfer down by spreading
+    the windows over time instead.
+    """
+    def on_ack(self, blocks, window_size):
+        """
+        Called when the client acknowledges a whole window.
+
+        Keyword arguments:
+        blocks      -- the number of acknowledged blocks
+        window_size -- the negotiated window size
+        """
+
+    def on_loss(self):
+        """
+        Called when the client has missed blocks of a window.
+        """
+
+    def on_timeout(self):
+        """
+        Called when no answer to a window arrived in time.
+        """
+
+    def pacing_interval(self, rtt, window_size):
+        """
+        Returns the seconds to leave between two DATA packets, 0 to send
+        them at once.
+
+        Keyword arguments:
+        rtt         -- the smallest round-trip time of the transfer, None
+                       if unknown
+        window_size -- the negotiated window size
+        """
+        return 0
+
+
+class PacedController(CongestionController):
+    """
+    Spreads the packets of each window over a fraction of the round-trip
+    time, so that a window does not reach the switches and the network
+    card of the client as a single burst.
+    """
+    # Packets leave at this many times the rate of one window per round
+    # trip. As the client only answers a whole window, spreading it over
+    # the full round trip would halve the throughput.
+    pacing_gain = 4
+
+    # The number of blocks per round trip that the packets are paced at,
+    # None for the negotiated window size.
+    cwnd = None
+
+    def pacing_interval(self, rtt, window_size):
+        if rtt is None:
+            return 0
+        cwnd = window_size if self.cwnd is None else \
+            min(self.cwnd, window_size)
+        return rtt / (self.pacing_gain * cwnd)
+
+
+class AIMDController(PacedController):
+    """
+    Loss-based congestion control, with the additive increase and
+    multiplicative decrease of TCP (RFC 5681) applied to the pacing rate.
+
+    cwnd starts small and doubles with every acknowledged window, until the
+    first loss halves it. From then on, it grows by a block with every
+    acknowledged window and is halved on every loss. A timeout brings it
+    back to a single block.
+    """
+    initial_window = 4
+    min_window = 1
+    decrease = 0.5
+
+    def __init__(self):
+        self.cwnd = self.initial_window
+        # Slow start threshold, the first loss sets it.
+        self.ssthresh = None
+
+    def on_ack(self, blocks, window_size):
+        if self.ssthresh is None or self.cwnd < self.ssthresh:
+            self.cwnd *= 2
+        else:
+            self.cwnd += 1
+        self.cwnd = min(self.cwnd, window_size)
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd * self.decrease, self.min_window)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self.ssthresh = max(self.cwnd * self.decrease, self.min_window)
+        self.cwnd = self.min_window
+
+
+# The controllers that can be selected by name.
+controllers = {
+    'none': CongestionController,
+    'paced': PacedController,
+    'aimd': AIMDController,
+}
+
+
+def load_controller(name):
+    """
+    Returns the congestion controller class called name, either one of
+    controllers or the dotted path of a class, e.g. mymodule.MyController,
+    to try other algorithms.
+
+    Raises a ValueError if there is no such class.
+    """
+    if name in controllers:
+        return controllers[name]
+
+    module_name, _, class_name = name.rpartition('.')
+    try:
+        return getattr(importlib.import_module(module_name), class_name)
+    except (ValueError, ImportError, AttributeError):
+        raise ValueError('Unknown congestion controller: {}'.format(name))
+
+
+class Pacer:
+    """
+    Holds a session back so that its packets leave at a given interval.
+
+    Sleeping is only worth it for more than a quantum of time, so shorter
+    intervals build up until they amount to one, and the packets in
+    between go out as a small burst.
+    """
+    quantum = 0.001
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        """
+        Keyword arguments:
+        clock -- the clock that the packets are paced by
+        sleep -- function that sleeps for the given seconds
+        """
+        self.clock = clock
+        self.sleep = sleep
+        # The time the next packet is due.
+        self.next_send = None
+
+    def wait(self, interval):
+        """
+        Waits until the next packet is due, and schedules the one after it
+        interval seconds later.
+        """
+        now = self.clock()
+        if self.next_send is None or self.next_send < now:
+            # Idle time gives no credit for a later burst.
+            self.next_send = now
+        elif self.next_send - now >= self.quantum:
+            self.sleep(self.next_send - now)
+        self.next_send += interval
@@ -0,0 +1,148 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+import logging
+import threading
+import socketserver
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """
+    Reads a single command line from the connection, and writes back the
+    response of the command.
+    """
+    def handle(self):
+        tokens = self.rfile.readline().decode(errors='replace').split()
+        if not tokens:
+            return
+
+        name, args = tokens[0], tokens[1:]
+        try:
+            command = self.server.commands[name]
+        except KeyError:
+            response = 'error: unknown command {}\n'.format(name)
+        else:
+            try:
+                response = command(*args)
+            except Exception as e:
+                logging.error('Control command {} failed: {}'.format(name, e))
+                response = 'error: {}\n'.format(e)
+
+        self.wfile.write(response.encode())
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """
+    A local Unix socket through which tools talk to a running server.
+
+    Commands are registered with a name and a function. A client sends the
+    name of a command, optionally followed by whitespace separated
+    arguments, and a newline. The function is called with the arguments as
+    strings and returns the response as a string.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, sock=None):
+        """
+        Keyword arguments:
+        path -- filesystem path of the Unix socket
+        sock -- a listening Unix socket already bound to path, e.g. handed
+                over by a previous server process, or None to bind a new
+                one
+        """
+        if sock is not None:
+            super().__init__(path, ControlHandler, bind_and_activate=False)
+            self.socket.close()
+            self.socket = sock
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+            super().__init__(path, ControlHandler)
+            os.chmod(path, 0o600)
+        self.path = path
+        # A new server process may bind a socket at the same path, which
+        # must outlive this one.
+        self.inode = os.stat(path).st_ino
+        self.commands = {}
+
+    def register(self, name, function):
+        self.commands[name] = function
+
+    def start(self):
+        """
+        Starts serving requests on a separate thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def hand_over(self):
+        """
+        Stops serving the socket, and leaves it to the server process that
+        it has been handed over to.
+        """
+        self.shutdown()
+        self.server_close()
+
+    def stop(self):
+        self.hand_over()
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+
+def inherited_control_socket(path):
+    """
+    Returns the control socket at path that a previous server process handed
+    over to this one on a reload, with its file descriptor in
+    APTS_CONTROL_FD, or None.
+
+    The variable is removed from the environment, so that it is not passed
+    on. A socket bound to another path is closed.
+    """
+    fd = os.environ.pop('APTS_CONTROL_FD', None)
+    if fd is None:
+        return None
+    sock = socket.socket(fileno=int(fd))
+    if sock.getsockname() != path:
+        sock.close()
+        return None
+    return sock
+
+
+def send_command(path, command, timeout=5):
+    """
+    Sends a command to the control socket at path.
+
+    Returns the response as a string.
+    May raise an OSError.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(command.encode() + b'\n')
+
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    return b''.join(chunks).decode()
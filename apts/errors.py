@@ -68,10 +68,10 @@ class UnsupportedModeError(PayloadParseError):
 
 class DataSizeError(PayloadParseError):
     """
-    A DataPacket carries more than 512 bytes of data.
+    A DataPacket carries more data than the block size.
     """
     def __str__(self):
-        return "512 bytes of data is the max for a packet"
+        return "the data of a packet exceed the block size"
 
 
 class InvalidErrorcodeError(PayloadParseError):
@@ -92,6 +92,13 @@ class TftpRootError(TftpError):
     pass
 
 
+class TftpPrivilegesError(TftpError):
+    """
+    Exception class for failures to drop the root privileges.
+    """
+    pass
+
+
 class TftpIOError(TftpError):
     """
     Base exception class for Tftp I/O errors.
@@ -99,6 +106,27 @@ class TftpIOError(TftpError):
     pass
 
 
+class TftpTransferError(TftpError):
+    """
+    A transfer of the client failed, because the remote host sent an error
+    packet or did not answer.
+    """
+    def __init__(self, message, error_code=None):
+        self.message = message
+        self.error_code = error_code
+
+    def __str__(self):
+        return self.message
+
+
+class TftpTimeoutError(TftpTransferError):
+    """
+    The remote host stopped answering during a transfer of the client.
+    """
+    def __init__(self):
+        super().__init__("timed out")
+
+
 class ParseConfigError(Exception):
     """
     Failed to parse the configuration file.
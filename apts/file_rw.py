@@ -18,10 +18,27 @@ from .errors import TftpIOError
 
 
 class TftpFileIO:
-    block_size = 512
-
-    def __init__(self, mode):
+    def __init__(self, mode, block_size=512):
         self.mode = mode
+        self.block_size = block_size
+        self.closed = False
+        self._owns_file = False
+
+    def open(self, file, mode):
+        """
+        Opens file in the given binary mode, unless it is a file object
+        already. File objects are left open when the transfer ends, for
+        the caller to use them.
+        """
+        if hasattr(file, 'read') or hasattr(file, 'write'):
+            return file
+        self._owns_file = True
+        return open(file, mode=mode)
+
+    def close(self):
+        self.closed = True
+        if self._owns_file:
+            self._file.close()
 
 
 class TftpFileReader(TftpFileIO):
@@ -30,12 +47,19 @@ class TftpFileReader(TftpFileIO):
     one block at a time, taking into consideration the TFTP transfer mode.
 
     From outside of the class we should only call the get_next_block() method
-    that will return the next 512 bytes to be send to the remote host. The rest
-    of the methods are helper functions and they should not be called directly.
+    that will return the next block of bytes to be send to the remote host. The
+    rest of the methods are helper functions and they should not be called
+    directly.
     """
-    def __init__(self, filename, mode):
-        super(TftpFileReader, self).__init__(mode)
-        self._file = open(filename, mode='rb')
+    def __init__(self, filename, mode, block_size=512):
+        """
+        Keyword arguments:
+        filename   -- path of the file, or a binary file object
+        mode       -- the TFTP transfer mode, 'netascii' or 'octet'
+        block_size -- the block size of the transfer
+        """
+        super(TftpFileReader, self).__init__(mode, block_size)
+        self._file = self.open(filename, 'rb')
 
         # Raw bytes buffer.
         # Holds the last bytes read directly from the file in binary mode.
@@ -46,12 +70,15 @@ class TftpFileReader(TftpFileIO):
         # because of the size differences of raw bytes and netascii bytes.
         self.netascii_bytes = b''
 
+        # Whether the last block, shorter than block_size, has been returned.
+        self._read_last = False
+
     def get_next_block(self):
         """
-        Returns the next 512 unread bytes of the file.
-        These 512 bytes might not correspond to the original 512 bytes read
-        from the file due to netascii conversions. However, regardless of the
-        self.mode it will always return 512 bytes or less.
+        Returns the next block_size unread bytes of the file.
+        These bytes might not correspond to the original bytes read from the
+        file due to netascii conversions. However, regardless of the self.mode
+        it will always return block_size bytes or less.
         """
         if self.mode == 'netascii':
             return self.get_next_block_netascii()
@@ -60,33 +87,58 @@ class TftpFileReader(TftpFileIO):
 
     def read_next_bytes(self):
         """
-        This method reads 512 bytes from the file and save them to the
+        This method reads block_size bytes from the file and save them to the
         self._bytes variable (it doesn't return anything). If it actually read
-        less than 512 bytes, it closes the file.
+        less than block_size bytes, it closes the file.
 
         Shall not be called from outside of the class.
         """
-        if self._file.closed:
+        if self.closed:
             raise TftpIOError("read attemption of closed file")
 
         self._bytes = self._file.read(self.block_size)
         if len(self._bytes) < self.block_size:
-            self._file.close()
+            self.close()
+
+    def seek(self, offset, layout=None):
+        """
+        Makes the next block start at offset of the transferred data, e.g.
+        to restart a transfer at a given block. In netascii mode, offset
+        counts the encoded bytes, and layout is the NetasciiLayout of the
+        file, without which the file is encoded from its start up to offset.
+        """
+        if self.closed:
+            raise TftpIOError("seek attemption of closed file")
+
+        self._bytes = self.netascii_bytes = b''
+        self._read_last = False
+        if self.mode == 'octet':
+            self._file.seek(offset)
+            return
+
+        start, skip = (0, offset) if layout is None else layout.locate(offset)
+        self._file.seek(start)
+        while skip and not self.closed:
+            self.read_next_bytes()
+            encoded = netascii.encode(self._bytes)
+            self.netascii_bytes = encoded[skip:]
+            skip -= min(skip, len(encoded))
+        self._bytes = b''
 
     def get_next_block_netascii(self):
-        self.netascii_bytes += netascii.encode(self._bytes)
-        while len(self.netascii_bytes) < self.block_size:
-            try:
-                self.read_next_bytes()
-                self.netascii_bytes += netascii.encode(self._bytes)
-            except TftpIOError:
-                if self.netascii_bytes:
-                    break
-                raise # reraise the TftpIOError
+        if self._read_last:
+            raise TftpIOError("read attemption of closed file")
 
+        while len(self.netascii_bytes) < self.block_size and not self.closed:
+            self.read_next_bytes()
+            self.netascii_bytes += netascii.encode(self._bytes)
+
+        # When the encoded file ends on a block boundary, the last block is
+        # empty.
         to_send = self.netascii_bytes[:self.block_size]
         self.netascii_bytes = self.netascii_bytes[self.block_size:]
         self._bytes = b''
+        self._read_last = len(to_send) < self.block_size
         return to_send
 
     def get_next_block_octet(self):
@@ -101,23 +153,38 @@ class TftpFileWriter(TftpFileIO):
     This class is responsible for writing each block of received data on
     the appropriate file, taking into consideration the TFTP transfer mode.
     """
-    def __init__(self, filename, mode):
-        super(TftpFileWriter, self).__init__(mode)
-        self._file = open(filename, mode='wb')
+    def __init__(self, filename, mode, block_size=512):
+        """
+        Keyword arguments:
+        filename   -- path of the file, or a binary file object
+        mode       -- the TFTP transfer mode, 'netascii' or 'octet'
+        block_size -- the block size of the transfer
+        """
+        super(TftpFileWriter, self).__init__(mode, block_size)
+        self._file = self.open(filename, 'wb')
+
+        # A CR at the end of a block can only be decoded together with the
+        # LF or NUL at the start of the next one.
+        self._cr = b''
 
     def write_next_block(self, data):
         """
         Writes the given data to the file.
         It firstly converts them to netascii when needed. If the
-        given data are less than 512 bytes, it closes the file.
+        given data are less than block_size bytes, it closes the file.
         """
-        if self._file.closed:
+        if self.closed:
             raise TftpIOError("write attemption of closed file")
 
+        is_last = len(data) < self.block_size
         if self.mode == 'netascii':
-            self._file.write(netascii.decode(data))
+            encoded = self._cr + data
+            self._cr = b''
+            if encoded.endswith(b'\r') and not is_last:
+                encoded, self._cr = encoded[:-1], b'\r'
+            self._file.write(netascii.decode(encoded))
         if self.mode == 'octet':
             self._file.write(data)
 
-        if len(data) < self.block_size:
-            self._file.close()
+        if is_last:
+            self.close()
@@ -0,0 +1,202 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+import time
+import logging
+import posixpath
+import threading
+
+
+class FileIndex:
+    """
+    An in-memory index of the files in the tftp root, that finds the file a
+    client asks for when the requested name differs from the one on disk,
+    e.g. in case, or with backslashes for separators, as many PXE firmwares
+    send them.
+
+    The index maps the normalized path of every file to its path relative
+    to the root, so that a lookup costs a dictionary access whatever the
+    size of the tree. rescan() builds a new index and swaps it in as a
+    whole, so lookups never wait for a scan. Files created since the last
+    scan are still found by their exact name.
+    """
+    def __init__(self, root, case_fold=True, backslashes=True, aliases=(),
+                 clock=time.monotonic, memory=None):
+        """
+        Keyword arguments:
+        root        -- canonical path of the tftp root directory
+        case_fold   -- if True, names are looked up regardless of case
+        backslashes -- if True, backslashes in requested names are path
+                       separators
+        aliases     -- list of (pattern, replacement) tuples of regular
+                       expressions that rewrite requested names before the
+                       lookup. Only the first matching pattern applies.
+        memory      -- a MemoryAccountant to charge the index to, or None
+        """
+        self.root = root
+        self.case_fold = case_fold
+        self.backslashes = backslashes
+        self.aliases = [(re.compile(pattern), replacement)
+                        for pattern, replacement in aliases]
+        self.clock = clock
+        self.memory = memory
+
+        # normalized path -> path relative to the root
+        self.files = {}
+        # Bytes of memory the index takes, as last charged.
+        self.size = 0
+        self._scan_lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.scans = 0
+        self.scan_seconds = 0
+
+        self.rescan()
+
+    def key(self, path):
+        if self.case_fold:
+            key = path.casefold()
+            # Most names need no folding, and then share the string of the
+            # path instead of taking a copy.
+            if key == path:
+                return path
+            return key
+        return path
+
+    def normalize(self, name):
+        """
+        Returns the key that a requested name is looked up by.
+        """
+        if self.backslashes:
+            name = name.replace('\\', '/')
+        # Resolve . and .. as if the root were /, so that no name points
+        # outside of it.
+        name = posixpath.normpath('/' + name).lstrip('/')
+        for pattern, replacement in self.aliases:
+            name, count = pattern.subn(replacement, name, count=1)
+            if count:
+                break
+        return self.key(name)
+
+    def lookup(self, name):
+        """
+        Returns the path, relative to the root, of the file that the client
+        asks for with name, or None if there is none in the index.
+        """
+        path = self.files.get(self.normalize(name))
+        if path is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return path
+
+    def scan(self):
+        """
+        Walks the tree of the root and returns a new index. Symbolic links
+        to directories are not followed, as they may form loops.
+        """
+        files = {}
+        directories = ['']
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = os.scandir(os.path.join(self.root, directory))
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    path = directory + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(path + '/')
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    key = self.key(path)
+                    # Of files that differ only in case, the one named as
+                    # the key wins.
+                    if key not in files or key == path:
+                        files[key] = path
+        return files
+
+    def rescan(self):
+        """
+        Replaces the index with a new scan of the root.
+        """
+        with self._scan_lock:
+            start = self.clock()
+            files = self.scan()
+            self.files = files
+            self.scans += 1
+            self.scan_seconds = self.clock() - start
+
+            size = index_size(files)
+            if self.memory is not None:
+                self.memory.charge('file_index', size - self.size)
+            self.size = size
+        logging.debug('Indexed {} files in {:.3f} seconds'.format(
+                len(files), self.scan_seconds))
+
+    def stats(self):
+        """
+        Returns a dictionary with the counters of the index.
+        """
+        return {
+            'files': len(self.files),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'scans': self.scans,
+            'scan_seconds': self.scan_seconds,
+        }
+
+
+def index_size(files):
+    """
+    Returns the bytes of memory that the dictionary files and its strings
+    take.
+    """
+    size = sys.getsizeof(files)
+    for key, path in files.items():
+        size += sys.getsizeof(key)
+        if path is not key:
+            size += sys.getsizeof(path)
+    return size
+
+
+class IndexRescanner(threading.Thread):
+    """
+    Periodically rescans a FileIndex, so that it follows the changes to the
+    tftp root.
+    """
+    def __init__(self, index, interval=60):
+        super().__init__(daemon=True)
+        self.index = index
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.index.rescan()
+
+    def stop(self):
+        self.stopped.set()
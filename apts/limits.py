@@ -0,0 +1,117 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+from .shaping import TokenBucket
+
+
+class SessionLimiter:
+    """
+    Decides whether a request received on the listening socket may start a
+    new session, before any thread or socket is created for it.
+
+    Each source IP has a token bucket for the creation of new sessions and
+    a limit on the number of its concurrent sessions. Requests that exceed
+    either of them are dropped.
+    """
+    # Forget the state of idle sources when we track more than this.
+    max_sources = 65536
+
+    def __init__(self, rate=0, burst=0, max_sessions=0, clock=time.monotonic):
+        """
+        Keyword arguments:
+        rate         -- new sessions per second allowed for each source IP
+        burst        -- new sessions a source IP may start at once,
+                        defaults to the rate (or 1 if the rate is lower)
+        max_sessions -- maximum number of concurrent sessions per source IP
+
+        Limits with a value of 0 are disabled.
+        """
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.max_sessions = max_sessions
+        self.clock = clock
+
+        # source ip -> token bucket
+        self._buckets = {}
+        # source ip -> number of active sessions
+        self._active = {}
+        self._lock = threading.Lock()
+
+        # counters
+        self.admitted = 0
+        self.dropped_rate = 0
+        self.dropped_sessions = 0
+
+    def admit(self, ip):
+        """
+        Returns True if a new session from ip may start, else False.
+
+        A True return value must be followed by a release() call once the
+        session is over.
+        """
+        with self._lock:
+            active = self._active.get(ip, 0)
+            if self.max_sessions and active >= self.max_sessions:
+                self.dropped_sessions += 1
+                return False
+
+            if self.rate:
+                now = self.clock()
+                bucket = self._buckets.get(ip)
+                if bucket is None:
+                    if len(self._buckets) >= self.max_sources:
+                        self.prune(now)
+                    bucket = self._buckets[ip] = TokenBucket(self.rate,
+                                                             self.burst)
+                if not bucket.take(1, now):
+                    self.dropped_rate += 1
+                    return False
+
+            self._active[ip] = active + 1
+            self.admitted += 1
+            return True
+
+    def release(self, ip):
+        """
+        Records the end of a session admitted for ip.
+        """
+        with self._lock:
+            active = self._active.pop(ip) - 1
+            if active:
+                self._active[ip] = active
+
+    def prune(self, now):
+        """
+        Forgets the buckets of sources that have no active sessions and
+        whose bucket is full again.
+        """
+        self._buckets = {ip: bucket for ip, bucket in self._buckets.items()
+                         if ip in self._active or not bucket.is_full(now)}
+
+    def stats(self):
+        """
+        Returns a dictionary with the counters of the limiter.
+        """
+        with self._lock:
+            return {
+                'admitted': self.admitted,
+                'dropped_rate': self.dropped_rate,
+                'dropped_sessions': self.dropped_sessions,
+                'active': sum(self._active.values()),
+                'sources': len(self._active),
+            }
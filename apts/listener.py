@@ -0,0 +1,288 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import queue
+import socket
+import struct
+import logging
+import selectors
+import threading
+
+# Linux socket options that the socket module does not export.
+# SO_RCVBUFFORCE sets a receive buffer beyond net.core.rmem_max, with
+# CAP_NET_ADMIN. SO_RXQ_OVFL attaches to every datagram the number of
+# datagrams that the kernel has dropped because the buffer was full.
+SO_RCVBUFFORCE = 33
+SO_RXQ_OVFL = 40
+LINUX = sys.platform.startswith('linux')
+
+# The first file descriptor passed by systemd socket activation.
+SD_LISTEN_FDS_START = 3
+
+
+def address_family(ip):
+    """
+    Returns the address family of the interface ip: AF_INET6 for an IPv6
+    address, e.g. '::' for all the interfaces, else AF_INET.
+    """
+    return socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+
+def udp_socket(family, ipv6_only=False):
+    """
+    Returns a new UDP socket of the given address family. Unless ipv6_only
+    is True, an IPv6 socket serves IPv4 hosts as well (dual-stack), through
+    their IPv4-mapped addresses, e.g. ::ffff:192.0.2.1.
+    """
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if family == socket.AF_INET6:
+        try:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY,
+                            ipv6_only)
+        except OSError:
+            sock.close()
+            raise
+    return sock
+
+
+def client_ip(address):
+    """
+    Returns the IP of the remote host at address, as received on a socket
+    of either family. IPv4 hosts of a dual-stack socket get their plain IPv4
+    address, so that limits and subnets apply to them as on an IPv4 socket.
+    """
+    ip = address[0]
+    if ip.startswith('::ffff:') and '.' in ip:
+        return ip[7:]
+    return ip
+
+
+def format_address(address):
+    """
+    Returns an (ip, port) address as a string, with IPv6 addresses in
+    brackets, e.g. [2001:db8::1]:69.
+    """
+    if ':' in address[0]:
+        return '[{}]:{}'.format(*address[:2])
+    return '{}:{}'.format(*address[:2])
+
+
+def inherited_socket():
+    """
+    Returns the listening socket that this process inherited, or None.
+
+    The socket is either handed over by a previous server process on a
+    reload, with its file descriptor in APTS_LISTEN_FD, or passed by
+    systemd socket activation (LISTEN_FDS and LISTEN_PID). The variables
+    are removed from the environment, so that they are not passed on.
+    """
+    fd = os.environ.pop('APTS_LISTEN_FD', None)
+    listen_fds = os.environ.pop('LISTEN_FDS', None)
+    listen_pid = os.environ.pop('LISTEN_PID', None)
+    if fd is None and listen_fds and listen_pid == str(os.getpid()):
+        fd = SD_LISTEN_FDS_START
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+def notify_ready():
+    """
+    Tells the server process that handed its listening socket over to this
+    one, if any, that this process serves requests now.
+    """
+    fd = os.environ.pop('APTS_READY_FD', None)
+    if fd is not None:
+        os.write(int(fd), b'1')
+        os.close(int(fd))
+
+
+class RequestListener:
+    """
+    The listening socket of the server.
+
+    Requests are read in batches: once a datagram arrives, all the pending
+    ones are read without blocking, so that a burst of requests leaves the
+    kernel buffer as fast as possible. On Linux, the number of requests the
+    kernel dropped because its buffer was full is counted as well.
+    """
+    # Most datagrams read in a single batch.
+    batch_size = 256
+
+    def __init__(self, ip, port, receive_buffer=0, bufsize=2048, sock=None,
+                 ipv6_only=False):
+        """
+        Keyword arguments:
+        ip             -- the interface to listen on
+        port           -- the port to listen on
+        receive_buffer -- size of the kernel receive buffer in bytes,
+                          0 for the system default
+        bufsize        -- maximum size of a received datagram
+        sock           -- a bound socket to listen on instead of ip and
+                          port, e.g. one inherited from another process
+        ipv6_only      -- if False, listening on an IPv6 address serves
+                          IPv4 requests as well
+
+        May raise an OSError if the socket cannot be bound.
+        """
+        self.bufsize = bufsize
+        self.socket = sock
+        if sock is None:
+            self.socket = udp_socket(address_family(ip), ipv6_only)
+        try:
+            if receive_buffer:
+                self.set_receive_buffer(receive_buffer)
+            if sock is None:
+                self.socket.bind((ip, port))
+        except OSError:
+            self.socket.close()
+            raise
+
+        self.track_drops = False
+        if LINUX:
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self.track_drops = True
+            except OSError:
+                pass
+        self.cmsg_size = socket.CMSG_SPACE(4) if self.track_drops else 0
+
+        # interrupt() writes to the waker to wake up receive().
+        self.interrupted = False
+        self._wakeup, self._waker = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self._wakeup, selectors.EVENT_READ)
+
+        # counters
+        self.received = 0
+        self.batches = 0
+        # The number of datagrams dropped by the kernel so far. The kernel
+        # reports it with each datagram, so drops are only counted once a
+        # later datagram has been read.
+        self.kernel_drops = 0
+
+    def set_receive_buffer(self, size):
+        """
+        Sets the size of the kernel receive buffer. Beyond the system limit,
+        this only works while the server still runs as root.
+        """
+        sock = self.socket
+        try:
+            if not LINUX:
+                raise OSError()
+            sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+        except OSError:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+        # Linux reports twice the size, as it counts its bookkeeping too.
+        granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if LINUX:
+            granted //= 2
+        if granted < size:
+            logging.warning('Receive buffer limited to {} bytes, raise '
+                            'net.core.rmem_max for more'.format(granted))
+
+    def buffer_size(self):
+        """
+        Returns the number of bytes the kernel may buffer for the socket.
+        """
+        return self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def receive(self):
+        """
+        Waits for requests and returns a list of (data, address) tuples of
+        all the pending ones, or an empty list once interrupt() is called.
+        """
+        batch = []
+        while not batch:
+            self.selector.select()
+            if self.interrupted:
+                return []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.receive_one(socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                pass
+
+        self.received += len(batch)
+        self.batches += 1
+        return batch
+
+    def receive_one(self, flags):
+        if not self.track_drops:
+            return self.socket.recvfrom(self.bufsize, flags)
+
+        data, ancdata, _, address = self.socket.recvmsg(
+                self.bufsize, self.cmsg_size, flags)
+        for level, kind, value in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                self.kernel_drops = struct.unpack('I', value[:4])[0]
+        return data, address
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'batches': self.batches,
+            'kernel_drops': self.kernel_drops,
+        }
+
+    def interrupt(self):
+        """
+        Makes receive() return an empty list, now or on its next call.
+        """
+        self.interrupted = True
+        self._waker.send(b'\0')
+
+    def close(self):
+        self.selector.close()
+        self._wakeup.close()
+        self._waker.close()
+        self.socket.close()
+
+
+class RequestDispatcher(threading.Thread):
+    """
+    Hands requests over from the listener to a thread that starts their
+    sessions, so that the listener goes back to reading requests at once
+    instead of waiting for a thread and a socket to be set up.
+    """
+    def __init__(self, handler):
+        """
+        Keyword arguments:
+        handler -- function called with the data and the address of each
+                   request
+        """
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.requests = queue.SimpleQueue()
+
+    def dispatch(self, data, address):
+        self.requests.put((data, address))
+
+    def stop(self):
+        self.requests.put(None)
+
+    def run(self):
+        for request in iter(self.requests.get, None):
+            try:
+                self.handler(*request)
+            except Exception:
+                logging.exception('Could not start session')
+
+    def stats(self):
+        return {'queued': self.requests.qsize()}
@@ -0,0 +1,90 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import atexit
+import logging
+import logging.handlers
+
+from .trace import TraceHandler
+
+
+def setup_logging(level=logging.INFO, filename=None, trace_file=None):
+    """
+    Sets up the root logger so that records are formatted and written by a
+    separate thread. Sessions only put their records on a queue, and never
+    block on a slow disk or terminal.
+
+    Keyword arguments:
+    level      -- the logging level
+    filename   -- file to append the log to, None for the standard error
+    trace_file -- file to append a trace of the requests to, None to not
+                  record a trace
+
+    Returns the QueueListener that writes the records. It is stopped, after
+    writing any pending records, when the interpreter exits.
+    """
+    if filename:
+        handler = logging.FileHandler(filename)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt='[%(asctime)s] %(message)s',
+                                           datefmt='%Y-%m-%d %H:%M:%S'))
+    handler.setLevel(level)
+    handlers = [handler]
+
+    # The trace is made of the transfer summaries, which are logged at the
+    # INFO level, so they have to pass the root logger even if the log
+    # itself is less verbose.
+    if trace_file:
+        handlers.append(TraceHandler(trace_file))
+        level = min(level, logging.INFO)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                              respect_handler_level=True)
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def log_transfer(protocol, client):
+    """
+    Logs a single summary record for a finished transfer.
+
+    The record carries the summary in its 'transfer' attribute as well, so
+    that handlers can process it without parsing the message.
+
+    Keyword arguments:
+    protocol -- the TftpProtocol of the transfer
+    client   -- the address of the remote host in a (ip, port) format
+    """
+    if not logging.root.isEnabledFor(logging.INFO):
+        return
+
+    summary = protocol.summary()
+    summary['client'] = client[0]
+    logging.info("transfer tid=%(tid)s client=%(client)s op=%(op)s "
+                 "file='%(filename)s' mode=%(mode)s outcome=%(outcome)s "
+                 "bytes=%(bytes)d duration=%(duration).3fs "
+                 "throughput=%(throughput).0fB/s retransmits=%(retransmits)d",
+                 summary, extra={'transfer': summary})
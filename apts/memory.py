@@ -0,0 +1,137 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import Counter
+
+
+class MemoryAccountant:
+    """
+    Accounts for the memory that the buffers of the server take, by
+    category, and keeps their total within a budget.
+
+    Components that buffer data either charge the bytes they hold, e.g. the
+    windows of the sessions, or register as a cache that reports its own
+    usage and can evict data. When the total exceeds the budget, the caches
+    are evicted first, in the order they registered. New sessions reserve
+    their buffers before they start, and are refused while the budget is
+    still exceeded once the caches are empty.
+    """
+    def __init__(self, budget=0):
+        """
+        Keyword arguments:
+        budget -- maximum number of bytes, 0 to only account for them
+        """
+        self.budget = budget
+
+        # category -> charged bytes
+        self._charged = Counter()
+        # (category, usage function, evict function) of each cache
+        self._caches = []
+        self._lock = threading.Lock()
+
+        # counters
+        self.evicted = 0
+        self.refused = 0
+
+    def add_cache(self, category, usage, evict):
+        """
+        Registers a cache.
+
+        Keyword arguments:
+        category -- the category of the memory of the cache
+        usage    -- function that returns the bytes the cache holds
+        evict    -- function that evicts at least the given number of bytes
+                    if it can, and returns the number of evicted bytes
+        """
+        with self._lock:
+            self._caches.append((category, usage, evict))
+
+    def charge(self, category, nbytes):
+        """
+        Adds nbytes, which may be negative, to the usage of category, and
+        evicts caches if the budget is exceeded.
+        """
+        with self._lock:
+            self._charged[category] += nbytes
+            if nbytes > 0:
+                self.make_room(0)
+
+    def release(self, category, nbytes):
+        self.charge(category, -nbytes)
+
+    def reserve(self, category, nbytes):
+        """
+        Charges nbytes to category, if they fit in the budget once the
+        caches have been evicted as needed.
+
+        Returns True if the bytes were charged, else False. They must be
+        released once they are no longer used.
+        """
+        with self._lock:
+            if not self.make_room(nbytes):
+                self.refused += 1
+                return False
+            self._charged[category] += nbytes
+            return True
+
+    def enforce(self):
+        """
+        Evicts caches until the total fits in the budget, e.g. after a
+        cache has grown.
+        """
+        with self._lock:
+            self.make_room(0)
+
+    def make_room(self, nbytes):
+        """
+        Evicts caches until nbytes more fit in the budget. Must be called
+        with the lock held.
+
+        Returns True if they fit.
+        """
+        if not self.budget:
+            return True
+        excess = self.total() + nbytes - self.budget
+        for _, _, evict in self._caches:
+            if excess <= 0:
+                break
+            freed = evict(excess)
+            self.evicted += freed
+            excess -= freed
+        return excess <= 0
+
+    def total(self):
+        return sum(self._charged.values()) + \
+            sum(usage() for _, usage, _ in self._caches)
+
+    def usage(self):
+        """
+        Returns a dictionary with the bytes used by each category.
+        """
+        with self._lock:
+            usage = Counter(self._charged)
+            for category, cache_usage, _ in self._caches:
+                usage[category] += cache_usage()
+        return dict(usage)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'used': self.total(),
+                'budget': self.budget,
+                'evicted': self.evicted,
+                'refused': self.refused,
+            }
@@ -0,0 +1,285 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import bisect
+import logging
+import threading
+
+
+class Metric:
+    """
+    Base class of all metrics.
+
+    A metric with label names is a family of metrics, one for each
+    combination of label values. Use labels() to get the member of the
+    family that should be updated.
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        Returns the metric of the family with the given label values.
+        """
+        try:
+            return self._children[values]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(values, self.child())
+
+    def child(self):
+        raise NotImplementedError("Abstract method")
+
+    def samples(self):
+        """
+        Returns a list of (name, labels, value) tuples. labels is a list of
+        (label name, label value) tuples.
+        """
+        if not self.labelnames:
+            return self.own_samples(self.name, [])
+
+        samples = []
+        for values, child in sorted(self._children.items()):
+            labels = list(zip(self.labelnames, map(str, values)))
+            samples.extend(child.own_samples(self.name, labels))
+        return samples
+
+    def own_samples(self, name, labels):
+        raise NotImplementedError("Abstract method")
+
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def child(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def own_samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down. The value can also be computed when the
+    metric is collected, by a function set with set_function().
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.function = None
+
+    def child(self):
+        return Gauge(self.name, self.help)
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def own_samples(self, name, labels):
+        if self.function is not None:
+            return [(name, labels, self.function())]
+        return [(name, labels, self.value)]
+
+
+class Histogram(Metric):
+    """
+    Counts observed values in buckets with fixed upper bounds.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def child(self):
+        return Histogram(self.name, self.help, self.buckets)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def own_samples(self, name, labels):
+        with self._lock:
+            counts, total = self.counts[:], self.sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], counts):
+            cumulative += count
+            samples.append((name + '_bucket', labels + [('le', str(bound))],
+                            cumulative))
+        samples.append((name + '_sum', labels, total))
+        samples.append((name + '_count', labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    A collection of metrics that can be rendered in the Prometheus text
+    exposition format.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, buckets, labelnames=()):
+        return self.register(Histogram(name, help, buckets, labelnames))
+
+    def render(self):
+        """
+        Returns the current values of all the metrics as a string.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += '{' + ','.join('{}="{}"'.format(*label)
+                                           for label in labels) + '}'
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics(MetricsRegistry):
+    """
+    The metrics of a TftpServer and its sessions.
+    """
+    def __init__(self):
+        super().__init__()
+
+        self.sessions = self.gauge(
+                'apts_sessions_active', 'Number of active sessions.')
+        self.requests = self.counter(
+                'apts_requests_total', 'Received requests.', ('op',))
+        self.bytes_sent = self.counter(
+                'apts_sent_bytes_total', 'Bytes of sent datagrams.')
+        self.bytes_received = self.counter(
+                'apts_received_bytes_total', 'Bytes of received datagrams.')
+        self.retransmissions = self.counter(
+                'apts_retransmissions_total', 'Retransmitted packets.')
+        self.resent_bytes = self.counter(
+                'apts_resent_bytes_total',
+                'Bytes of file data sent more than once.')
+        self.timeouts = self.counter(
+                'apts_timeouts_total', 'Expired retransmission timers.')
+        self.errors = self.counter(
+                'apts_errors_total', 'Sent error packets.', ('code',))
+        self.transfers = self.counter(
+                'apts_transfers_total', 'Finished transfers.', ('outcome',))
+        self.duration = self.histogram(
+                'apts_transfer_duration_seconds',
+                'Duration of complete transfers.',
+                (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+        self.throughput = self.histogram(
+                'apts_transfer_throughput_bytes_per_second',
+                'Throughput of complete transfers.',
+                (10**4, 10**5, 5 * 10**5, 10**6, 5 * 10**6, 10**7, 5 * 10**7,
+                 10**8))
+        self.block_rtt = self.histogram(
+                'apts_block_rtt_seconds',
+                'Time between sending a packet and receiving its answer.',
+                (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+
+    def add_stats(self, prefix, help, stats_function, keys):
+        """
+        Exports values of the dictionary returned by stats_function as
+        gauges named prefix_key. The function is called on every collection.
+        """
+        for key in keys:
+            gauge = self.gauge('{}_{}'.format(prefix, key), help)
+            gauge.set_function(lambda key=key: stats_function()[key])
+
+    def transfer_finished(self, protocol):
+        """
+        Records the metrics of a finished transfer.
+        """
+        summary = protocol.summary()
+        self.transfers.labels(summary['outcome']).inc()
+        if protocol.opname == 'RRQ':
+            self.resent_bytes.inc(
+                    max(0, protocol.bytes_sent - protocol.transferred))
+        if summary['outcome'] == 'complete':
+            self.duration.observe(summary['duration'])
+            self.throughput.observe(summary['throughput'])
+
+
+class PrometheusFileWriter(threading.Thread):
+    """
+    Periodically writes the metrics of a registry to a file, e.g. for the
+    textfile collector of the Prometheus node exporter.
+    """
+    def __init__(self, registry, path, interval=15):
+        super().__init__(daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        # Write a temporary file and rename it, so that readers never see
+        # a partially written file.
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(self.registry.render())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.error('Could not write metrics: {}'.format(e))
+
+    def stop(self):
+        self.stopped.set()
@@ -53,16 +53,21 @@ class RQPacket(TftpPacket):
      ------------------------------------------------
     | 01/02  |  Filename  |   0  |    Mode    |   0  |
      ------------------------------------------------
+
+    The mode may be followed by options (RFC 2347), each one a pair of
+    zero-terminated name and value strings.
     """
 
-    def __init__(self, filename, mode):
+    def __init__(self, filename, mode, options=None):
         """
         Keyword arguments:
         filename -- raw bytes, represents the requested file name
         mode     -- raw bytes, transfer mode, can be b'netascii' or b'octet'
+        options  -- dictionary of raw bytes option names to raw bytes values
         """
         self.filename = filename
         self.mode = mode.lower()
+        self.options = options or {}
 
         if self.mode not in (b'netascii', b'octet'):
             raise UnsupportedModeError(self.mode.decode())
@@ -73,11 +78,20 @@ class RQPacket(TftpPacket):
         if len(tokens) < 2:
             raise PayloadParseError("not enough fields in the payload")
 
-        return cls(filename=tokens[0], mode=tokens[1])
+        # Option names are case insensitive. An incomplete trailing option
+        # is ignored.
+        options = {}
+        for i in range(2, len(tokens) - 2, 2):
+            options[tokens[i].lower()] = tokens[i + 1]
+
+        return cls(filename=tokens[0], mode=tokens[1], options=options)
 
     def to_wire(self):
-        return b''.join((struct.pack("!H", self.opcode), self.filename,
-                         self.seperator, self.mode, self.seperator))
+        fields = [struct.pack("!H", self.opcode), self.filename,
+                  self.seperator, self.mode, self.seperator]
+        for name, value in self.options.items():
+            fields.extend((name, self.seperator, value, self.seperator))
+        return b''.join(fields)
 
     def __str__(self):
         return "filename='{}' mode='{}'".format(
@@ -108,30 +122,42 @@ class DataPacket(TftpPacket):
     """
     opcode = 3
 
-    def __init__(self, blockn, data):
+    # The largest block size that can be negotiated (RFC 2348).
+    max_block_size = 65464
+
+    def __init__(self, blockn, data, block_size=512):
         """
         Keyword arguments:
-        blockn -- integer, sequence number
-        data   -- raw bytes, file data, 512 bytes or less
+        blockn     -- integer, sequence number
+        data       -- raw bytes, file data, block_size bytes or less
+        block_size -- integer, the block size of the transfer
 
         The is_last instance variable indicates whether the packet is the last
         in the sequence of all the sent or received packets.
         """
-        if len(data) > 512:
+        if len(data) > block_size:
             raise DataSizeError()
 
         self.blockn = blockn
         self.data = data
-        self.is_last = len(data) < 512
+        self.is_last = len(data) < block_size
 
     @classmethod
     def from_wire(cls, payload):
+        """
+        The block size of a received packet is not known, so is_last assumes
+        the default one. Receivers that negotiated a larger block size have
+        to compare the length of the data with it themselves.
+        """
         try:
             blockn = struct.unpack('!H', payload[:2])[0]
         except struct.error:
             raise PayloadParseError("couldn't extract block number")
 
-        return cls(blockn, data=payload[2:])
+        data = payload[2:]
+        if len(data) > cls.max_block_size:
+            raise DataSizeError()
+        return cls(blockn, data, block_size=max(512, len(data)))
 
     def to_wire(self):
         return b''.join((struct.pack('!HH', self.opcode, self.blockn), self.data))
@@ -194,6 +220,7 @@ class ErrorPacket(TftpPacket):
     ERR_UNKNOWN_TID = 5
     ERR_FILE_EXISTS = 6
     ERR_NO_SUCH_USER = 7
+    ERR_OPTION_NEGOTIATION = 8
 
     errors = {
         ERR_NOT_DEFINED: "",
@@ -204,6 +231,7 @@ class ErrorPacket(TftpPacket):
         ERR_UNKNOWN_TID: "Unknown transfer ID",
         ERR_FILE_EXISTS: "File already exists",
         ERR_NO_SUCH_USER: "No such user",
+        ERR_OPTION_NEGOTIATION: "Option negotiation failed",
     }
 
     def __init__(self, error_code, error_msg=None):
@@ -240,6 +268,44 @@ class ErrorPacket(TftpPacket):
                 self.error_code, self.error_msg.decode())
 
 
+class OACKPacket(TftpPacket):
+    """
+    OACKPacket representation (RFC 2347):
+
+     2 bytes   string   1 byte   string   1 byte
+     --------------------------------------------------
+    |  06   |  Option  |   0  |  Value  |   0  |  ...  |
+     --------------------------------------------------
+    """
+    opcode = 6
+
+    def __init__(self, options):
+        """
+        Keyword arguments:
+        options -- dictionary of raw bytes option names to raw bytes values
+        """
+        self.options = options
+
+    @classmethod
+    def from_wire(cls, payload):
+        tokens = payload.split(TftpPacket.seperator)
+        options = {}
+        for i in range(0, len(tokens) - 2, 2):
+            options[tokens[i].lower()] = tokens[i + 1]
+
+        return cls(options)
+
+    def to_wire(self):
+        fields = [struct.pack("!H", self.opcode)]
+        for name, value in self.options.items():
+            fields.extend((name, self.seperator, value, self.seperator))
+        return b''.join(fields)
+
+    def __str__(self):
+        return "[OACK] " + ' '.join('{}={}'.format(name.decode(), value.decode())
+                                    for name, value in self.options.items())
+
+
 class PacketFactory:
     """
     This class generates TftpPacket objects by using its create() method.
@@ -252,6 +318,7 @@ class PacketFactory:
         DataPacket.opcode: DataPacket,
         ACKPacket.opcode: ACKPacket,
         ErrorPacket.opcode: ErrorPacket,
+        OACKPacket.opcode: OACKPacket,
     }
 
     def create(self, data):
@@ -0,0 +1,129 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import socket
+import threading
+from collections import OrderedDict
+
+from .listener import LINUX, address_family
+
+# Linux socket options that the socket module does not export. With
+# IP_PMTUDISC_DO the kernel never fragments the datagrams of the socket, and
+# IP_MTU reads the path MTU that it knows for the connected destination,
+# i.e. the MTU of the route, lowered by any ICMP "fragmentation needed"
+# received since.
+IP_MTU_DISCOVER = 10
+IP_MTU = 14
+IPV6_MTU_DISCOVER = 23
+IPV6_MTU = 24
+PMTUDISC_DO = 2
+
+# Bytes of the IP, UDP and TFTP DATA headers in front of each block.
+HEADERS = {
+    socket.AF_INET: 20 + 8 + 4,
+    socket.AF_INET6: 40 + 8 + 4,
+}
+
+
+def path_mtu(ip):
+    """
+    Returns the path MTU to the host ip as the kernel knows it, or None if
+    it cannot tell.
+
+    No packet is sent: the MTU is read from a UDP socket connected to the
+    host, which takes a route lookup only.
+    """
+    if not LINUX:
+        return None
+    family = address_family(ip)
+    if family == socket.AF_INET6:
+        level, discover, mtu = socket.IPPROTO_IPV6, IPV6_MTU_DISCOVER, IPV6_MTU
+    else:
+        level, discover, mtu = socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_MTU
+    try:
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(level, discover, PMTUDISC_DO)
+            sock.connect((ip, 9))
+            return sock.getsockopt(level, mtu)
+    except OSError:
+        return None
+
+
+class PathMtuCache:
+    """
+    The largest block size that reaches each host without IP fragmentation,
+    where a lost fragment loses the whole block.
+
+    The block size of a host is derived from its path MTU, and kept for
+    ttl seconds, as the kernel forgets a lowered path MTU after 10 minutes
+    by default. The least recently used hosts are dropped beyond
+    max_hosts.
+    """
+    def __init__(self, ttl=600, max_hosts=4096, clock=time.monotonic,
+                 probe=path_mtu):
+        """
+        Keyword arguments:
+        ttl       -- seconds after which the path MTU of a host is read again
+        max_hosts -- maximum number of hosts in the cache
+        probe     -- function that returns the path MTU to an IP, or None
+        """
+        self.ttl = ttl
+        self.max_hosts = max_hosts
+        self.clock = clock
+        self.probe = probe
+
+        # ip -> (probed_at, block size or None), the least recently used
+        # first
+        self._hosts = OrderedDict()
+        self._lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def block_size(self, ip):
+        """
+        Returns the largest block size that fits the path MTU to the host
+        ip, or None if the path MTU is unknown.
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self._hosts.get(ip)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.hits += 1
+                self._hosts.move_to_end(ip)
+                return entry[1]
+            self.misses += 1
+
+        mtu = self.probe(ip)
+        size = None
+        if mtu is not None:
+            size = mtu - HEADERS[address_family(ip)]
+
+        with self._lock:
+            self._hosts[ip] = (now, size)
+            self._hosts.move_to_end(ip)
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        return size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hosts': len(self._hosts),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,164 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+
+class PhaseTimers:
+    """
+    Aggregates the time the sessions spend in each phase of their work, as
+    a histogram of the server metrics labelled with the phase:
+
+    parse       -- parsing received packets
+    read        -- reading blocks of the file to send
+    write       -- writing received blocks to the file
+    send        -- encoding and sending packets
+    client_wait -- waiting for the next packet of the client
+    """
+    phases = ('parse', 'read', 'write', 'send', 'client_wait')
+
+    def __init__(self, registry, clock=time.perf_counter):
+        """
+        Keyword arguments:
+        registry -- the MetricsRegistry to add the histogram to
+        clock    -- the clock that the phases are timed with
+        """
+        self.clock = clock
+        histogram = registry.histogram(
+                'apts_phase_seconds', 'Time spent by sessions in each phase.',
+                (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+                 0.1, 0.5, 1, 5), ('phase',))
+        self.histograms = {phase: histogram.labels(phase)
+                           for phase in self.phases}
+
+    def add(self, phase, seconds):
+        self.histograms[phase].observe(seconds)
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler of the session threads.
+
+    While it runs, a separate thread takes a sample of the call stack of
+    every session at a fixed interval. The sessions themselves do nothing
+    different, so profiling costs them nothing when it is not running and
+    very little when it is, and it works after the server has dropped its
+    privileges.
+
+    The samples are written in the collapsed stack format, one line per
+    distinct stack with its frames separated by semicolons, followed by
+    the number of samples. The file can be turned into a flame graph, e.g.
+    with flamegraph.pl or speedscope.
+    """
+    def __init__(self, threads, directory, interval=0.005):
+        """
+        Keyword arguments:
+        threads   -- function that returns the threads to sample
+        directory -- directory to write the profiles to
+        interval  -- seconds between samples
+        """
+        self.threads = threads
+        self.directory = directory
+        self.interval = interval
+        # The thread that takes the current or last profile.
+        self.thread = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def start(self, seconds):
+        """
+        Starts profiling for the given seconds on a separate thread.
+
+        Returns the path of the file the profile will be written to.
+        Raises a ValueError if seconds is not positive and a RuntimeError
+        if a profile is already being taken.
+        """
+        seconds = float(seconds)
+        if seconds <= 0:
+            raise ValueError('the duration must be positive')
+        with self._lock:
+            if self._running:
+                raise RuntimeError('a profile is already being taken')
+            self._running = True
+
+        # The directory may be shared with other users, e.g. /tmp, so the
+        # file gets a name that cannot be guessed and is created anew,
+        # rather than following a link someone left in its place.
+        try:
+            fd, path = tempfile.mkstemp(
+                    prefix='apts-profile-{}-'.format(
+                            time.strftime('%Y%m%d-%H%M%S')),
+                    suffix='.txt', dir=self.directory)
+        except OSError:
+            self._running = False
+            raise
+        self.thread = threading.Thread(target=self.run,
+                                       args=(seconds, fd, path), daemon=True)
+        self.thread.start()
+        return path
+
+    def run(self, seconds, fd, path):
+        try:
+            stacks = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                samples += self.sample(stacks)
+                time.sleep(self.interval)
+            self.write(fd, stacks)
+        except OSError as e:
+            logging.error('Could not write profile: {}'.format(e))
+        else:
+            logging.info('Wrote profile of {} samples to {}'.format(
+                    samples, path))
+        finally:
+            self._running = False
+
+    def sample(self, stacks):
+        """
+        Adds the current call stack of every thread to the stacks Counter.
+
+        Returns the number of sampled threads.
+        """
+        idents = {thread.ident for thread in self.threads()}
+        sampled = 0
+        for ident, frame in sys._current_frames().items():
+            if ident not in idents:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                frame = frame.f_back
+            stacks[';'.join(reversed(names))] += 1
+            sampled += 1
+        return sampled
+
+    @staticmethod
+    def write(file, stacks):
+        """
+        Writes the stacks to file, a path or a file descriptor.
+        """
+        with open(file, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
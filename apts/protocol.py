@@ -0,0 +1,653 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+
+from .errors import PacketParseError, TftpTransferError
+from .file_rw import TftpFileReader, TftpFileWriter
+from .textindex import NetasciiLayout, encoded_size
+from .packets import (RRQPacket, WRQPacket, DataPacket, ACKPacket, ErrorPacket,
+                      OACKPacket, PacketFactory)
+
+
+class TftpProtocol:
+    """
+    The protocol logic of a single TFTP transfer, as seen from the server.
+
+    This class does no network I/O and never reads a clock. The engine that
+    drives it (a thread, an event loop, a simulator) feeds it with the raw
+    data received from the remote host by calling receive(), and with timer
+    expirations by calling expire(). In both cases the engine passes the
+    current time and gets back a list of packets that must be sent to the
+    remote host. After each call the engine should arm a timer for the
+    protocol's deadline. When the transfer is over, closed becomes True and
+    deadline becomes None.
+    """
+    factory = PacketFactory()
+
+    # Each time we retransmit a package, we can have different timeout
+    # values. When and if the values of the following tuple is exhausted,
+    # the transfer is considered failed and the session is terminated.
+    timeout_values = (3, 5, 8)
+
+    # The largest block size (RFC 2348) and window size (RFC 7440) granted
+    # to a client that asks for more.
+    max_block_size = DataPacket.max_block_size
+    max_window_size = 64
+
+    def __init__(self, tftp_root, allow_write, tid=None, relay=None,
+                 phase_timers=None, congestion=None, index=None,
+                 providers=None, client_ip=None, netascii_index=None,
+                 max_block_size=None):
+        """
+        Keyword arguments:
+        tftp_root   -- canonical path of the tftp root directory
+        allow_write -- if False, reject all WRQs
+        tid         -- transfer identifier, only used for logging
+        relay       -- a RelayCache that RRQs are answered from, or None to
+                       answer them from the tftp root
+        phase_timers -- a PhaseTimers that the parsing, reading and writing
+                        are timed in, or None
+        congestion  -- a CongestionController told how the sent windows
+                       fare, or None
+        index       -- a FileIndex that the files of RRQs are looked up in,
+                       or None to only find them by their exact name
+        providers   -- a ProviderCache that produces the files of RRQs
+                       before they are looked up, or None
+        client_ip   -- the IP address of the remote host, as passed to the
+                       providers
+        netascii_index -- a NetasciiIndex that the tsize of netascii RRQs
+                          is looked up in, or None to count the line endings
+                          of the file on every request
+        max_block_size -- the largest block size to grant, e.g. the one that
+                          fits the path MTU to the remote host, or None for
+                          no limit but that of the protocol
+        """
+        self.tftp_root = tftp_root
+        self.allow_write = allow_write
+        self.tid = tid
+        self.relay = relay
+        self.phase_timers = phase_timers
+        self.congestion = congestion
+        self.index = index
+        self.providers = providers
+        self.client_ip = client_ip
+        self.netascii_index = netascii_index
+        if max_block_size is not None:
+            self.max_block_size = min(max_block_size, self.max_block_size)
+
+        # Name of the requested file, as sent by the remote host, and its
+        # size in bytes if it is known.
+        self.filename = None
+        self.file_size = None
+        self.opname = None
+        self.mode = None
+
+        # Options of the request (RFC 2347), names and values as strings.
+        self.options = {}
+
+        # When we receive data, blockn indicates the block number of the next
+        # DataPacket that we expect to acknowledge. When we send data, blockn
+        # indicates the block number of the last sent DataPacket. It keeps
+        # counting past 65535, the block numbers on the wire wrap around.
+        self.blockn = 0
+
+        # Negotiated with the options of the request. With a window size of
+        # n, n DataPackets are sent before an ACK is expected.
+        self.block_size = 512
+        self.window_size = 1
+        # The sent DataPackets that have not been acknowledged yet, and
+        # whether the last block of the file is among the sent ones.
+        self.window = []
+        self.read_all = False
+        # Time the window was last sent.
+        self.window_sent_at = None
+        # The number of DataPackets received since our last ACK.
+        self.received_in_window = 0
+        # The number of the last DataPacket received out of order since the
+        # last one received in order, None if there is none.
+        self.out_of_order = None
+
+        # Save the last packet we sent, to make retransmission easy.
+        self.last_sent = None
+        self.last_received = None
+
+        # Indicates the number of retransmissions of the last sent packet.
+        self.retransmissions = 0
+
+        # Absolute time at which expire() should be called, None if there is
+        # no timer to arm.
+        self.deadline = None
+        self.closed = False
+
+        # Statistics of the transfer. transferred counts each byte of the
+        # file once, bytes_sent counts the data of every sent DataPacket,
+        # including retransmissions.
+        self.started = None
+        self.finished = None
+        self.closed_at = None
+        self.transferred = 0
+        self.bytes_sent = 0
+        self.total_retransmissions = 0
+        # Packets sent again by the last call to receive() or expire().
+        self.resent = 0
+        self.complete = False
+        self.error_code = None
+
+        # Time the last packet was sent, None if it has been retransmitted.
+        # When its answer arrives, the round-trip time is saved in last_rtt,
+        # and last_rtt stays None on any other call to receive().
+        self.sent_at = None
+        self.received_at = None
+        self.last_rtt = None
+        # Smoothed round-trip time, as in RFC 6298, and the smallest one,
+        # which neither queues nor the timeouts of the client inflate.
+        self.srtt = None
+        self.min_rtt = None
+
+        # A TftpFileReader instance will be initialized if, and at the time,
+        # we receive a RRQ packet.
+        self.file_reader = None
+        # The file object the reader reads from, if we opened it ourselves,
+        # e.g. from the relay cache. It is closed with the transfer.
+        self.source = None
+        # As above, will be initialized with a WRQ packet.
+        self.file_writer = None
+
+        self.respond_map = {
+            RRQPacket: self.respond_to_RRQ, WRQPacket: self.respond_to_WRQ,
+            DataPacket: self.respond_to_Data, ACKPacket: self.respond_to_ACK,
+            ErrorPacket: self.respond_to_Error,
+            OACKPacket: self.respond_to_Error,
+        }
+
+    def receive(self, data, now):
+        """
+        Handles raw data received from the remote host.
+
+        Returns a list of TftpPackets to be sent to the remote host.
+        """
+        self.resent = 0
+        if self.closed:
+            return []
+        if self.started is None:
+            self.started = now
+        self.received_at = now
+        self.last_rtt = None
+
+        packet = self.respond_to_data(data)
+        if self.complete and self.finished is None:
+            # The transfer ends with the last block, even if we wait to
+            # acknowledge a retransmission of it.
+            self.finished = now
+        if packet == []:
+            return []
+        self.retransmissions = 0
+        return self.transmit(packet, now)
+
+    def expire(self, now):
+        """
+        Handles the expiration of the timer armed for the current deadline.
+
+        Returns a list of TftpPackets to be sent to the remote host.
+        """
+        self.resent = 0
+        if self.closed:
+            return []
+
+        self.retransmissions += 1
+        if not self.must_retransmit():
+            self.close(now)
+            return []
+
+        self.total_retransmissions += 1
+        if self.congestion is not None and isinstance(self.last_sent, list):
+            self.congestion.on_timeout()
+        packets = self.resend_last(now)
+        self.resent = len(packets)
+        return packets
+
+    def transmit(self, packet, now):
+        """
+        Records packet, a TftpPacket or a list of DataPackets, as the last
+        sent packet and arms the retransmission timer. Error packets and None
+        terminate the transfer.
+
+        Returns a list of TftpPackets to be sent to the remote host.
+        """
+        self.last_sent = packet
+        if packet is None:
+            self.close(now)
+            return []
+        if isinstance(packet, ErrorPacket):
+            self.error_code = packet.error_code
+            self.close(now)
+            return [packet]
+
+        packets = packet if isinstance(packet, list) else [packet]
+        for sent in packets:
+            if isinstance(sent, DataPacket):
+                self.bytes_sent += len(sent.data)
+                self.window_sent_at = now
+
+        # Karn's algorithm: the answer of a retransmitted packet is ambiguous
+        # and gives no round-trip time sample.
+        self.sent_at = now if self.retransmissions == 0 else None
+        self.deadline = now + self.timeout_values[self.retransmissions]
+        return packets
+
+    def sent(self, now):
+        """
+        Records that the packets returned last were all sent at now, which
+        may be later than when they were returned, e.g. if their sending was
+        shaped or paced, so that the round-trip time is measured from the
+        last one and the retransmission timer starts once it is sent.
+        """
+        if self.sent_at is not None:
+            self.sent_at = now
+        if self.window_sent_at is not None:
+            self.window_sent_at = now
+        if self.deadline is not None:
+            self.deadline = now + self.timeout_values[self.retransmissions]
+
+    def resend_last(self, now):
+        """
+        Retransmits the last sent packet, due to a timeout.
+        """
+        return self.transmit(self.last_sent, now)
+
+    def must_retransmit(self):
+        """
+        Checks whether the last sent packet needs retransmission after a
+        timeout.
+
+        Returns True if we need to retransmit the last packet, else False.
+        """
+        if self.retransmissions >= len(self.timeout_values):
+            return False
+        # Do not retransmit ACK packets for the last block of data.
+        if isinstance(self.last_received, DataPacket):
+            return not self.complete
+        return True
+
+    def close(self, now):
+        self.closed = True
+        self.deadline = None
+        self.closed_at = now
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if self.finished is None:
+            self.finished = now
+
+    def outcome(self):
+        """
+        Returns 'complete', 'error' or 'timeout', depending on how the
+        transfer ended. An unfinished transfer has no outcome, None.
+        """
+        if self.complete:
+            return 'complete'
+        if self.error_code is not None:
+            return 'error'
+        if self.closed:
+            return 'timeout'
+        return None
+
+    def summary(self):
+        """
+        Returns a dictionary that summarizes the transfer.
+        """
+        duration = linger = 0
+        if self.started is not None and self.finished is not None:
+            duration = self.finished - self.started
+        if self.closed_at is not None and self.finished is not None:
+            linger = self.closed_at - self.finished
+
+        return {
+            'tid': self.tid,
+            'op': self.opname,
+            'filename': self.filename,
+            'mode': self.mode,
+            'options': self.options,
+            'size': self.file_size,
+            'outcome': self.outcome(),
+            'error_code': self.error_code,
+            'bytes': self.transferred,
+            'duration': duration,
+            # Seconds the session stayed open after the end of the transfer.
+            'linger': linger,
+            'throughput': self.transferred / duration if duration else 0,
+            'retransmits': self.total_retransmissions,
+        }
+
+    def measure_rtt(self):
+        """
+        Called when the answer to the last sent packet has been received.
+        """
+        if self.sent_at is not None:
+            rtt = self.last_rtt = self.received_at - self.sent_at
+            if self.srtt is None:
+                self.srtt = self.min_rtt = rtt
+            else:
+                self.srtt += (rtt - self.srtt) / 8
+                self.min_rtt = min(self.min_rtt, rtt)
+            # Only the first answer gives a sample, e.g. of all the blocks
+            # of a window that follow an ACK.
+            self.sent_at = None
+
+    def respond_to_data(self, data):
+        """
+        Creates an appropriate TftpPacket as a response to the received raw
+        data, based on the type of packet of the received data.
+
+        Returns a TftpPacket, a list of DataPackets, or None. None means
+        that the transfer is over and nothing has to be sent, while an empty
+        list means that the received data need no answer and the transfer
+        goes on.
+        """
+        timers = self.phase_timers
+        if timers is not None:
+            start = timers.clock()
+        try:
+            packet = self.factory.create(data)
+        except PacketParseError:
+            logging.debug("[Recv TID=%s] [UNKOWN] Failed to parse received "
+                          "packet", self.tid)
+            return ErrorPacket(ErrorPacket.ERR_ILLEGAL_OPERATION)
+        finally:
+            if timers is not None:
+                timers.add('parse', timers.clock() - start)
+
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("[Recv TID=%s] %s", self.tid, packet)
+        self.last_received = packet
+        return self.respond_map[type(packet)](packet)
+
+    @staticmethod
+    def decode_options(packet):
+        """
+        Returns the options of a request as a dictionary of strings, or None
+        if any of them is not valid UTF-8.
+        """
+        try:
+            return {name.decode(): value.decode()
+                    for name, value in packet.options.items()}
+        except UnicodeDecodeError:
+            return None
+
+    def negotiate(self):
+        """
+        Applies the options of the request that we support: blksize
+        (RFC 2348), tsize (RFC 2349) and windowsize (RFC 7440). Options that
+        are unknown or have invalid values are ignored.
+
+        Returns the options to acknowledge with an OACK, an empty dictionary
+        if there are none.
+        """
+        accepted = {}
+        for name, value in self.options.items():
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+
+            if name == 'blksize' and value >= 8:
+                self.block_size = min(value, self.max_block_size)
+                accepted[name] = self.block_size
+            elif name == 'windowsize' and 1 <= value <= 65535:
+                self.window_size = min(value, self.max_window_size)
+                accepted[name] = self.window_size
+            elif name == 'tsize' and value >= 0:
+                # The client tells the size of the file it writes, and asks
+                # for the size of the file it reads, if we know it.
+                if self.opname == 'WRQ':
+                    self.file_size = value
+                if self.file_size is not None:
+                    accepted[name] = self.file_size
+
+        return {name.encode(): str(value).encode()
+                for name, value in accepted.items()}
+
+    def fill_window(self):
+        """
+        Reads new blocks from the file until the window is full or the whole
+        file has been read.
+
+        Returns the list of the DataPackets of the window, to be sent.
+        """
+        timers = self.phase_timers
+        while len(self.window) < self.window_size and not self.read_all:
+            if timers is not None:
+                start = timers.clock()
+            try:
+                data = self.file_reader.get_next_block()
+            except TftpTransferError as e:
+                return self.upstream_error(e)
+            if timers is not None:
+                timers.add('read', timers.clock() - start)
+            self.blockn += 1
+            self.transferred += len(data)
+            packet = DataPacket(self.blockn % 65536, data, self.block_size)
+            self.window.append(packet)
+            self.read_all = packet.is_last
+        return list(self.window)
+
+    def respond_to_RRQ(self, packet):
+        fname, mode = packet.filename.decode(), packet.mode.decode()
+        self.opname, self.filename, self.mode = 'RRQ', fname, mode
+        options = self.decode_options(packet)
+        if options is None:
+            return ErrorPacket(ErrorPacket.ERR_OPTION_NEGOTIATION)
+        self.options = options
+
+        provided = None
+        if self.providers is not None:
+            try:
+                provided = self.providers.open(fname.strip('/'),
+                                               self.client_ip)
+            except TftpTransferError as e:
+                return self.upstream_error(e)
+
+        if provided is not None:
+            self.source, self.file_size = provided
+            source = self.source
+            if mode == 'netascii' and 'tsize' in self.options:
+                self.file_size = encoded_size(self.source.getvalue())
+        elif self.relay is not None:
+            try:
+                self.source, self.file_size = self.relay.open(fname.strip('/'))
+            except TftpTransferError as e:
+                return self.upstream_error(e)
+            source = self.source
+            # The encoded size of a file that is still arriving from
+            # upstream is unknown, so no tsize is offered for it.
+            if mode == 'netascii':
+                self.file_size = None
+        else:
+            path = os.path.realpath(os.path.join(self.tftp_root,
+                                                 fname.strip('/')))
+            # The name on disk may differ from the requested one, e.g. in
+            # case, but a file of the exact name always wins. The checks
+            # below apply to the indexed file all the same.
+            if self.index is not None and not os.path.isfile(path):
+                fname = self.index.lookup(fname) or fname
+                path = os.path.realpath(os.path.join(self.tftp_root,
+                                                     fname.strip('/')))
+
+            # Ensure that file exists, is readable and resides in the tftp
+            # root.
+            if not os.path.isfile(path) or not path.startswith(self.tftp_root):
+                return ErrorPacket(ErrorPacket.ERR_FILE_NOT_FOUND)
+            if not os.access(path, os.R_OK):
+                return ErrorPacket(ErrorPacket.ERR_ACCESS_VIOLATION)
+
+            self.file_size = os.path.getsize(path)
+            source = path
+            # tsize is the size of the transferred data, which in netascii
+            # is only known once the file has been encoded.
+            if mode == 'netascii' and 'tsize' in self.options:
+                try:
+                    self.file_size = self.netascii_layout(path).encoded_size
+                except OSError:
+                    return ErrorPacket(ErrorPacket.ERR_ACCESS_VIOLATION)
+
+        accepted = self.negotiate()
+        self.file_reader = TftpFileReader(source, mode, self.block_size)
+
+        # With options, the transfer starts once the client acknowledges
+        # our OACK with an ACK for block 0.
+        if accepted:
+            return OACKPacket(accepted)
+        return self.fill_window()
+
+    def netascii_layout(self, path):
+        """
+        Returns the NetasciiLayout of the file at path.
+
+        May raise an OSError if it cannot be read.
+        """
+        if self.netascii_index is not None:
+            return self.netascii_index.layout(path)
+        return NetasciiLayout(path)
+
+    @staticmethod
+    def upstream_error(error):
+        """
+        Returns the ErrorPacket that passes on a failure of the upstream
+        server of the relay, or of a provider.
+        """
+        error_code = error.error_code
+        if error_code not in ErrorPacket.errors:
+            error_code = ErrorPacket.ERR_NOT_DEFINED
+        return ErrorPacket(error_code, str(error).encode())
+
+    def respond_to_WRQ(self, packet):
+        fname, mode = packet.filename.decode(), packet.mode.decode()
+        self.opname, self.filename, self.mode = 'WRQ', fname, mode
+        options = self.decode_options(packet)
+        if options is None:
+            return ErrorPacket(ErrorPacket.ERR_OPTION_NEGOTIATION)
+        self.options = options
+        path = os.path.realpath(os.path.join(self.tftp_root, fname.strip('/')))
+
+        if not all([self.allow_write,
+                    path.startswith(self.tftp_root),
+                    os.access(os.path.split(path)[0], os.W_OK)]):
+            return ErrorPacket(ErrorPacket.ERR_ACCESS_VIOLATION)
+
+        accepted = self.negotiate()
+        self.file_writer = TftpFileWriter(path, mode, self.block_size)
+        self.blockn = 1
+
+        if accepted:
+            return OACKPacket(accepted)
+        return ACKPacket(0)
+
+    def respond_to_Data(self, packet):
+        if self.file_writer is None:
+            return ErrorPacket(ErrorPacket.ERR_ILLEGAL_OPERATION)
+
+        if packet.blockn != self.blockn % 65536:
+            # A duplicate, or a block after a lost one: acknowledge the last
+            # block received in order, so that the client resends from the
+            # block after it. The rest of a window that follows the gap is
+            # not acknowledged again, as every ACK would make the client
+            # resend the window, unless the client has started over from an
+            # earlier block. A repeat of the last block received in order
+            # means that our ACK of it was lost, and is always answered.
+            last, self.out_of_order = self.out_of_order, packet.blockn
+            if self.window_size > 1 and last is not None and \
+                    packet.blockn != (self.blockn - 1) % 65536 and \
+                    (packet.blockn - last) % 65536 < 32768:
+                # The client is still there, even if it gets no answer.
+                self.retransmissions = 0
+                return []
+            self.received_in_window = 0
+            return ACKPacket((self.blockn - 1) % 65536)
+        self.out_of_order = None
+
+        self.measure_rtt()
+        timers = self.phase_timers
+        if timers is not None:
+            start = timers.clock()
+        try:
+            self.file_writer.write_next_block(packet.data)
+        except IOError:
+            return ErrorPacket(ErrorPacket.ERR_DISK_FULL)
+        if timers is not None:
+            timers.add('write', timers.clock() - start)
+
+        self.blockn += 1
+        self.transferred += len(packet.data)
+        self.complete = len(packet.data) < self.block_size
+
+        # Acknowledge every window_size blocks, and the last one. In the
+        # middle of a window, only record the ACK to send on a timeout, so
+        # that the client resends from the first missing block.
+        self.received_in_window += 1
+        if self.complete or self.received_in_window >= self.window_size:
+            self.received_in_window = 0
+            return ACKPacket(packet.blockn)
+        self.last_sent = ACKPacket(packet.blockn)
+        return []
+
+    def respond_to_ACK(self, packet):
+        if self.file_reader is None:
+            return ErrorPacket(ErrorPacket.ERR_ILLEGAL_OPERATION)
+
+        for i, sent in enumerate(self.window):
+            if sent.blockn == packet.blockn:
+                # Blocks up to the acknowledged one have been received. If it
+                # is not the last block of the window, the ones after it are
+                # sent again, along with new ones.
+                congestion = self.congestion
+                if i == len(self.window) - 1:
+                    self.measure_rtt()
+                    if congestion is not None:
+                        congestion.on_ack(i + 1, self.window_size)
+                elif congestion is not None:
+                    congestion.on_loss()
+                del self.window[:i + 1]
+                self.resent = len(self.window)
+                if not self.window and self.read_all:
+                    self.complete = True
+                    return None
+                return self.fill_window()
+
+        # The ACK of the OACK starts the transfer.
+        if self.blockn == 0 and packet.blockn == 0:
+            self.measure_rtt()
+            return self.fill_window()
+
+        # Any other ACK is a duplicate. When it acknowledges the block before
+        # the window and arrives more than two round trips after the window
+        # was sent, the client has timed out waiting for the window, and we
+        # send it again at once. Answering earlier duplicates would send
+        # every following window twice (the Sorcerer's Apprentice bug of
+        # RFC 1123), so those windows are only resent on our timeout.
+        if (self.window and self.srtt is not None and
+                packet.blockn == (self.window[0].blockn - 1) % 65536 and
+                self.received_at - self.window_sent_at > 2 * self.srtt):
+            self.total_retransmissions += 1
+            self.resent = len(self.window)
+            if self.congestion is not None:
+                self.congestion.on_loss()
+            return list(self.window)
+        return []
+
+    def respond_to_Error(self, packet):
+        # As a server we should not receive any error packets from a client.
+        return ErrorPacket(ErrorPacket.ERR_UNKNOWN_TID)
@@ -0,0 +1,262 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Files that are produced by Python functions when they are requested,
+instead of being read from the tftp root.
+
+A provider function takes any of the keyword arguments:
+    filename  -- the requested name, without a leading slash
+    match     -- the re.Match of the pattern of the provider
+    client_ip -- the IP address of the client
+
+and returns the content of the file as bytes or str, or None if the file
+should be looked up in the tftp root as usual. For example, to answer the
+pxelinux requests of every machine:
+
+    def pxelinux_config(match):
+        mac = match.group(1)
+        return 'DEFAULT linux\\nAPPEND hostname={}\\n'.format(mac)
+
+The content is memoized, keyed by the arguments the function takes, so a
+function that does not take client_ip renders each file once for all the
+clients.
+"""
+
+import io
+import re
+import time
+import inspect
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from .errors import TftpTransferError
+
+
+class Provider:
+    """
+    Produces the files whose names match a regular expression.
+    """
+    arguments = ('filename', 'match', 'client_ip')
+
+    def __init__(self, pattern, function):
+        """
+        Keyword arguments:
+        pattern  -- regular expression searched for in requested names
+        function -- function that returns the content of a file
+        """
+        self.pattern = re.compile(pattern)
+        self.function = function
+
+        # Pass the function only the arguments it takes.
+        parameters = inspect.signature(function).parameters
+        if any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+            self.takes = self.arguments
+        else:
+            self.takes = tuple(a for a in self.arguments if a in parameters)
+        self.per_client = 'client_ip' in self.takes
+
+    def render(self, filename, match, client_ip):
+        values = {'filename': filename, 'match': match,
+                  'client_ip': client_ip}
+        data = self.function(**{name: values[name] for name in self.takes})
+        if isinstance(data, str):
+            data = data.encode()
+        return data
+
+
+def load_function(name):
+    """
+    Returns the function at the dotted path name, e.g. mymodule.render.
+
+    Raises a ValueError if there is no such function.
+    """
+    module_name, _, function_name = name.rpartition('.')
+    try:
+        function = getattr(importlib.import_module(module_name),
+                           function_name)
+    except (ValueError, ImportError, AttributeError):
+        raise ValueError('Unknown provider function: {}'.format(name))
+    if not callable(function):
+        raise ValueError('Provider {} is not callable'.format(name))
+    return function
+
+
+class ProviderCache:
+    """
+    Answers read requests with the files of a list of providers, and
+    memoizes their content.
+
+    The first provider whose pattern matches a requested name produces the
+    file. Concurrent requests for a file that is being rendered share that
+    rendering, and the content is kept for ttl seconds, so that a boot
+    storm renders each file once. The least recently used files are
+    evicted when the cache grows beyond max_size bytes.
+    """
+    def __init__(self, providers, max_size=64 * 1024 ** 2, ttl=60,
+                 clock=time.monotonic, memory=None):
+        """
+        Keyword arguments:
+        providers -- list of Provider instances, in order of precedence
+        max_size  -- maximum number of bytes in the cache
+        ttl       -- seconds after which a file is rendered again
+        memory    -- a MemoryAccountant to register the cache with, or None
+        """
+        self.providers = providers
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+
+        # key -> (rendered_at, data), the least recently used first
+        self._files = OrderedDict()
+        # key -> Future of a rendering in progress
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.size = 0
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        self.errors = 0
+
+        self.memory = memory
+        if memory is not None:
+            memory.add_cache('providers', self.memory_usage, self.evict_bytes)
+
+    def open(self, filename, client_ip):
+        """
+        Returns a (file object, size) tuple with the content of filename,
+        or None if no provider produces it.
+
+        Raises a TftpTransferError if the provider fails.
+        """
+        for number, provider in enumerate(self.providers):
+            match = provider.pattern.search(filename)
+            if match is not None:
+                break
+        else:
+            return None
+
+        key = (number, filename, client_ip if provider.per_client else None)
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is not None and self.clock() - entry[0] < self.ttl:
+                self.hits += 1
+                self._files.move_to_end(key)
+                future = None
+                data = entry[1]
+            else:
+                if entry is not None:
+                    self.evict(key)
+                future = self._pending.get(key)
+                rendering = future is None
+                if rendering:
+                    self.misses += 1
+                    future = self._pending[key] = Future()
+                else:
+                    self.shared += 1
+
+        if future is not None:
+            if rendering:
+                self.render(key, provider, filename, match, client_ip, future)
+            # Raises the error of a failed rendering.
+            data = future.result()
+
+        if data is None:
+            return None
+        return io.BytesIO(data), len(data)
+
+    def render(self, key, provider, filename, match, client_ip, future):
+        """
+        Renders a file into the cache and sets the result of future.
+        """
+        try:
+            data = provider.render(filename, match, client_ip)
+            if not isinstance(data, (bytes, type(None))):
+                raise TypeError('expected bytes, str or None, got {}'.format(
+                        type(data).__name__))
+            length = len(data or b'')
+        except Exception as e:
+            # Failures are not memoized, the next request tries again.
+            logging.exception("Provider failed to render '%s'", filename)
+            with self._lock:
+                self.errors += 1
+                del self._pending[key]
+            future.set_exception(TftpTransferError(
+                    'Failed to render {}: {}'.format(filename, e)))
+            return
+
+        with self._lock:
+            del self._pending[key]
+            if length <= self.max_size:
+                self._files[key] = (self.clock(), data)
+                self.size += length
+                self.shrink()
+        future.set_result(data)
+        if self.memory is not None:
+            self.memory.enforce()
+
+    def evict(self, key):
+        """
+        Removes the file of key from the cache. Must be called with the lock
+        held.
+        """
+        _, data = self._files.pop(key)
+        self.size -= len(data or b'')
+        self.evictions += 1
+
+    def shrink(self):
+        """
+        Evicts the least recently used files until the cache fits in
+        max_size. Must be called with the lock held.
+        """
+        while self.size > self.max_size:
+            self.evict(next(iter(self._files)))
+
+    def memory_usage(self):
+        return self.size
+
+    def evict_bytes(self, nbytes):
+        """
+        Evicts the least recently used files until at least nbytes have
+        been evicted.
+
+        Returns the number of evicted bytes.
+        """
+        with self._lock:
+            size = self.size
+            while self._files and size - self.size < nbytes:
+                self.evict(next(iter(self._files)))
+            return size - self.size
+
+    def stats(self):
+        """
+        Returns a dictionary with the counters of the cache.
+        """
+        with self._lock:
+            return {
+                'files': len(self._files),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'evictions': self.evictions,
+                'errors': self.errors,
+            }
@@ -0,0 +1,448 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .client import TftpClient
+from .errors import TftpTransferError
+
+
+class CachedFile:
+    """
+    A file of the upstream server in the relay cache. A single fetch writes
+    the file, while any number of readers read the data that have arrived
+    so far.
+
+    The data are kept in memory, or in a file of the cache directory that
+    is named path + '.part' until the fetch completes.
+    """
+    def __init__(self, key, name, path=None):
+        """
+        Keyword arguments:
+        key  -- the key of the file in the cache
+        name -- the name of the file on the upstream server
+        path -- the file to store the data in, None to keep them in memory
+        """
+        self.key = key
+        self.name = name
+        self.path = path
+
+        self.condition = threading.Condition()
+        # The size announced by the upstream server (tsize), None if it is
+        # not known until the fetch completes.
+        self.size = None
+        # The number of bytes that have arrived.
+        self.length = 0
+        self.started = False
+        self.complete = False
+        self.error = None
+        self.fetched_at = None
+
+        # The number of open readers. An evicted file is discarded once the
+        # last of them is closed.
+        self.readers = 0
+        self.evicted = False
+        # Whether the data have been freed, and the number of reads of the
+        # file that are in progress, as the file is only closed once they
+        # are over.
+        self.discarded = False
+        self._reads = 0
+
+        self._buffer = None
+        self._file = None
+        if path is None:
+            self._buffer = bytearray()
+        else:
+            self._file = open(path + '.part', 'w+b', buffering=0)
+
+    @classmethod
+    def stored(cls, key, path, fetched_at):
+        """
+        Returns a complete CachedFile for a file that an earlier run of the
+        server left in the cache directory.
+        """
+        cached_file = cls(key, None)
+        cached_file._buffer = None
+        cached_file.path = path
+        cached_file._file = open(path, 'rb', buffering=0)
+        cached_file.size = cached_file.length = os.path.getsize(path)
+        cached_file.started = cached_file.complete = True
+        cached_file.fetched_at = fetched_at
+        return cached_file
+
+    def start(self, size):
+        """
+        Called when the upstream server starts sending the file, with its
+        size if the server told it.
+        """
+        with self.condition:
+            self.size = size
+            self.started = True
+            self.condition.notify_all()
+
+    def write(self, data):
+        """
+        Appends data of the fetch. CachedFile is the file object that the
+        TftpFileWriter of the fetch writes to.
+        """
+        if self._file is not None:
+            self._file.write(data)
+        with self.condition:
+            if self._buffer is not None:
+                self._buffer += data
+            self.length += len(data)
+            self.started = True
+            self.condition.notify_all()
+
+    def finish(self, now):
+        with self.condition:
+            if self._file is not None:
+                os.rename(self.path + '.part', self.path)
+            self.size = self.length
+            self.complete = True
+            self.fetched_at = now
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+        self.discard()
+
+    def wait_started(self):
+        """
+        Waits until the upstream server starts sending the file, or the
+        fetch fails.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                    lambda: self.started or self.error is not None)
+
+    def read(self, offset, size):
+        """
+        Returns up to size bytes from offset, waiting until they arrive or
+        the fetch completes.
+
+        Raises the TftpTransferError of the fetch if it fails.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                    lambda: self.length >= offset + size or self.complete or
+                            self.error is not None)
+            if self.error is not None:
+                raise self.error
+            if self.discarded:
+                raise TftpTransferError('the cached file was discarded')
+            end = min(offset + size, self.length)
+            if self._buffer is not None:
+                return bytes(self._buffer[offset:end])
+            self._reads += 1
+        try:
+            return os.pread(self._file.fileno(), end - offset, offset)
+        finally:
+            with self.condition:
+                self._reads -= 1
+                if self.discarded and not self._reads:
+                    self._file.close()
+
+    def discard(self):
+        """
+        Frees the data of the file. A file on disk is closed once the reads
+        in progress are over.
+        """
+        with self.condition:
+            self.discarded = True
+            self._buffer = None
+            if self._file is None:
+                return
+            if not self._reads:
+                self._file.close()
+        path = self.path if self.complete else self.path + '.part'
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class CachedFileReader:
+    """
+    A binary file object that reads a CachedFile from the start.
+    """
+    def __init__(self, cache, cached_file):
+        self.cache = cache
+        self.cached_file = cached_file
+        self.offset = 0
+        self.closed = False
+
+    def read(self, size):
+        data = self.cached_file.read(self.offset, size)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.cache.release(self.cached_file)
+
+
+class RelayCache:
+    """
+    A cache of the files of an upstream TFTP server, for a server that
+    relays read requests to it.
+
+    A file that is not in the cache is fetched from the upstream server
+    on a separate thread, and readers get its data as they arrive. Requests
+    for a file that is being fetched share that fetch. Files are fetched
+    again once they are older than ttl seconds, and the least recently used
+    ones are evicted when the cache grows beyond max_size bytes.
+    """
+    def __init__(self, upstream, cache_dir=None, max_size=1024 ** 3,
+                 ttl=3600, block_size=None, window_size=None, timeout=1,
+                 retries=5, clock=time.monotonic, memory=None):
+        """
+        Keyword arguments:
+        upstream    -- (host, port) of the upstream server
+        cache_dir   -- directory to keep the files in, None to keep them in
+                       memory
+        max_size    -- maximum number of bytes in the cache
+        ttl         -- seconds after which a cached file is fetched again
+        block_size  -- block size to ask the upstream server for, or None
+        window_size -- window size to ask the upstream server for, or None
+        timeout     -- seconds to wait for the upstream server before
+                       resending
+        retries     -- how many times to resend before giving up
+        memory      -- a MemoryAccountant to register the cache with, or
+                       None
+        """
+        self.upstream = upstream
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ttl = ttl
+        self.client = TftpClient(upstream[0], upstream[1], block_size,
+                                 window_size, tsize=True, timeout=timeout,
+                                 retries=retries)
+        self.clock = clock
+
+        # key -> CachedFile, the least recently used first
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        self.errors = 0
+        self.fetched_bytes = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.load()
+
+        # Files kept in memory are the first to go when the server runs out
+        # of its memory budget.
+        self.memory = memory
+        if memory is not None:
+            memory.add_cache('relay_cache', self.memory_usage,
+                             self.evict_bytes)
+
+    @staticmethod
+    def key(name):
+        return hashlib.sha1(name.encode()).hexdigest()
+
+    def load(self):
+        """
+        Adds the complete files left in the cache directory by an earlier
+        run, and removes the incomplete ones.
+        """
+        now, wall_now = self.clock(), time.time()
+        stored = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.part'):
+                os.unlink(entry.path)
+                continue
+            age = max(0, wall_now - entry.stat().st_mtime)
+            key = entry.name.split('.', 1)[0]
+            stored.append((now - age, key, entry.path))
+
+        # The most recently fetched files are the most recently used ones.
+        for fetched_at, key, path in sorted(stored):
+            if key in self._files:
+                self._files.pop(key).discard()
+            self._files[key] = CachedFile.stored(key, path, fetched_at)
+        with self._lock:
+            self.shrink()
+
+    def open(self, name):
+        """
+        Opens the file name of the upstream server, fetching it if it is
+        not cached.
+
+        Returns a (file object, size) tuple, size being None if it is not
+        known yet. The file object must be closed after use.
+        Raises a TftpTransferError if the upstream server fails to send the
+        file.
+        """
+        key = self.key(name)
+        with self._lock:
+            cached_file = self._files.get(key)
+            if cached_file is not None and cached_file.complete and \
+                    self.clock() - cached_file.fetched_at >= self.ttl:
+                self.evict(cached_file)
+                cached_file = None
+
+            if cached_file is None:
+                self.misses += 1
+                cached_file = self.fetch(key, name)
+            elif cached_file.complete:
+                self.hits += 1
+            else:
+                self.shared += 1
+            self._files.move_to_end(key)
+            cached_file.readers += 1
+
+        cached_file.wait_started()
+        if cached_file.error is not None:
+            self.release(cached_file)
+            raise cached_file.error
+        return CachedFileReader(self, cached_file), cached_file.size
+
+    def release(self, cached_file):
+        """
+        Records that a reader of cached_file has been closed.
+        """
+        with self._lock:
+            cached_file.readers -= 1
+            if cached_file.evicted and not cached_file.readers:
+                cached_file.discard()
+            self.shrink()
+
+    def fetch(self, key, name):
+        """
+        Adds a CachedFile for name and starts fetching it. Must be called
+        with the lock held.
+        """
+        path = None
+        if self.cache_dir is not None:
+            # A unique name, as an older version of the file may still be
+            # read while the new one is fetched.
+            path = os.path.join(self.cache_dir,
+                                '{}.{}'.format(key, os.urandom(4).hex()))
+        cached_file = self._files[key] = CachedFile(key, name, path)
+        threading.Thread(target=self.run_fetch, args=(cached_file,),
+                         daemon=True).start()
+        return cached_file
+
+    def run_fetch(self, cached_file):
+        try:
+            self.download(cached_file)
+        except Exception as e:
+            # Whatever goes wrong, the readers must not wait forever.
+            if not isinstance(e, TftpTransferError):
+                e = TftpTransferError(str(e))
+            logging.warning("Relay: failed to fetch '%s' from upstream: %s",
+                            cached_file.name, e)
+            with self._lock:
+                self.errors += 1
+                if self._files.get(cached_file.key) is cached_file:
+                    del self._files[cached_file.key]
+            cached_file.fail(e)
+            return
+
+        cached_file.finish(self.clock())
+        with self._lock:
+            self.fetched_bytes += cached_file.length
+            self.shrink()
+        if self.memory is not None:
+            self.memory.enforce()
+
+    def download(self, cached_file):
+        """
+        Downloads a file from the upstream server into cached_file.
+        """
+        asyncio.run(self.client.get(cached_file.name, cached_file,
+                                    on_start=cached_file.start))
+
+    def evict(self, cached_file):
+        """
+        Removes cached_file from the cache. Must be called with the lock
+        held.
+        """
+        del self._files[cached_file.key]
+        cached_file.evicted = True
+        self.evictions += 1
+        if not cached_file.readers:
+            cached_file.discard()
+
+    def shrink(self):
+        """
+        Evicts the least recently used complete files that nobody reads,
+        until the cache fits in max_size. Must be called with the lock held.
+        """
+        size = sum(f.length for f in self._files.values())
+        for cached_file in list(self._files.values()):
+            if size <= self.max_size:
+                break
+            if cached_file.complete and not cached_file.readers:
+                size -= cached_file.length
+                self.evict(cached_file)
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes of the files kept in memory.
+        """
+        with self._lock:
+            return sum(f.length for f in self._files.values()
+                       if f.path is None)
+
+    def evict_bytes(self, nbytes):
+        """
+        Evicts the least recently used complete files kept in memory that
+        nobody reads, until at least nbytes have been evicted.
+
+        Returns the number of evicted bytes.
+        """
+        evicted = 0
+        with self._lock:
+            for cached_file in list(self._files.values()):
+                if evicted >= nbytes:
+                    break
+                if cached_file.path is None and cached_file.complete and \
+                        not cached_file.readers:
+                    evicted += cached_file.length
+                    self.evict(cached_file)
+        return evicted
+
+    def stats(self):
+        """
+        Returns a dictionary with the counters of the cache.
+        """
+        with self._lock:
+            return {
+                'files': len(self._files),
+                'bytes': sum(f.length for f in self._files.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'evictions': self.evictions,
+                'errors': self.errors,
+                'fetched_bytes': self.fetched_bytes,
+            }
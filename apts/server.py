@@ -17,68 +17,550 @@ import os
 import pwd
 import grp
 import sys
-import socket
+import json
+import time
+import select
+import signal
 import logging
+import argparse
+import threading
+import subprocess
 
-from . import config
-from .session import TftpSessionThread
-from .errors import TftpRootError
+from . import __version__
+from .config import (ServerConfig, CONFIG_FILE, EXIT_NORMAL, EXIT_CONF_ERROR,
+                     EXIT_ROOTDIR_ERROR, EXIT_PRIVILEGES)
+from .log import setup_logging
+from .limits import SessionLimiter
+from .control import ControlServer, inherited_control_socket
+from .listener import (RequestListener, RequestDispatcher, inherited_socket,
+                       notify_ready, client_ip)
+from .metrics import ServerMetrics, PrometheusFileWriter
+from .profiling import PhaseTimers, SamplingProfiler
+from .session import TftpSessionThread, buffer_size
+from .protocol import TftpProtocol
+from .sockpool import TransferSocketPool
+from .shaping import BandwidthScheduler, FileClass
+from .congestion import load_controller
+from .memory import MemoryAccountant
+from .index import FileIndex, IndexRescanner
+from .textindex import NetasciiIndex
+from .pmtu import PathMtuCache
+from .errors import TftpRootError, TftpPrivilegesError, ParseConfigError
 
 
 class TftpServer:
-    def __init__(self, tftp_root=config.tftp_root, writable=config.writable):
+    """
+    A TFTP server, configured by a ServerConfig.
+
+    listen() serves requests on the calling thread until the server is
+    stopped, while start() serves them on a separate thread, e.g. for a
+    server embedded in another program or a test. Either way, stop() waits
+    for the running sessions to finish.
+
+    reload() hands the listening socket over to a new server process and
+    stops serving requests, so that a server is restarted without
+    refusing a request or interrupting a transfer.
+    """
+    def __init__(self, tftp_root=None, writable=None, config=None):
         """
         Keyword arguments:
-        tftp_root -- path to the tftp root directory
+        tftp_root -- path to the tftp root directory, by default the one of
+                     the configuration
         writable  -- if True, the server is writable
-                     else, a client can only read existing files
+                     else, a client can only read existing files.
+                     By default, as in the configuration
+        config    -- the ServerConfig, None for the default options
+
+        Raises a TftpRootError if the tftp root is not a directory.
         """
+        if config is None:
+            config = ServerConfig()
+        self.config = config
+        if tftp_root is None:
+            tftp_root = config.tftp_root
+        if writable is None:
+            writable = config.writable
         self.tftp_root = os.path.realpath(tftp_root)
         self.writable = writable
 
-        if not self.check_tftp_root():
-            logging.info("Terminating the server")
-            sys.exit(config.EXIT_ROOTDIR_ERROR)
-
+        self.check_tftp_root()
         logging.info("TFTP root directory set to: {}".format(self.tftp_root))
 
-    def listen(self, ip=config.host, port=config.port):
+        # Shape the outgoing traffic only if any limits are configured.
+        self.scheduler = None
+        if any([config.rate, config.client_rate, config.subnet_rates,
+                config.file_classes]):
+            self.scheduler = BandwidthScheduler(
+                    config.rate, config.client_rate, config.subnet_rates,
+                    [FileClass(name, patterns, rate)
+                     for name, rate, patterns in config.file_classes],
+                    config.small_file_size, config.priority_paths, config.aging)
+
+        # Limit the new sessions of each client IP only if configured.
+        self.limiter = None
+        if config.session_rate or config.max_sessions_per_ip:
+            self.limiter = SessionLimiter(config.session_rate,
+                                          config.session_burst,
+                                          config.max_sessions_per_ip)
+
+        # Every buffer of the server is accounted for, within the budget if
+        # one is configured.
+        self.memory = MemoryAccountant(config.memory_budget)
+
+        # In relay mode, RRQs are answered from a cache of the files of an
+        # upstream server.
+        self.relay = None
+        if config.relay_upstream:
+            # Imported here, as the client of the relay takes asyncio, which
+            # would double the startup time of every other server.
+            from .relay import RelayCache
+            self.relay = RelayCache(
+                    config.relay_upstream, config.relay_cache_dir,
+                    config.relay_cache_size, config.relay_cache_ttl,
+                    config.relay_block_size, config.relay_window_size,
+                    memory=self.memory)
+            logging.info('Relaying read requests to {}:{}'.format(
+                    *config.relay_upstream))
+
+        # Otherwise, RRQs may be looked up in an index of the tftp root, that
+        # is built before the server serves any request.
+        self.index = None
+        self.index_rescanner = None
+        if config.file_index and self.relay is None:
+            self.index = FileIndex(self.tftp_root, config.index_case_fold,
+                                   config.index_backslashes,
+                                   config.index_aliases, memory=self.memory)
+            logging.info('Indexed {} files in {:.3f} seconds'.format(
+                    len(self.index.files), self.index.scan_seconds))
+
+        # The encoded sizes of the files sent in netascii, for their tsize.
+        self.netascii_index = NetasciiIndex()
+
+        # The block size granted to each client is capped by its path MTU.
+        self.path_mtu = None
+        if config.path_mtu:
+            self.path_mtu = PathMtuCache()
+
+        # Files of RRQs may be produced by Python functions.
+        self.providers = None
+        if config.providers:
+            from .providers import Provider, ProviderCache, load_function
+            self.providers = ProviderCache(
+                    [Provider(pattern, load_function(function))
+                     for pattern, function in config.providers],
+                    config.provider_cache_size, config.provider_ttl,
+                    memory=self.memory)
+
+        # Every read request gets a congestion controller of its own.
+        self.congestion = None
+        if config.congestion != 'none':
+            self.congestion = load_controller(config.congestion)
+
+        self.metrics = ServerMetrics()
+        self.metrics_writer = None
+        self.control_server = None
+
+        # The running sessions.
+        self.sessions = set()
+
+        # Sessions only time their phases if asked to, and the profiler
+        # costs them nothing until a profile is taken.
+        self.phase_timers = None
+        if config.phase_timers:
+            self.phase_timers = PhaseTimers(self.metrics)
+        self.profiler = SamplingProfiler(lambda: list(self.sessions),
+                                         config.profile_dir)
+
+        self.listener = None
+        self.socket_pool = None
+        self.dispatcher = RequestDispatcher(self.start_session)
+        self.thread = None
+        self._reload_lock = threading.Lock()
+
+    @property
+    def address(self):
+        """
+        The (ip, port) address the server listens on.
+        """
+        return self.listener.socket.getsockname()
+
+    def listen(self, ip=None, port=None, drop_privileges=True, sock=None):
+        """
+        Start a server listening on the supplied interface and port, by
+        default the configured ones, or on the bound socket sock, and serve
+        requests until the server is stopped or reloaded.
+
+        If drop_privileges is False, the server keeps running as the current
+        user, e.g. for tests and benchmarks on unprivileged ports.
+        Raises a TftpPrivilegesError if the privileges cannot be dropped.
         """
-        Start a server listening on the supplied interface and port.
+        self.bind(ip, port, drop_privileges, sock)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR2, self.on_profile_signal)
+            signal.signal(signal.SIGHUP, self.on_reload_signal)
+            signal.signal(signal.SIGTERM, self.on_stop_signal)
+        self.serve()
+
+    def start(self, ip=None, port=None, sock=None):
+        """
+        Starts serving requests on a separate thread, as the current user.
+        A port of 0 picks a free port, see the address attribute.
+
+        Returns once the server is listening.
         """
-        # AF_INET for IPv4 family address, SOCK_DGRAM for UDP socket
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        server_socket.bind((ip, port))
-        logging.info('Start listening on port {}'.format(port))
+        self.bind(ip, port, drop_privileges=False, sock=sock)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops a server started with start() or listen(), and waits up to
+        timeout seconds, or for as long as it takes if timeout is None, for
+        the running sessions to finish.
+
+        Returns the number of sessions that were still running.
+        """
+        if self.listener is None:
+            return 0
+        self.listener.interrupt()
+        if self.thread is not None:
+            self.thread.join()
+        # Requests that are still queued start their sessions before the
+        # running sessions are waited for.
+        self.dispatcher.stop()
+        if self.dispatcher.is_alive():
+            self.dispatcher.join()
+        if self.control_server is not None:
+            self.control_server.stop()
+        if self.metrics_writer is not None:
+            self.metrics_writer.stop()
+        if self.index_rescanner is not None:
+            self.index_rescanner.stop()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for session in list(self.sessions):
+            if deadline is None:
+                session.join()
+            else:
+                session.join(max(0, deadline - time.monotonic()))
+        self.listener.close()
+        self.memory.release('socket_buffers', self.socket_buffers)
+        self.socket_pool.close()
+        return len(self.sessions)
+
+    def reload(self, command=None, timeout=10):
+        """
+        Starts a new server process, hands the listening socket over to it,
+        and stops serving requests once the new process serves them. The
+        running sessions go on until stop() is called.
+
+        Keyword arguments:
+        command -- the command line of the new process, by default the one
+                   this process was started with
+        timeout -- seconds to wait for the new process to start
+
+        Returns a message with the process ID of the new server.
+        Raises a RuntimeError if the new process does not start.
+        """
+        if command is None:
+            command = sys.orig_argv
+        with self._reload_lock:
+            if self.listener.interrupted:
+                raise RuntimeError('the server is stopping')
+
+            # The new process tells that it is ready through a pipe, and
+            # until then, both processes may read requests.
+            fd = self.listener.socket.fileno()
+            ready_r, ready_w = os.pipe()
+            env = dict(os.environ, APTS_LISTEN_FD=str(fd),
+                       APTS_READY_FD=str(ready_w))
+            pass_fds = [fd, ready_w]
+            # The control socket is handed over as well, as the new process
+            # could not bind it again once it has dropped its privileges.
+            if self.control_server is not None:
+                control_fd = self.control_server.fileno()
+                env['APTS_CONTROL_FD'] = str(control_fd)
+                pass_fds.append(control_fd)
+            try:
+                process = subprocess.Popen(command, pass_fds=pass_fds,
+                                           env=env)
+            finally:
+                os.close(ready_w)
+            try:
+                ready = select.select([ready_r], [], [], timeout)[0] and \
+                        os.read(ready_r, 1)
+            finally:
+                os.close(ready_r)
+            if not ready:
+                process.kill()
+                process.wait()
+                raise RuntimeError('the new server process did not start')
+
+            self.listener.interrupt()
+            if self.control_server is not None:
+                self.control_server.hand_over()
+                self.control_server = None
+        logging.info('Server process {} took over, draining {} '
+                     'sessions'.format(process.pid, len(self.sessions)))
+        return 'server process {} took over\n'.format(process.pid)
+
+    def on_reload_signal(self, signum, frame):
+        try:
+            self.reload()
+        except (RuntimeError, OSError) as e:
+            logging.error('Could not reload: {}'.format(e))
+
+    def on_stop_signal(self, signum, frame):
+        # A second signal aborts waiting for the sessions, as an interrupt
+        # does.
+        if self.listener.interrupted:
+            raise KeyboardInterrupt()
+        self.listener.interrupt()
+
+    def bind(self, ip, port, drop_privileges, sock=None):
+        """
+        Sets up the listening socket, or uses the bound socket sock, and
+        everything the sessions need.
+        """
+        config = self.config
+        if ip is None:
+            ip = config.host
+        if port is None:
+            port = config.port
+
+        self.listener = RequestListener(ip, port, config.receive_buffer,
+                                        config.bufsize, sock,
+                                        config.ipv6_only)
+        if sock is None:
+            logging.info('Start listening on port {}'.format(self.address[1]))
+        else:
+            ip = self.address[0]
+            logging.info('Took over the listening socket on port {}'.format(
+                    self.address[1]))
+        self.interface = ip
+        # Released by stop(), as the accountant may outlive the server.
+        self.socket_buffers = self.listener.buffer_size()
+        self.memory.charge('socket_buffers', self.socket_buffers)
+
+        self.socket_pool = TransferSocketPool(
+                ip, config.transfer_ports, config.min_idle_sockets,
+                config.max_idle_sockets, family=self.listener.socket.family,
+                quarantine=max(TftpProtocol.timeout_values))
+        self.setup_metrics()
+        if self.index is not None and config.index_rescan_interval:
+            self.index_rescanner = IndexRescanner(
+                    self.index, config.index_rescan_interval)
+            self.index_rescanner.start()
+        if config.control_socket:
+            self.start_control_server(config.control_socket)
 
         # Drop no longer needed root privileges for security reasons.
-        if not self.drop_root_privileges():
-            logging.info('Aborting')
-            sys.exit(config.EXIT_PRIVILEGES)
+        if drop_privileges and not self.drop_root_privileges():
+            raise TftpPrivilegesError('Could not drop root privileges')
+        notify_ready()
 
+    def serve(self):
+        """
+        Serves requests until the server is stopped.
+        """
+        # The listener only reads requests and hands them over, and the
+        # sessions are set up on the dispatcher thread.
+        self.dispatcher.start()
         while True:
-            data, client_address = server_socket.recvfrom(config.bufsize)
+            batch = self.listener.receive()
+            if not batch:
+                break
+            for data, client_address in batch:
+                # Drop flooding clients before spending anything on them.
+                if self.limiter is not None and \
+                        not self.limiter.admit(client_ip(client_address)):
+                    continue
+                self.dispatcher.dispatch(data, client_address)
+
+    def start_session(self, data, client_address):
+        """
+        Starts a session for a request received on the listening socket.
+        """
+        # Out of memory even without the caches, drop the request until
+        # running transfers end, and the client will send it again.
+        reserved = buffer_size(self.config.bufsize)
+        if not self.memory.reserve('sessions', reserved):
+            logging.debug('Out of memory budget, dropped request from %s',
+                          client_ip(client_address))
+            if self.limiter is not None:
+                self.limiter.release(client_ip(client_address))
+            return
 
-            session_thread = TftpSessionThread(ip, client_address,
-                    self.tftp_root, self.writable, data)
-            session_thread.start()
+        congestion = None
+        if self.congestion is not None:
+            congestion = self.congestion()
+        try:
+            session_thread = TftpSessionThread(self.interface, client_address,
+                    self.tftp_root, self.writable, data, self.scheduler,
+                    self.limiter, self.socket_pool, self.metrics,
+                    self.sessions, self.relay, self.phase_timers,
+                    self.config.bufsize, congestion, self.memory, reserved,
+                    self.index, self.providers, self.netascii_index,
+                    self.path_mtu)
+        except OSError as e:
+            logging.error('Could not create transfer socket: {}'.format(e))
+            if self.limiter is not None:
+                self.limiter.release(client_ip(client_address))
+            self.memory.release('sessions', reserved)
+            return
 
-    def check_tftp_root(self):
+        # Registered before it runs, so that stop() waits for it too.
+        self.sessions.add(session_thread)
+        session_thread.start()
+
+    def setup_metrics(self):
         """
-        Performs sanity checks on the tftp root path.
+        Exports the statistics of the server components as metrics, and
+        starts writing the metrics file if one is configured.
+        """
+        config = self.config
+        metrics = self.metrics
+        metrics.add_stats('apts_listener', 'Listening socket counters.',
+                          lambda: dict(self.listener.stats(),
+                                       **self.dispatcher.stats()),
+                          ('received', 'batches', 'kernel_drops', 'queued'))
+        metrics.add_stats('apts_socket_pool', 'Transfer socket pool counters.',
+                          self.socket_pool.stats,
+                          ('idle', 'created', 'reused', 'closed'))
+
+        metrics.add_stats('apts_memory', 'Memory budget counters.',
+                          self.memory.stats,
+                          ('used', 'budget', 'evicted', 'refused'))
+        gauge = metrics.gauge('apts_memory_bytes',
+                              'Memory used by each category of buffers.',
+                              ('category',))
+        for category in ('sessions', 'relay_cache', 'socket_buffers',
+                         'file_index', 'providers'):
+            gauge.labels(category).set_function(
+                lambda category=category:
+                    self.memory.usage().get(category, 0))
+
+        if self.limiter is not None:
+            metrics.add_stats('apts_limiter', 'Session limiter counters.',
+                              self.limiter.stats,
+                              ('admitted', 'dropped_rate', 'dropped_sessions'))
+
+        if self.relay is not None:
+            metrics.add_stats('apts_relay', 'Relay cache counters.',
+                              self.relay.stats,
+                              ('files', 'bytes', 'hits', 'misses', 'shared',
+                               'evictions', 'errors', 'fetched_bytes'))
+
+        if self.providers is not None:
+            metrics.add_stats('apts_providers', 'Provider cache counters.',
+                              self.providers.stats,
+                              ('files', 'bytes', 'hits', 'misses', 'shared',
+                               'evictions', 'errors'))
+
+        if self.index is not None:
+            metrics.add_stats('apts_index', 'File index counters.',
+                              self.index.stats,
+                              ('files', 'bytes', 'hits', 'misses', 'scans',
+                               'scan_seconds'))
 
-        Returns True if the path passes the tests, else False.
+        metrics.add_stats('apts_netascii_index',
+                          'Netascii size index counters.',
+                          self.netascii_index.stats,
+                          ('files', 'hits', 'misses'))
+
+        if self.path_mtu is not None:
+            metrics.add_stats('apts_path_mtu', 'Path MTU cache counters.',
+                              self.path_mtu.stats,
+                              ('hosts', 'hits', 'misses'))
+
+        if self.scheduler is not None:
+            scheduler = self.scheduler
+            for key in ('bytes', 'deferred', 'throughput'):
+                gauge = metrics.gauge('apts_class_' + key,
+                                      'Shaping statistics per file class.',
+                                      ('class',))
+                for file_class in scheduler.file_classes + \
+                        [scheduler.default_class]:
+                    gauge.labels(file_class.name).set_function(
+                        lambda name=file_class.name, key=key:
+                            scheduler.stats()[name][key])
+
+        if config.metrics_file:
+            self.metrics_writer = PrometheusFileWriter(
+                    metrics, config.metrics_file, config.metrics_interval)
+            self.metrics_writer.start()
+
+    def start_control_server(self, path):
+        """
+        Starts serving the control socket at path.
         """
         try:
-            if not os.path.exists(self.tftp_root):
-                raise TftpRootError("The TFTP root does not exist")
-            if not os.path.isdir(self.tftp_root):
-                raise TftpRootError("The TFTP root must be a directory")
-        except TftpRootError as e:
-            logging.error("{}: {}".format(e, self.tftp_root))
-            return False
+            self.control_server = ControlServer(
+                    path, inherited_control_socket(path))
+        except OSError as e:
+            logging.error('Could not create control socket: {}'.format(e))
+            return
 
-        return True
+        self.control_server.register('metrics', self.metrics.render)
+        self.control_server.register('sessions', self.list_sessions)
+        self.control_server.register('profile', self.profile)
+        self.control_server.register('reload', self.reload)
+        self.control_server.register('memory', self.memory_usage)
+        if self.index is not None:
+            self.control_server.register('rescan', self.rescan)
+        self.control_server.start()
+        logging.info('Control socket listening on {}'.format(path))
+
+    def list_sessions(self):
+        """
+        Returns a JSON list with a snapshot of each running session.
+        """
+        sessions = list(self.sessions)
+        return json.dumps([session.snapshot() for session in sessions]) + '\n'
+
+    def memory_usage(self):
+        """
+        Returns a JSON object with the bytes of memory used by category.
+        """
+        return json.dumps(self.memory.usage()) + '\n'
+
+    def rescan(self):
+        """
+        Rescans the tftp root into the file index at once, e.g. after
+        files have been added. Returns a message with the number of files.
+        """
+        self.index.rescan()
+        return 'indexed {} files\n'.format(len(self.index.files))
+
+    def profile(self, seconds=None):
+        """
+        Starts profiling the sessions for the given seconds, by default the
+        configured ones. Returns a message with the path of the profile.
+        """
+        if seconds is None:
+            seconds = self.config.profile_seconds
+        path = self.profiler.start(seconds)
+        logging.info('Profiling sessions for {} seconds'.format(seconds))
+        return 'profiling for {} seconds into {}\n'.format(seconds, path)
+
+    def on_profile_signal(self, signum, frame):
+        try:
+            self.profile()
+        except (ValueError, RuntimeError, OSError) as e:
+            logging.error('Could not start profiling: {}'.format(e))
+
+    def check_tftp_root(self):
+        """
+        Performs sanity checks on the tftp root path.
+
+        Raises a TftpRootError if the path does not pass the tests.
+        """
+        if not os.path.exists(self.tftp_root):
+            raise TftpRootError("The TFTP root does not exist: {}".format(
+                    self.tftp_root))
+        if not os.path.isdir(self.tftp_root):
+            raise TftpRootError("The TFTP root must be a directory: {}".format(
+                    self.tftp_root))
 
     @staticmethod
     def drop_root_privileges(username='nobody'):
@@ -94,6 +576,11 @@ class TftpServer:
             logging.error(e)
             return False
 
+        # e.g. a server started by a reload, which inherits the privileges
+        # of the server that it took over from
+        if os.getuid() == user.pw_uid:
+            return True
+
         try:
             os.setgroups([]) # remove group privileges
             os.setgid(user.pw_gid)
@@ -107,6 +594,78 @@ class TftpServer:
         return True
 
 
-def main():
-    server = TftpServer()
-    server.listen()
+def build_parser():
+    parser = argparse.ArgumentParser(
+            prog='apts', description='Another Python TFTP Server.')
+    parser.add_argument('-c', '--config', default=CONFIG_FILE,
+                        help='configuration file (default: %(default)s)')
+    parser.add_argument('-r', '--root', help='TFTP root directory')
+    parser.add_argument('-H', '--host', help='interface to listen on')
+    parser.add_argument('-p', '--port', type=int, help='port to listen on')
+    parser.add_argument('--read-only', action='store_true',
+                        help='reject all write requests')
+    parser.add_argument('-l', '--log-level',
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR',
+                                 'CRITICAL'),
+                        help='logging level')
+    parser.add_argument('--log-file', help='file to append the log to')
+    parser.add_argument('-s', '--control-socket',
+                        help='path of the control socket')
+    parser.add_argument('--no-drop-privileges', action='store_true',
+                        help='keep running as the current user')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s ' + __version__)
+    return parser
+
+
+def main(argv=None):
+    """
+    Runs the apts command. Options given on the command line override the
+    ones of the configuration file.
+
+    Returns the exit code.
+    """
+    args = build_parser().parse_args(argv)
+    try:
+        config = ServerConfig.from_file(args.config)
+    except ParseConfigError as e:
+        print('apts: configuration error: {}'.format(e), file=sys.stderr)
+        return EXIT_CONF_ERROR
+
+    for name, value in (('tftp_root', args.root), ('host', args.host),
+                        ('port', args.port), ('log_file', args.log_file),
+                        ('control_socket', args.control_socket)):
+        if value is not None:
+            setattr(config, name, value)
+    if args.read_only:
+        config.writable = False
+    if args.log_level:
+        config.log_level = getattr(logging, args.log_level)
+
+    setup_logging(config.log_level, config.log_file, config.trace_file)
+    try:
+        server = TftpServer(config=config)
+    except TftpRootError as e:
+        logging.error(e)
+        logging.info("Terminating the server")
+        return EXIT_ROOTDIR_ERROR
+
+    try:
+        server.listen(drop_privileges=not args.no_drop_privileges,
+                      sock=inherited_socket())
+    except TftpPrivilegesError:
+        logging.info('Aborting')
+        return EXIT_PRIVILEGES
+    except KeyboardInterrupt:
+        pass
+
+    # After a reload, SIGTERM or an interrupt, let the running transfers
+    # finish before exiting.
+    try:
+        abandoned = server.stop(timeout=config.drain_timeout)
+    except KeyboardInterrupt:
+        abandoned = len(server.sessions)
+    if abandoned:
+        logging.warning('Aborting {} unfinished sessions'.format(abandoned))
+    logging.info('Terminating the server')
+    return EXIT_NORMAL
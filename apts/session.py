@@ -13,16 +13,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
+import io
+import time
 import socket
 import logging
 import threading
 
-from . import config
-from .errors import PacketParseError
-from .file_rw import TftpFileReader, TftpFileWriter
-from .packets import (RRQPacket, WRQPacket, DataPacket, ACKPacket, ErrorPacket,
-                      PacketFactory)
+from .log import log_transfer
+from .listener import address_family, client_ip, format_address, udp_socket
+from .congestion import Pacer
+from .packets import DataPacket, ErrorPacket
+from .protocol import TftpProtocol
+
+
+def buffer_size(bufsize, block_size=512, window_size=1, netascii=False):
+    """
+    Returns an estimate of the bytes that the buffers of a session take: the
+    buffer data are received into, the buffer of the file, and for a read
+    request, the window of blocks that wait for an ACK and the backlog of
+    the netascii conversion.
+    """
+    size = io.DEFAULT_BUFFER_SIZE + max(bufsize, block_size + 4)
+    size += window_size * block_size
+    if netascii:
+        size += 2 * block_size
+    return size
 
 
 class TftpSessionThread(threading.Thread):
@@ -39,10 +54,12 @@ class TftpSessionThread(threading.Thread):
 
     When the file transfer is over, the session is destroyed.
     """
-    factory = PacketFactory()
-
     def __init__(self, interface, remote_address, tftp_root, allow_write,
-                 initial_data):
+                 initial_data, scheduler=None, limiter=None, socket_pool=None,
+                 metrics=None, registry=None, relay=None, phase_timers=None,
+                 bufsize=2048, congestion=None, memory=None, reserved=0,
+                 index=None, providers=None, netascii_index=None,
+                 path_mtu=None):
         """
         Keyword arguments:
         interface      -- the interface to bind to
@@ -52,51 +69,83 @@ class TftpSessionThread(threading.Thread):
         intial_data    -- the initial raw data received by the server at the
                           beggining of the transfer with the remote host.
                           should be a read or write request.
+        scheduler      -- a BandwidthScheduler that shapes the sent data,
+                          or None for no shaping
+        limiter        -- the SessionLimiter that admitted the session,
+                          or None
+        socket_pool    -- a TransferSocketPool to take the transfer socket
+                          from, or None to create a new socket
+        metrics        -- the ServerMetrics to update, or None
+        registry       -- a set that holds the session until it ends, once
+                          it has been added by whoever starts it, or None
+        relay          -- a RelayCache that RRQs are answered from, or None
+        phase_timers   -- a PhaseTimers that the work of the session is timed
+                          in, or None
+        bufsize        -- maximum amount of data to be received at once
+        congestion     -- a CongestionController that paces the sent data,
+                          or None to send every window at once
+        memory         -- a MemoryAccountant to charge the buffers of the
+                          session to, or None
+        reserved       -- the bytes already reserved for the session in
+                          memory, released when it ends
+        index          -- a FileIndex that RRQs are looked up in, or None
+        providers      -- a ProviderCache that produces the files of RRQs,
+                          or None
+        netascii_index -- a NetasciiIndex that the tsize of netascii RRQs is
+                          looked up in, or None
+        path_mtu       -- a PathMtuCache that the block size is capped by,
+                          or None
+
+        May raise an OSError if no transfer socket can be created.
         """
-        super().__init__()
+        # The server waits for its sessions itself when it stops, for as
+        # long as it is configured to.
+        super().__init__(daemon=True)
 
         self.remote_address = remote_address
+        # Limits, shaping and providers see IPv4 hosts by their IPv4 address
+        # on a dual-stack socket too. Packets are matched by remote_address.
+        self.client_ip = client_ip(remote_address)
         self.initial_data = initial_data
         self.tftp_root = tftp_root
         self.allow_write = allow_write
-
-        # We must create a new socket with a random TID for the transfer.
-        # Port value 0 means that the OS will pick an available port for us.
-        self.transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.transfer_socket.bind((interface, 0))
-        self.tid = self.transfer_socket.getsockname()[1]
-
-        # When we receive data, blockn indicates the block number of the next
-        # DataPacket that we expect to acknowledge. When we send data, blockn
-        # indicates the block number of the last sent DataPacket.
-        self.blockn = 0
-
-        # Save the last packet we sent, to make retransmission easy.
-        self.last_sent = None
-        self.last_received = None
-
-        # Each time we retransmit a package, we can have different timeout
-        # values. When and if the values of the following tuple is exhausted,
-        # the transfer is considered failed and the session is terminated.
-        self.timeout_values = (3, 5, 8)
-
-        # Indicates the number of retransmissions of the last sent packet.
-        self.retransmissions = 0
-
-        # A TftpFileReader instance will be initialized if, and at the time,
-        # we receive a RRQ packet.
-        self.file_reader = None
-        # As above, will be initialized with a WRQ packet.
-        self.file_writer = None
-
-        self.respond_map = {
-            RRQPacket: self.respond_to_RRQ, WRQPacket: self.respond_to_WRQ,
-            DataPacket: self.respond_to_Data, ACKPacket: self.respond_to_ACK,
-            ErrorPacket: self.respond_to_Error
-        }
-
-        logging.info('Initialized new connection from {} with TID={}'\
-                     .format(remote_address[0], self.tid))
+        self.scheduler = scheduler
+        self.limiter = limiter
+        self.metrics = metrics
+        self.registry = registry
+        self.phase_timers = phase_timers
+        self.bufsize = bufsize
+        self.congestion = congestion
+        self.memory = memory
+        self.reserved = reserved
+        self.pacer = Pacer() if congestion is not None else None
+
+        # The FileClass and the priority rank of the transfer, looked up once
+        # the first block of data is about to be sent.
+        self.file_class = None
+        self.rank = 0
+
+        # We must use a new socket with a unique TID for the transfer.
+        self.socket_pool = socket_pool
+        if socket_pool is not None:
+            self.transfer_socket, self.tid = socket_pool.acquire()
+        else:
+            # Port value 0 means that the OS will pick an available port.
+            self.transfer_socket = udp_socket(address_family(interface))
+            self.transfer_socket.bind((interface, 0))
+            self.tid = self.transfer_socket.getsockname()[1]
+
+        self.path_mtu = path_mtu
+
+        # The protocol logic of the transfer lives in a TftpProtocol that
+        # knows nothing about sockets, threads or clocks.
+        self.protocol = TftpProtocol(tftp_root, allow_write, self.tid, relay,
+                                     phase_timers, congestion, index,
+                                     providers, self.client_ip,
+                                     netascii_index)
+
+        logging.debug('Initialized new connection from %s with TID=%s',
+                      self.client_ip, self.tid)
 
     def run(self):
         """
@@ -104,156 +153,189 @@ class TftpSessionThread(threading.Thread):
         threading.Thread's run() method and it can be seen as the main of the
         session.
 
-        It waits for new data, takes care of retransmissions and handles
-        received data appropriately.
+        It feeds the protocol with received data and timeouts, and sends the
+        packets the protocol responds with.
 
         When this method is over the session is terminated.
         """
-        while True:
-            timeout = self.timeout_values[self.retransmissions]
-            self.transfer_socket.settimeout(timeout)
-
-            try:
-                data = self.read_new_data()
-            except socket.timeout:
-                self.retransmissions += 1
-                if not self.must_retransmit():
-                    break
+        if self.metrics is not None:
+            self.metrics.sessions.inc()
 
-                self.resend_last()
+        try:
+            self.serve()
+            log_transfer(self.protocol,
+                         (self.client_ip, self.remote_address[1]))
+        finally:
+            # The server waits for the sessions of its registry when it
+            # stops, so the session leaves it once the transfer is logged.
+            if self.registry is not None:
+                self.registry.discard(self)
+            if self.metrics is not None:
+                self.metrics.sessions.dec()
+                self.metrics.transfer_finished(self.protocol)
+            if self.socket_pool is not None:
+                self.socket_pool.release(self.transfer_socket, self.tid)
             else:
-                self.send_packet(self.respond_to_data(data))
-                self.retransmissions = 0
-
-                if isinstance(self.last_sent, (ErrorPacket, type(None))):
-                    break
-
-        logging.info('Connection with TID={} closed'.format(self.tid))
+                self.transfer_socket.close()
+            if self.limiter is not None:
+                self.limiter.release(self.client_ip)
+            if self.memory is not None:
+                self.memory.release('sessions', self.reserved)
 
-    def read_new_data(self):
+    def snapshot(self, now=None):
         """
-        Returns new raw data for processing.
-
-        First time called, it returns the initial data that have been passed
-        to the session. After then, it reads data from the transfer_socket.
-
-        May raise socket.timeout error.
+        Returns a dictionary that describes the current state of the
+        session. It is built from plain attribute reads, so that inspecting
+        a session costs nothing to the transfer itself.
         """
-        if self.initial_data is None:
-            return self.transfer_socket.recvfrom(config.bufsize)[0]
-
-        data = self.initial_data
-        self.initial_data = None
-        return data
+        if now is None:
+            now = time.monotonic()
+        protocol = self.protocol
+        started = protocol.started
+        elapsed = now - started if started is not None else 0
+
+        return {
+            'client': format_address((self.client_ip,
+                                      self.remote_address[1])),
+            'tid': self.tid,
+            'op': protocol.opname,
+            'file': protocol.filename,
+            'mode': protocol.mode,
+            'block': protocol.blockn,
+            'bytes': protocol.transferred,
+            'size': protocol.file_size,
+            'elapsed': elapsed,
+            'throughput': protocol.transferred / elapsed if elapsed else 0,
+            'rtt': protocol.srtt,
+            'retransmits': protocol.total_retransmissions,
+        }
 
-    def send_packet(self, packet):
-        """
-        Sends a TftpPacket to the remote host through the transfer socket.
+    def throttle(self, packet):
         """
-        self.last_sent = packet
-        if packet is None:
-            return
-
-        self.transfer_socket.sendto(packet.to_wire(), self.remote_address)
-        logging.info("[Sent TID={}] ".format(self.tid) + str(packet))
-
-    def resend_last(self):
+        Defers the session until the scheduler allows packet to be sent.
         """
-        Retransmits the last sent packet, due to a socket timeout.
+        if self.file_class is None:
+            filename = self.protocol.filename
+            self.file_class = self.scheduler.classify(filename)
+            self.rank = self.scheduler.rank(filename, self.protocol.file_size)
+        self.scheduler.throttle(self.client_ip, self.file_class,
+                                len(packet.data), self.rank)
+
+    def serve(self):
         """
-        self.send_packet(self.last_sent)
-
-    def must_retransmit(self):
+        Runs the transfer until the protocol is closed.
         """
-        Checks whether the last sent packet needs retransmission after a
-        socket timeout.
-
-        Returns True if we need to retransmit the last packet, else False.
+        protocol = self.protocol
+        metrics = self.metrics
+        timers = self.phase_timers
+        # Blocks larger than the path MTU would be fragmented. The path MTU
+        # is looked up here rather than on the thread that starts sessions.
+        if self.path_mtu is not None:
+            max_block_size = self.path_mtu.block_size(self.client_ip)
+            if max_block_size is not None:
+                protocol.max_block_size = min(max_block_size,
+                                              protocol.max_block_size)
+        self.send_packets(protocol.receive(self.initial_data, time.monotonic()))
+        if metrics is not None:
+            metrics.requests.labels(protocol.opname or 'invalid').inc()
+            metrics.bytes_received.inc(len(self.initial_data))
+        if self.memory is not None:
+            self.charge_buffers()
+
+        while not protocol.closed:
+            if timers is not None:
+                start = timers.clock()
+            try:
+                data = self.read_new_data(protocol.deadline)
+            except socket.timeout:
+                if timers is not None:
+                    timers.add('client_wait', timers.clock() - start)
+                packets = protocol.expire(time.monotonic())
+                if metrics is not None:
+                    metrics.timeouts.inc()
+            else:
+                if timers is not None:
+                    timers.add('client_wait', timers.clock() - start)
+                packets = protocol.receive(data, time.monotonic())
+                if metrics is not None:
+                    metrics.bytes_received.inc(len(data))
+                    if protocol.last_rtt is not None:
+                        metrics.block_rtt.observe(protocol.last_rtt)
+            if metrics is not None and protocol.resent:
+                metrics.retransmissions.inc(protocol.resent)
+
+            self.send_packets(packets)
+
+    def charge_buffers(self):
         """
-        if self.retransmissions >= len(self.timeout_values):
-            return False
-        # Do not retransmit ACK packets for the last block of data.
-        if isinstance(self.last_received, DataPacket):
-            return not self.last_received.is_last
-        return True
-
-    def respond_to_data(self, data):
+        Charges the buffers of the transfer, as sized by the negotiated
+        options, instead of the bytes reserved before the request was read.
         """
-        Creates an appropriate TftpPacket as a response to the received raw
-        data, based on the type of packet of the received data.
-
-        Returns a TftpPacket or None. None as a return value means that we
-        should just ignore the received data and send nothing in response.
+        protocol = self.protocol
+        reading = protocol.opname == 'RRQ'
+        size = buffer_size(self.bufsize, protocol.block_size,
+                           protocol.window_size if reading else 0,
+                           reading and protocol.mode == 'netascii')
+        self.memory.charge('sessions', size - self.reserved)
+        self.reserved = size
+
+    def read_new_data(self, deadline):
         """
-        try:
-            packet = self.factory.create(data)
-        except PacketParseError:
-            msg = "[UNKOWN] Failed to parse received packet"
-            logging.info("[Recv TID={}] ".format(self.tid) + msg)
-            return ErrorPacket(ErrorPacket.ERR_ILLEGAL_OPERATION)
-
-        logging.info("[Recv TID={}] ".format(self.tid) + str(packet))
-        self.last_received = packet
-        return self.respond_map[type(packet)](packet)
-
-    def respond_to_RRQ(self, packet):
-        fname, mode = packet.filename.decode(), packet.mode.decode()
-        path = os.path.realpath(os.path.join(self.tftp_root, fname.strip('/')))
-
-        # Ensure that file exists, is readable and resides in the tftp root.
-        if not os.path.isfile(path) or not path.startswith(self.tftp_root):
-            return ErrorPacket(ErrorPacket.ERR_FILE_NOT_FOUND)
-        if not os.access(path, os.R_OK):
-            return ErrorPacket(ErrorPacket.ERR_ACCESS_VIOLATION)
-
-        self.file_reader = TftpFileReader(path, mode)
-        data = self.file_reader.get_next_block()
-        self.blockn = 1
-
-        return DataPacket(self.blockn, data)
-
-    def respond_to_WRQ(self, packet):
-        fname, mode = packet.filename.decode(), packet.mode.decode()
-        path = os.path.realpath(os.path.join(self.tftp_root, fname.strip('/')))
-
-        if not all([self.allow_write,
-                    path.startswith(self.tftp_root),
-                    os.access(os.path.split(path)[0], os.W_OK)]):
-            return ErrorPacket(ErrorPacket.ERR_ACCESS_VIOLATION)
+        Returns new raw data read from the transfer socket.
 
-        self.file_writer = TftpFileWriter(path, mode)
-        self.blockn = 1
+        Data that come from any other address than the remote host's are
+        answered with an error and otherwise ignored.
 
-        return ACKPacket(0)
-
-    def respond_to_Data(self, packet):
-        if packet.blockn > self.blockn:
-            return ErrorPacket(ErrorPacket.ERR_UNKNOWN_TID)
-
-        if packet.blockn == self.blockn:
-            try:
-                self.file_writer.write_next_block(packet.data)
-            except IOError:
-                return ErrorPacket(ErrorPacket.ERR_DISK_FULL)
-            else:
-                self.blockn += 1
-
-        return ACKPacket(packet.blockn)
-
-    def respond_to_ACK(self, packet):
-        if packet.blockn == self.blockn:
-            if isinstance(self.last_sent, DataPacket) and self.last_sent.is_last:
-                return None
-
-            self.blockn += 1
-            data = self.file_reader.get_next_block()
-            return DataPacket(self.blockn, data)
+        Raises socket.timeout if no data arrive until the deadline.
+        """
+        # A negotiated block size may exceed the configured buffer size.
+        bufsize = max(self.bufsize, self.protocol.block_size + 4)
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise socket.timeout()
 
-        if packet.blockn < self.blockn:
-            return self.last_sent
+            self.transfer_socket.settimeout(timeout)
+            data, address = self.transfer_socket.recvfrom(bufsize)
+            if address == self.remote_address:
+                return data
 
-        return ErrorPacket(ErrorPacket.ERR_UNKNOWN_TID)
+            error = ErrorPacket(ErrorPacket.ERR_UNKNOWN_TID)
+            self.transfer_socket.sendto(error.to_wire(), address)
 
-    def respond_to_Error(self, packet):
-        # As a server we should not receive any error packets from a client.
-        return ErrorPacket(ErrorPacket.ERR_UNKNOWN_TID)
+    def send_packets(self, packets):
+        """
+        Sends a list of TftpPackets to the remote host through the transfer
+        socket.
+        """
+        debug = logging.root.isEnabledFor(logging.DEBUG)
+        metrics = self.metrics
+        timers = self.phase_timers
+        # Whether shaping or pacing may have held the packets back.
+        delayed = False
+        for packet in packets:
+            if self.scheduler is not None and isinstance(packet, DataPacket):
+                self.throttle(packet)
+                delayed = True
+            if self.pacer is not None and isinstance(packet, DataPacket):
+                interval = self.congestion.pacing_interval(
+                        self.protocol.min_rtt, self.protocol.window_size)
+                if interval:
+                    self.pacer.wait(interval)
+                    delayed = True
+            if timers is not None:
+                start = timers.clock()
+            wire = packet.to_wire()
+            self.transfer_socket.sendto(wire, self.remote_address)
+            if timers is not None:
+                timers.add('send', timers.clock() - start)
+            if metrics is not None:
+                metrics.bytes_sent.inc(len(wire))
+                if isinstance(packet, ErrorPacket):
+                    metrics.errors.labels(packet.error_code).inc()
+            if debug:
+                logging.debug("[Sent TID=%s] %s", self.tid, packet)
+        # The round trip and the retransmission timer start once the last
+        # packet is actually sent.
+        if delayed:
+            self.protocol.sent(time.monotonic())
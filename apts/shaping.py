@@ -0,0 +1,323 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import time
+import heapq
+import fnmatch
+import itertools
+import threading
+import ipaddress
+
+
+class TokenBucket:
+    """
+    A token bucket that refills at a constant rate up to its burst size.
+
+    Consumers may take more tokens than the bucket holds. The bucket then
+    goes into debt, and consume() returns how long the consumer has to wait
+    until the debt is paid off. This way a consumer is deferred exactly once
+    per consumption, instead of polling the bucket until enough tokens are
+    available.
+    """
+    def __init__(self, rate, burst=None):
+        """
+        Keyword arguments:
+        rate  -- number of tokens added to the bucket per second
+        burst -- maximum number of tokens the bucket can hold,
+                 defaults to one second worth of tokens
+        """
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.stamp = None
+
+    def refill(self, now):
+        if self.stamp is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, amount, now):
+        """
+        Takes amount tokens out of the bucket.
+
+        Returns the number of seconds the consumer must wait before using the
+        tokens, 0 if they were already available.
+        """
+        self.refill(now)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def take(self, amount, now):
+        """
+        Takes amount tokens out of the bucket only if they are available.
+
+        Returns True if the tokens were taken, else False.
+        """
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class PriorityGate:
+    """
+    Hands out the tokens of a shared TokenBucket to the waiting sessions in
+    priority order.
+
+    Sessions go through the gate one at a time. While the session at the
+    front pays off the debt of the bucket, the others wait in a queue
+    ordered by their arrival time plus aging seconds for each priority rank
+    (lower ranks first). So a session of rank r is served before a session
+    of rank 0 only if it has been waiting for r * aging seconds longer,
+    which means that low priority sessions are delayed but never starved.
+    """
+    def __init__(self, bucket, aging, clock=time.monotonic, sleep=time.sleep):
+        """
+        Keyword arguments:
+        bucket -- the shared TokenBucket
+        aging  -- waiting time in seconds that makes up for one priority rank
+        clock  -- function returning the current time in seconds
+        sleep  -- function used to defer a session
+        """
+        self.bucket = bucket
+        self.aging = aging
+        self.clock = clock
+        self.sleep = sleep
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._busy = False
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes, rank=0):
+        """
+        Waits for the turn of the caller and takes nbytes tokens out of the
+        bucket, deferring the caller until they are available.
+
+        Returns the total number of seconds the caller waited.
+        """
+        with self._condition:
+            arrival = self.clock()
+            entry = (arrival + rank * self.aging, next(self._counter))
+            heapq.heappush(self._queue, entry)
+            while self._busy or self._queue[0] is not entry:
+                self._condition.wait()
+
+            heapq.heappop(self._queue)
+            self._busy = True
+            now = self.clock()
+            delay = self.bucket.consume(nbytes, now)
+
+        try:
+            if delay > 0:
+                self.sleep(delay)
+        finally:
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+        return now - arrival + delay
+
+
+class FileClass:
+    """
+    A class of files, matched by shell-style patterns, with an optional
+    bandwidth limit shared by all the transfers of the class.
+    """
+    def __init__(self, name, patterns=(), rate=0):
+        """
+        Keyword arguments:
+        name     -- name of the class, as shown in the statistics
+        patterns -- shell-style patterns matched against requested filenames
+        rate     -- maximum bytes per second for the class, 0 for unlimited
+        """
+        self.name = name
+        self.patterns = patterns
+        self.bucket = TokenBucket(rate) if rate else None
+
+        # statistics
+        self.bytes = 0
+        self.deferred = 0.0
+        self.started = None
+
+    def matches(self, filename):
+        return any(fnmatch.fnmatch(filename, p) for p in self.patterns)
+
+
+class BandwidthScheduler:
+    """
+    Shapes the outgoing DATA traffic of all the sessions of a server.
+
+    Every block that a session is about to send is charged to a global
+    bucket, to the bucket of the client IP, to the bucket of the subnet the
+    client belongs to and to the bucket of the file class of the transfer.
+    Any of the buckets may be missing, in which case that limit doesn't
+    apply. When a bucket runs out of tokens, the session sleeps until it
+    can send again.
+    """
+    # Forget the buckets of idle clients when we track more than this.
+    max_clients = 4096
+
+    def __init__(self, rate=0, client_rate=0, subnet_rates=(), file_classes=(),
+                 small_file_size=0, priority_paths=(), aging=1.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        Keyword arguments:
+        rate         -- maximum bytes per second for the whole server
+        client_rate  -- maximum bytes per second for a single client IP
+        subnet_rates -- sequence of (network, rate) tuples; network is a
+                        string such as '10.0.0.0/8'
+        file_classes -- sequence of FileClass objects, matched in order
+        small_file_size -- files of up to this many bytes have the highest
+                           priority, 0 disables prioritization by size
+        priority_paths  -- shell-style patterns of filenames that always
+                           have the highest priority
+        aging        -- waiting time in seconds that makes up for one
+                        priority rank, see PriorityGate
+        clock        -- function returning the current time in seconds
+        sleep        -- function used to defer a session
+
+        Limits with a value of 0 are disabled.
+
+        Priorities only matter when the global rate is limited. Then the
+        sessions that wait for the global bucket are served shortest job
+        first: the rank of a transfer grows with the logarithm of the size
+        of its file, so small files are sent before large ones.
+        """
+        self.gate = None
+        if rate:
+            self.gate = PriorityGate(TokenBucket(rate), aging, clock, sleep)
+        self.client_rate = client_rate
+        self.subnets = [(ipaddress.ip_network(network), TokenBucket(rate))
+                        for network, rate in subnet_rates]
+        self.file_classes = list(file_classes)
+        self.default_class = FileClass('default')
+        self.small_file_size = small_file_size
+        self.priority_paths = priority_paths
+        self.clock = clock
+        self.sleep = sleep
+
+        # client ip -> (client bucket, subnet bucket)
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def classify(self, filename):
+        """
+        Returns the FileClass of the given filename.
+        """
+        for file_class in self.file_classes:
+            if file_class.matches(filename):
+                return file_class
+        return self.default_class
+
+    def rank(self, filename, file_size=None):
+        """
+        Returns the priority rank of a transfer, 0 being the highest.
+
+        Keyword arguments:
+        filename  -- the requested filename
+        file_size -- size of the file in bytes, None if unknown
+        """
+        if any(fnmatch.fnmatch(filename, p) for p in self.priority_paths):
+            return 0
+        if not self.small_file_size or file_size is None:
+            return 0
+        if file_size <= self.small_file_size:
+            return 0
+        return 1 + int(math.log2(file_size / self.small_file_size))
+
+    def client_buckets(self, client_ip, now):
+        try:
+            return self._clients[client_ip]
+        except KeyError:
+            pass
+
+        if len(self._clients) >= self.max_clients:
+            self._clients = {ip: buckets
+                             for ip, buckets in self._clients.items()
+                             if not all(b is None or b.is_full(now)
+                                        for b in buckets)}
+
+        client_bucket = TokenBucket(self.client_rate) if self.client_rate else None
+        subnet_bucket = None
+        if self.subnets:
+            address = ipaddress.ip_address(client_ip)
+            for network, bucket in self.subnets:
+                if address in network:
+                    subnet_bucket = bucket
+                    break
+
+        buckets = self._clients[client_ip] = (client_bucket, subnet_bucket)
+        return buckets
+
+    def reserve(self, client_ip, file_class, nbytes):
+        """
+        Charges nbytes to the client, subnet and file class buckets that
+        apply to the transfer.
+
+        Returns the number of seconds the session must wait before sending.
+        """
+        with self._lock:
+            now = self.clock()
+            buckets = (file_class.bucket,) + self.client_buckets(client_ip, now)
+            delay = max(b.consume(nbytes, now) if b is not None else 0
+                        for b in buckets)
+
+            if file_class.started is None:
+                file_class.started = now
+            file_class.bytes += nbytes
+            file_class.deferred += delay
+
+        return delay
+
+    def throttle(self, client_ip, file_class, nbytes, rank=0):
+        """
+        Defers the calling session until nbytes may be sent to client_ip.
+        """
+        delay = self.reserve(client_ip, file_class, nbytes)
+        if delay > 0:
+            self.sleep(delay)
+
+        if self.gate is not None:
+            waited = self.gate.acquire(nbytes, rank)
+            with self._lock:
+                file_class.deferred += waited
+
+    def stats(self):
+        """
+        Returns a dictionary with the throughput statistics of each file
+        class, keyed by the class name.
+        """
+        now = self.clock()
+        stats = {}
+        with self._lock:
+            for file_class in self.file_classes + [self.default_class]:
+                elapsed = (now - file_class.started
+                           if file_class.started is not None else 0)
+                stats[file_class.name] = {
+                    'bytes': file_class.bytes,
+                    'deferred': file_class.deferred,
+                    'throughput': file_class.bytes / elapsed if elapsed else 0,
+                }
+        return stats
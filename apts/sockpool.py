@@ -0,0 +1,201 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import errno
+import socket
+import threading
+from collections import deque
+
+from .listener import udp_socket
+
+
+class TransferSocketPool:
+    """
+    A pool of transfer sockets, already bound and ready to be used by new
+    sessions.
+
+    Sockets are bound to ports of a configured range, or to ports picked by
+    the OS if there is no range. When a session is over, its socket is
+    drained and kept for the next session. The pool grows when all its
+    sockets are in use, and shrinks back to min_idle sockets when sockets
+    stay unused for more than idle_timeout seconds.
+
+    The socket that has been idle the longest is reused first, and none is
+    reused within quarantine seconds of its release unless no new socket can
+    be bound. Otherwise the next session would get the port that a client
+    just finished with, which makes ports predictable, along with the
+    delayed duplicates of the last transfer.
+    """
+    def __init__(self, interface, port_range=None, min_idle=0, max_idle=64,
+                 idle_timeout=60, family=socket.AF_INET, quarantine=8,
+                 clock=time.monotonic):
+        """
+        Keyword arguments:
+        interface    -- the interface to bind the sockets to
+        port_range   -- (first, last) tuple of the ports to use, inclusive,
+                        or None to let the OS pick the ports
+        min_idle     -- number of idle sockets that are always kept open
+        max_idle     -- maximum number of idle sockets kept open
+        idle_timeout -- seconds after which an unused socket is closed,
+                        unless there are only min_idle sockets left
+        family       -- the address family of the sockets. IPv6 sockets
+                        serve IPv4 hosts as well.
+        quarantine   -- seconds a released socket is kept out of use, e.g.
+                        the longest retransmission timeout
+        """
+        self.interface = interface
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.family = family
+        self.quarantine = quarantine
+        self.clock = clock
+
+        # Ports of the range that we haven't bound a socket to.
+        self._free_ports = None
+        if port_range is not None:
+            self._free_ports = deque(range(port_range[0], port_range[1] + 1))
+
+        # (socket, port, release time) tuples, the most recently used last.
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+        # counters
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+
+        # The first sockets are ready at once.
+        created_at = clock() - quarantine
+        for _ in range(min_idle):
+            self._idle.append(self.create() + (created_at,))
+
+    def create(self):
+        """
+        Creates and binds a new socket.
+
+        Returns a (socket, port) tuple.
+        May raise an OSError, e.g. when all the ports of the range are in use.
+        """
+        sock = udp_socket(self.family)
+        try:
+            if self._free_ports is None:
+                # Port value 0 means that the OS will pick a port for us.
+                sock.bind((self.interface, 0))
+                port = sock.getsockname()[1]
+            else:
+                port = self.bind_from_range(sock)
+        except OSError:
+            sock.close()
+            raise
+
+        self.created += 1
+        return sock, port
+
+    def bind_from_range(self, sock):
+        for _ in range(len(self._free_ports)):
+            port = self._free_ports.popleft()
+            try:
+                sock.bind((self.interface, port))
+            except OSError as e:
+                # Used by another process, try it again later.
+                self._free_ports.append(port)
+                if e.errno != errno.EADDRINUSE:
+                    raise
+            else:
+                return port
+
+        raise OSError(errno.EADDRINUSE, "No free port in the transfer range")
+
+    def acquire(self):
+        """
+        Returns a (socket, port) tuple for a new session.
+        May raise an OSError if no socket can be created.
+        """
+        now = self.clock()
+        with self._lock:
+            if self._idle and now - self._idle[0][2] >= self.quarantine:
+                return self.reuse()
+            try:
+                return self.create()
+            except OSError:
+                if not self._idle:
+                    raise
+                return self.reuse()
+
+    def reuse(self):
+        """
+        Takes the least recently used idle socket. Must be called with the
+        lock held.
+        """
+        sock, port, _ = self._idle.popleft()
+        # Datagrams of the last transfer may have arrived since the release.
+        self.drain(sock)
+        self.reused += 1
+        return sock, port
+
+    def release(self, sock, port):
+        """
+        Gives back the socket of a finished session.
+        """
+        self.drain(sock)
+        now = self.clock()
+
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((sock, port, now))
+            else:
+                self.discard(sock, port)
+
+            # The least recently used sockets are at the beginning.
+            while len(self._idle) > self.min_idle and \
+                    now - self._idle[0][2] > self.idle_timeout:
+                sock, port, _ = self._idle.popleft()
+                self.discard(sock, port)
+
+    def discard(self, sock, port):
+        sock.close()
+        self.closed += 1
+        if self._free_ports is not None:
+            self._free_ports.append(port)
+
+    @staticmethod
+    def drain(sock):
+        """
+        Reads and throws away any datagrams still queued on the socket, so
+        that they don't reach the next session.
+        """
+        sock.setblocking(False)
+        try:
+            while True:
+                sock.recv(1)
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                sock, port, _ = self._idle.pop()
+                self.discard(sock, port)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'created': self.created,
+                'reused': self.reused,
+                'closed': self.closed,
+            }
@@ -0,0 +1,136 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+
+from . import netascii
+
+
+def encoded_size(data, line_separator=os.linesep):
+    """
+    Returns the length of the netascii encoding of data, without encoding
+    it.
+    """
+    if line_separator == '\n':
+        # Every LF and every CR takes one more byte.
+        return len(data) + data.count(b'\n') + data.count(b'\r')
+    return len(netascii.encode(data, line_separator))
+
+
+class NetasciiLayout:
+    """
+    The netascii encoded size of a file, and the offsets in the encoded
+    stream of checkpoints every interval bytes of the file, so that a
+    transfer can start at any offset without encoding the file from its
+    beginning.
+    """
+    interval = 64 * 1024
+
+    def __init__(self, path, line_separator=os.linesep):
+        """
+        Scans the file at path.
+
+        May raise an OSError if it cannot be read.
+        """
+        # The encoded offset of the checkpoint at offset n * interval of the
+        # file.
+        self.checkpoints = array('Q')
+        size = 0
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mtime_ns, self.size = stat.st_mtime_ns, stat.st_size
+            while True:
+                data = f.read(self.interval)
+                if not data:
+                    break
+                self.checkpoints.append(size)
+                size += encoded_size(data, line_separator)
+        self.encoded_size = size
+
+    def current(self, stat):
+        """
+        Returns True if the layout still describes the file with the given
+        os.stat() result.
+        """
+        return (stat.st_mtime_ns, stat.st_size) == (self.mtime_ns, self.size)
+
+    def locate(self, offset):
+        """
+        Returns an (offset, skip) tuple: the offset of the file to start
+        encoding at, and the number of encoded bytes to skip from there to
+        reach offset of the encoded stream.
+        """
+        if not self.checkpoints:
+            return 0, offset
+        n = max(bisect.bisect_right(self.checkpoints, offset) - 1, 0)
+        return n * self.interval, offset - self.checkpoints[n]
+
+
+class NetasciiIndex:
+    """
+    A cache of the NetasciiLayout of the files sent in netascii mode, so
+    that tsize (RFC 2349) is answered without reading the file again. A
+    layout is scanned again once the modification time or the size of its
+    file changes, and the least recently used ones are dropped beyond
+    max_files.
+    """
+    def __init__(self, max_files=1024, line_separator=os.linesep):
+        self.max_files = max_files
+        self.line_separator = line_separator
+
+        # path -> NetasciiLayout, the least recently used first
+        self._layouts = OrderedDict()
+        self._lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def layout(self, path):
+        """
+        Returns the NetasciiLayout of the file at path.
+
+        May raise an OSError if it cannot be read.
+        """
+        stat = os.stat(path)
+        with self._lock:
+            layout = self._layouts.get(path)
+            if layout is not None and layout.current(stat):
+                self.hits += 1
+                self._layouts.move_to_end(path)
+                return layout
+            self.misses += 1
+
+        # Concurrent requests for a changed file may scan it twice, but no
+        # request waits for the scan of another file.
+        layout = NetasciiLayout(path, self.line_separator)
+        with self._lock:
+            self._layouts[path] = layout
+            self._layouts.move_to_end(path)
+            while len(self._layouts) > self.max_files:
+                self._layouts.popitem(last=False)
+        return layout
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._layouts),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,174 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+apts-top: live view of the transfers of a running apts server.
+
+Usage: apts-top [-s SOCKET] [-i SECONDS] [-k COLUMN] [--once]
+
+The server must be started with its control_socket option set, e.g. to
+/run/apts.sock, as the control socket is disabled by default.
+
+Keys:
+    left/right  change the sort column
+    r           reverse the sort order
+    q           quit
+"""
+
+import sys
+import json
+import argparse
+
+from .control import send_command
+
+
+def format_size(n):
+    for unit in ('', 'K', 'M', 'G'):
+        if n < 1024:
+            return '{:.0f}{}'.format(n, unit)
+        n /= 1024
+    return '{:.0f}T'.format(n)
+
+
+# (key, title, width, format function)
+COLUMNS = [
+    ('client', 'CLIENT', 21, str),
+    ('tid', 'TID', 6, str),
+    ('op', 'OP', 4, str),
+    ('file', 'FILE', 28, str),
+    ('mode', 'MODE', 9, str),
+    ('block', 'BLOCK', 7, str),
+    ('bytes', 'BYTES', 11, format_size),
+    ('throughput', 'RATE/s', 9, format_size),
+    ('rtt', 'RTT ms', 8, lambda v: '{:.2f}'.format(v * 1000)),
+    ('retransmits', 'RETX', 5, str),
+    ('elapsed', 'TIME', 8, lambda v: '{:.1f}s'.format(v)),
+]
+
+
+def fetch_sessions(path):
+    """
+    Returns the list of session snapshots of the server listening on the
+    control socket at path.
+    """
+    return json.loads(send_command(path, 'sessions'))
+
+
+def sort_sessions(sessions, key, reverse=False):
+    # None values (e.g. no RTT sample yet) sort before anything else.
+    return sorted(sessions, reverse=reverse,
+                  key=lambda s: (s[key] is not None,
+                                 s[key] if s[key] is not None else 0))
+
+
+def format_table(sessions, key, reverse=False):
+    """
+    Returns the lines of a table with the given sessions, sorted by key.
+    """
+    header = ''
+    for column, title, width, _ in COLUMNS:
+        if column == key:
+            title += '▼' if reverse else '▲'
+        header += title.ljust(width) + ' '
+
+    lines = [header.rstrip()]
+    for session in sort_sessions(sessions, key, reverse):
+        line = ''
+        for column, _, width, fmt in COLUMNS:
+            value = fmt(session[column]) if session[column] is not None else '-'
+            if len(value) > width:
+                value = value[:width - 1] + '…'
+            line += value.ljust(width) + ' '
+        lines.append(line.rstrip())
+    return lines
+
+
+def run_curses(screen, args):
+    import curses
+
+    curses.curs_set(0)
+    screen.timeout(int(args.interval * 1000))
+    keys = [column[0] for column in COLUMNS]
+    key, reverse = args.key, args.reverse
+    error = None
+
+    while True:
+        try:
+            sessions = fetch_sessions(args.socket)
+            error = None
+        except (OSError, ValueError) as e:
+            sessions, error = [], str(e)
+
+        screen.erase()
+        height, width = screen.getmaxyx()
+        status = 'apts-top  {} sessions  sorted by {}  ' \
+                 '(left/right: sort, r: reverse, q: quit)'.format(
+                         len(sessions), key)
+        if error:
+            status = 'apts-top  error: {}'.format(error)
+        screen.addnstr(0, 0, status, width - 1, curses.A_REVERSE)
+
+        lines = format_table(sessions, key, reverse)[:height - 2]
+        for y, line in enumerate(lines):
+            screen.addnstr(y + 2, 0, line, width - 1,
+                           curses.A_BOLD if y == 0 else curses.A_NORMAL)
+        screen.refresh()
+
+        char = screen.getch()
+        if char in (ord('q'), ord('Q')):
+            return
+        if char == ord('r'):
+            reverse = not reverse
+        elif char == curses.KEY_RIGHT:
+            key = keys[(keys.index(key) + 1) % len(keys)]
+        elif char == curses.KEY_LEFT:
+            key = keys[(keys.index(key) - 1) % len(keys)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            prog='apts-top', description='Live view of the transfers of a '
+                                         'running apts server.',
+            epilog='The server must have its control_socket option set, as '
+                   'the control socket is disabled by default.')
+    parser.add_argument('-s', '--socket', default='/run/apts.sock',
+                        help='control socket of the server, as set by its '
+                             'control_socket option (default: %(default)s)')
+    parser.add_argument('-i', '--interval', type=float, default=1,
+                        help='seconds between refreshes (default: %(default)s)')
+    parser.add_argument('-k', '--key', default='throughput',
+                        choices=[column[0] for column in COLUMNS],
+                        help='column to sort by (default: %(default)s)')
+    parser.add_argument('-r', '--reverse', action='store_true',
+                        help='sort in descending order')
+    parser.add_argument('--once', action='store_true',
+                        help='print the sessions once and exit')
+    args = parser.parse_args(argv)
+
+    if args.once:
+        try:
+            sessions = fetch_sessions(args.socket)
+        except (OSError, ValueError) as e:
+            print('apts-top: {}'.format(e), file=sys.stderr)
+            if isinstance(e, FileNotFoundError):
+                print('apts-top: is the control_socket option of the server '
+                      'set to {}?'.format(args.socket), file=sys.stderr)
+            return 1
+        print('\n'.join(format_table(sessions, args.key, args.reverse)))
+        return 0
+
+    import curses
+    curses.wrapper(run_curses, args)
+    return 0
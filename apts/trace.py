@@ -0,0 +1,89 @@
+# Copyright (C) 2015 Ilias Stamatis <stamatis.iliass@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Traces of the requests a server received, one JSON object per line, e.g.:
+
+{"time": 1444.21, "client": "10.0.0.7", "op": "RRQ", "file": "pxelinux.0",
+ "mode": "octet", "options": {}, "size": 26140, "bytes": 26140,
+ "duration": 0.051, "outcome": "complete", "error_code": null}
+
+time is the arrival of the request in seconds since the epoch, size is
+the size of the requested file (for WRQs, the number of bytes written).
+"""
+
+import json
+import logging
+
+
+class TraceHandler(logging.Handler):
+    """
+    Writes a trace line for every transfer summary record (see
+    log.log_transfer) and ignores all the other records.
+    """
+    def __init__(self, filename):
+        super().__init__()
+        self.stream = open(filename, 'a')
+
+    def emit(self, record):
+        summary = getattr(record, 'transfer', None)
+        if summary is None:
+            return
+
+        size = summary['size']
+        if summary['op'] == 'WRQ':
+            size = summary['bytes']
+
+        entry = {
+            'time': round(record.created - summary['linger']
+                          - summary['duration'], 6),
+            'client': summary['client'],
+            'op': summary['op'],
+            'file': summary['filename'],
+            'mode': summary['mode'],
+            'options': summary['options'],
+            'size': size,
+            'bytes': summary['bytes'],
+            'duration': round(summary['duration'], 6),
+            'outcome': summary['outcome'],
+            'error_code': summary['error_code'],
+        }
+        try:
+            self.stream.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+def read_trace(filename):
+    """
+    Returns the entries of a trace file as a list of dictionaries, sorted by
+    arrival time. Requests that were never parsed (e.g. malformed packets)
+    are skipped.
+    """
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry['op'] is not None:
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry['time'])
+    return entries
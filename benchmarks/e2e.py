@@ -0,0 +1,374 @@
+"""
+End-to-end benchmark of apts on the loopback interface.
+
+Starts a server in a child process against a generated TFTP root, and runs
+a number of transfers from concurrent clients, all on one event loop of the
+client of apts.client. Reports aggregate
+throughput, transfers per second, completion time percentiles, server CPU
+time per MB and server peak RSS, and optionally saves them as JSON so that
+runs can be compared across commits.
+
+Examples:
+    python3 -m benchmarks.e2e --clients 50 --transfers 2000 \\
+            --sizes 4K:60,256K:30,8M:10 --write-ratio 0.1 -o run.json
+    python3 -m benchmarks.e2e --compare base.json run.json
+
+With any of the impairment options, e.g. --loss 0.02, the clients talk to
+the server through an ImpairmentProxy, to measure goodput and completion
+time when packets get lost, delayed, duplicated or reordered.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+
+from apts.client import TftpClient
+from apts.control import send_command
+from apts.errors import TftpTransferError
+
+from . import impair
+from .loadgen import ServerProcess, make_file, parse_size, percentile
+
+
+def generate_root(tftp_root, sizes):
+    """
+    Creates a binary and a text test file of each size in tftp_root, named
+    bin_SIZE and text_SIZE, and a directory for uploads.
+    """
+    make_file(os.path.join(tftp_root, 'probe'), 1)
+    os.mkdir(os.path.join(tftp_root, 'upload'))
+    for size in sizes:
+        make_file(os.path.join(tftp_root, 'bin_{}'.format(size)), size)
+        make_file(os.path.join(tftp_root, 'text_{}'.format(size)), size,
+                  text=True)
+
+
+def plan_transfers(args, sizes, weights):
+    """
+    Returns the list of transfers to run, as (op, mode, size) tuples.
+    """
+    rng = random.Random(args.seed)
+    plan = []
+    for _ in range(args.transfers):
+        op = 'WRQ' if rng.random() < args.write_ratio else 'RRQ'
+        mode = 'netascii' if rng.random() < args.netascii_ratio else 'octet'
+        size = rng.choices(sizes, weights)[0]
+        plan.append((op, mode, size))
+    return plan
+
+
+async def run_client(client, work, results, payloads):
+    """
+    Runs transfers from the work iterator until it is exhausted, appending
+    a (op, size, seconds, bytes, error) tuple for each one to results.
+    """
+    for i, (op, mode, size) in work:
+        start = time.perf_counter()
+        error = None
+        transferred = size
+        try:
+            if op == 'RRQ':
+                prefix = 'text' if mode == 'netascii' else 'bin'
+                summary = await client.get('{}_{}'.format(prefix, size),
+                                           mode=mode)
+                transferred = summary['bytes']
+            else:
+                await client.put(BytesIO(payloads[size]),
+                                 'upload/{}'.format(i), mode)
+        except (TftpTransferError, OSError) as e:
+            error = str(e)
+        results.append((op, size, time.perf_counter() - start, transferred,
+                        error))
+
+
+async def run_clients(client, plan, payloads, clients):
+    """
+    Runs the transfers of plan from the given number of concurrent
+    clients, and returns the list of their results.
+    """
+    work = iter(list(enumerate(plan)))
+    results = []
+    await asyncio.gather(*[run_client(client, work, results, payloads)
+                           for _ in range(clients)])
+    return results
+
+
+def summarize(results, wall_time, cpu_time, peak_rss):
+    ok = [r for r in results if r[4] is None]
+    total_bytes = sum(r[3] for r in ok)
+    times = [r[2] for r in ok]
+    mb = total_bytes / 1024 ** 2
+
+    summary = {
+        'transfers': len(results),
+        'errors': len(results) - len(ok),
+        'bytes': total_bytes,
+        'wall_time': wall_time,
+        'mb_per_s': mb / wall_time if wall_time else 0,
+        'transfers_per_s': len(ok) / wall_time if wall_time else 0,
+        'p50_ms': percentile(times, 50) * 1000 if times else None,
+        'p99_ms': percentile(times, 99) * 1000 if times else None,
+        'p999_ms': percentile(times, 99.9) * 1000 if times else None,
+        'server_cpu_s': cpu_time,
+        'cpu_s_per_mb': cpu_time / mb if mb else None,
+        'server_peak_rss': peak_rss,
+        'per_size': {},
+    }
+
+    for size in sorted({r[1] for r in results}):
+        size_times = [r[2] for r in ok if r[1] == size]
+        summary['per_size'][str(size)] = {
+            'transfers': len(size_times),
+            'p50_ms': percentile(size_times, 50) * 1000 if size_times else None,
+            'p99_ms': percentile(size_times, 99) * 1000 if size_times else None,
+        }
+    return summary
+
+
+def server_metric(control_socket, name):
+    """
+    Returns the value of the metric called name of the server, read from
+    its control socket.
+    """
+    for line in send_command(control_socket, 'metrics').splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[1])
+    return 0
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, server_address=None, on_started=None):
+    """
+    Runs the benchmark described by the parsed command line arguments and
+    returns the result dictionary.
+
+    Keyword arguments:
+    server_address -- function that maps the address of the started server
+                      to the address the clients should use, e.g. to go
+                      through a proxy
+    on_started     -- function called with the ServerProcess once it serves
+    """
+    pairs = [item.split(':') for item in args.sizes.split(',')]
+    sizes = [parse_size(size) for size, _ in pairs]
+    weights = [float(weight) for _, weight in pairs]
+
+    tftp_root = tempfile.mkdtemp(prefix='apts-bench-')
+    server = None
+    try:
+        generate_root(tftp_root, sizes)
+        payloads = {size: os.urandom(size) for size in sizes}
+        plan = plan_transfers(args, sizes, weights)
+
+        options = dict(args.server_option or [])
+        options.setdefault('control_socket',
+                           os.path.join(tftp_root, 'control.sock'))
+        server = ServerProcess(tftp_root, options=options,
+                               log_file=args.server_log,
+                               log_level=args.server_log_level,
+                               host=args.host)
+        server.start(probe='probe')
+        if on_started is not None:
+            on_started(server)
+
+        address = server.address
+        if args.connect:
+            address = (args.connect, address[1])
+        if server_address is not None:
+            address = server_address(address)
+
+        client = TftpClient(*address, block_size=args.blksize,
+                            window_size=args.windowsize, timeout=args.timeout)
+
+        cpu_before = server.cpu_time()
+        start = time.perf_counter()
+        results = asyncio.run(run_clients(client, plan, payloads,
+                                          args.clients))
+        wall_time = time.perf_counter() - start
+        cpu_time = server.cpu_time() - cpu_before
+        peak_rss = server.peak_rss()
+        resent = server_metric(options['control_socket'],
+                               'apts_resent_bytes_total')
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(tftp_root, ignore_errors=True)
+
+    result = summarize(results, wall_time, cpu_time, peak_rss)
+    result['resent_ratio'] = resent / result['bytes'] if result['bytes'] \
+        else None
+    result['parameters'] = {
+        'clients': args.clients, 'transfers': args.transfers,
+        'sizes': args.sizes, 'write_ratio': args.write_ratio,
+        'netascii_ratio': args.netascii_ratio, 'seed': args.seed,
+        'blksize': args.blksize, 'windowsize': args.windowsize,
+        'host': args.host, 'connect': args.connect,
+        'server_options': options,
+        'impairment': {
+            'loss': args.loss, 'delay': args.delay, 'jitter': args.jitter,
+            'duplicate': args.duplicate, 'reorder': args.reorder,
+            'reorder_gap': args.reorder_gap, 'seed': args.impair_seed,
+            'rate': args.rate, 'queue': args.queue,
+        },
+    }
+    result['revision'] = git_revision()
+    result['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return result
+
+
+# (key, label, True if higher is better)
+REPORT_KEYS = [
+    ('mb_per_s', 'goodput MB/s', True),
+    ('transfers_per_s', 'transfers/s', True),
+    ('p50_ms', 'p50 ms', False),
+    ('p99_ms', 'p99 ms', False),
+    ('p999_ms', 'p999 ms', False),
+    ('resent_ratio', 'resent ratio', False),
+    ('cpu_s_per_mb', 'CPU s/MB', False),
+    ('server_peak_rss', 'peak RSS', False),
+    ('errors', 'errors', False),
+]
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.3f}'.format(value)
+    return str(value)
+
+
+def report(result, out=sys.stdout):
+    for key, label, _ in REPORT_KEYS:
+        print('{:<14} {:>14}'.format(label, format_value(result[key])), file=out)
+    for size, stats in result['per_size'].items():
+        print('  size {:>10}: {:>6} transfers, p50 {} ms, p99 {} ms'.format(
+                size, stats['transfers'], format_value(stats['p50_ms']),
+                format_value(stats['p99_ms'])), file=out)
+    if 'impairment' in result:
+        print('impairment     ' + ', '.join(
+                '{} {}'.format(key, value)
+                for key, value in result['impairment'].items()), file=out)
+
+
+def compare(base, new, out=sys.stdout):
+    """
+    Prints the relative change of each reported value between two runs.
+    """
+    print('{:<14} {:>14} {:>14} {:>9}'.format(
+            '', base.get('revision') or 'base', new.get('revision') or 'new',
+            'change'), file=out)
+    for key, label, higher_is_better in REPORT_KEYS:
+        old, cur = base.get(key), new.get(key)
+        change = ''
+        if old and cur is not None:
+            delta = (cur - old) / old * 100
+            better = delta > 0 if higher_is_better else delta < 0
+            change = '{:+.1f}%{}'.format(delta, '' if better or not delta
+                                         else ' !')
+        print('{:<14} {:>14} {:>14} {:>9}'.format(
+                label, format_value(old), format_value(cur), change), file=out)
+
+
+def option_pair(text):
+    key, value = text.split('=', 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+            description='End-to-end loopback benchmark of apts.')
+    parser.add_argument('-c', '--clients', type=int, default=20,
+                        help='number of concurrent clients')
+    parser.add_argument('-n', '--transfers', type=int, default=500,
+                        help='total number of transfers')
+    parser.add_argument('-s', '--sizes', default='4K:70,256K:25,4M:5',
+                        help='comma separated size:weight pairs')
+    parser.add_argument('-w', '--write-ratio', type=float, default=0.0,
+                        help='fraction of transfers that are WRQs')
+    parser.add_argument('-a', '--netascii-ratio', type=float, default=0.0,
+                        help='fraction of transfers in netascii mode')
+    parser.add_argument('--blksize', type=int,
+                        help='block size the clients negotiate')
+    parser.add_argument('--windowsize', type=int,
+                        help='window size the clients negotiate')
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='client retransmission timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the transfer plan')
+    parser.add_argument('-O', '--server-option', type=option_pair,
+                        action='append', metavar='KEY=VALUE',
+                        help='override a ServerConfig option of the '
+                             'server, the value is parsed as JSON if '
+                             'possible')
+    parser.add_argument('-H', '--host', default='127.0.0.1',
+                        help='address the server listens on, e.g. :: for '
+                             'IPv6 and IPv4')
+    parser.add_argument('--connect', metavar='HOST',
+                        help='address the clients send to, by default the '
+                             'loopback address of the family of --host')
+    parser.add_argument('--server-log', default=os.devnull,
+                        help='file the server logs to')
+    parser.add_argument('--server-log-level', default='INFO',
+                        help='logging level of the server')
+    impair.add_arguments(parser)
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two saved results and exit')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return 0
+
+    impairment = impair.from_arguments(args)
+    proxy = None
+
+    def through_proxy(address):
+        nonlocal proxy
+        proxy = impair.ImpairmentProxy(address, impairment)
+        proxy.start()
+        return proxy.address
+
+    try:
+        result = run(args, through_proxy if impairment else None)
+    finally:
+        if proxy is not None:
+            proxy.stop()
+    if proxy is not None:
+        result['impairment'] = proxy.stats()
+
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,315 @@
+"""
+A UDP proxy that impairs the traffic between TFTP clients and a server, to
+exercise and measure the retransmission logic under loss, delay, jitter,
+duplication and reordering.
+
+Clients send their requests to the proxy instead of the server. For every
+client the proxy opens an upstream socket, through which it talks to the
+server, and for every transfer ID (port) of the server it opens a
+downstream socket, through which it talks to the client. So the client
+sees a distinct TID per transfer, exactly as it would without the proxy.
+
+All the random decisions are drawn from a generator seeded with the given
+seed, so with the same traffic the same packets get impaired.
+
+Example:
+    python3 -m benchmarks.impair --server 127.0.0.1:69 \\
+            --listen 127.0.0.1:6969 --loss 0.02 --delay 0.01 --jitter 0.005
+"""
+
+import sys
+import time
+import heapq
+import random
+import socket
+import argparse
+import selectors
+import threading
+
+
+class Impairment:
+    """
+    Decides what happens to every forwarded packet.
+    """
+    def __init__(self, loss=0, delay=0, jitter=0, duplicate=0, reorder=0,
+                 reorder_gap=0.02, seed=0, rate=0, queue=65536):
+        """
+        Keyword arguments:
+        loss        -- probability that a packet is dropped
+        delay       -- seconds every packet is delayed by
+        jitter      -- the delay varies uniformly by up to this many seconds
+        duplicate   -- probability that a packet is sent twice
+        reorder     -- probability that a packet is held back for reorder_gap
+                       more seconds, so that later packets overtake it
+        reorder_gap -- seconds a reordered packet is held back
+        seed        -- seed of the random decisions
+        rate        -- bytes per second of a bottleneck link that all the
+                       packets go through, 0 for none
+        queue       -- bytes the bottleneck queues, packets that do not fit
+                       are dropped as a switch would
+        """
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_gap = reorder_gap
+        self.rng = random.Random(seed)
+        self.rate = rate
+        self.queue = queue
+        # Time the bottleneck has sent the packets queued so far.
+        self.link_free_at = 0
+
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.overflowed = 0
+
+    def __bool__(self):
+        return any((self.loss, self.delay, self.jitter, self.duplicate,
+                    self.reorder, self.rate))
+
+    def delays(self, size=0, now=0):
+        """
+        Returns the list of delays, in seconds, after which copies of a
+        packet of size bytes, arriving at now, should be sent. An empty
+        list means the packet is dropped.
+        """
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return []
+
+        queued = 0
+        if self.rate:
+            # The packet waits for the ones ahead of it to leave the
+            # bottleneck, unless they fill its queue.
+            start = max(now, self.link_free_at)
+            if (start - now) * self.rate + size > self.queue:
+                self.overflowed += 1
+                return []
+            self.link_free_at = start + size / self.rate
+            queued = self.link_free_at - now
+
+        copies = 1
+        if self.rng.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+
+        delays = []
+        for _ in range(copies):
+            delay = self.delay + queued
+            if self.jitter:
+                delay += self.rng.uniform(-self.jitter, self.jitter)
+            if self.rng.random() < self.reorder:
+                self.reordered += 1
+                delay += self.reorder_gap
+            delays.append(max(0, delay))
+
+        self.forwarded += 1
+        return delays
+
+    def stats(self):
+        return {
+            'forwarded': self.forwarded,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'reordered': self.reordered,
+            'overflowed': self.overflowed,
+        }
+
+
+class ImpairmentProxy(threading.Thread):
+    """
+    Forwards datagrams between clients and a TFTP server through an
+    Impairment, on a separate thread.
+    """
+    def __init__(self, server_address, impairment, listen=('127.0.0.1', 0),
+                 idle_timeout=30):
+        """
+        Keyword arguments:
+        server_address -- (ip, port) of the TFTP server
+        impairment     -- an Impairment applied to both directions
+        listen         -- (ip, port) clients send their requests to
+        idle_timeout   -- seconds after which the sockets of a silent
+                          client are closed
+        """
+        super().__init__(daemon=True)
+        self.server_address = server_address
+        self.impairment = impairment
+        self.idle_timeout = idle_timeout
+
+        self.selector = selectors.DefaultSelector()
+        self.front = self.open_socket(('front',), listen[0], listen[1])
+        self.address = self.front.getsockname()
+
+        # client address -> upstream socket
+        self.upstream = {}
+        # (client address, server address) -> downstream socket
+        self.downstream = {}
+        # client address -> time of the last packet from or to the client
+        self.last_seen = {}
+
+        # heap of (due time, sequence number, socket, data, address)
+        self.pending = []
+        self.sequence = 0
+        self.stopped = threading.Event()
+
+    def open_socket(self, key, ip='127.0.0.1', port=0):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((ip, port))
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, key)
+        return sock
+
+    def close_socket(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+
+    def schedule(self, sock, data, address, now):
+        for delay in self.impairment.delays(len(data), now):
+            self.sequence += 1
+            heapq.heappush(self.pending,
+                           (now + delay, self.sequence, sock, data, address))
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            while self.pending and self.pending[0][0] <= now:
+                _, _, sock, data, address = heapq.heappop(self.pending)
+                try:
+                    sock.sendto(data, address)
+                except OSError:
+                    pass # the socket has been closed or the peer is gone
+
+            timeout = 0.1
+            if self.pending:
+                timeout = min(timeout, self.pending[0][0] - now)
+            for key, _ in self.selector.select(max(0, timeout)):
+                self.forward(key.fileobj, key.data, time.monotonic())
+
+            self.prune(time.monotonic())
+
+        for sock in [self.front, *self.upstream.values(),
+                     *self.downstream.values()]:
+            self.close_socket(sock)
+        self.selector.close()
+
+    def forward(self, sock, key, now):
+        try:
+            data, address = sock.recvfrom(65536)
+        except OSError:
+            return
+
+        if key[0] == 'front':
+            # A request from a client, forward it to the server's port.
+            client = address
+            upstream = self.upstream.get(client)
+            if upstream is None:
+                upstream = self.open_socket(('up', client))
+                self.upstream[client] = upstream
+            self.schedule(upstream, data, self.server_address, now)
+        elif key[0] == 'up':
+            # A packet from a server TID, forward it to the client from the
+            # downstream socket that stands for that TID.
+            client = key[1]
+            downstream = self.downstream.get((client, address))
+            if downstream is None:
+                downstream = self.open_socket(('down', client, address))
+                self.downstream[client, address] = downstream
+            self.schedule(downstream, data, client, now)
+        else:
+            # A packet from the client to a server TID.
+            client, server = key[1], key[2]
+            if address != client:
+                return
+            self.schedule(self.upstream[client], data, server, now)
+
+        self.last_seen[client] = now
+
+    def prune(self, now):
+        for client, seen in list(self.last_seen.items()):
+            if now - seen < self.idle_timeout:
+                continue
+            del self.last_seen[client]
+            self.close_socket(self.upstream.pop(client))
+            for pair in [pair for pair in self.downstream if pair[0] == client]:
+                self.close_socket(self.downstream.pop(pair))
+
+    def stats(self):
+        stats = self.impairment.stats()
+        stats['clients'] = len(self.upstream)
+        return stats
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def add_arguments(parser):
+    """
+    Adds the impairment options to an argparse parser.
+    """
+    group = parser.add_argument_group('network impairment')
+    group.add_argument('--loss', type=float, default=0,
+                       help='probability that a packet is dropped')
+    group.add_argument('--delay', type=float, default=0,
+                       help='seconds every packet is delayed by')
+    group.add_argument('--jitter', type=float, default=0,
+                       help='seconds by which the delay varies')
+    group.add_argument('--duplicate', type=float, default=0,
+                       help='probability that a packet is duplicated')
+    group.add_argument('--reorder', type=float, default=0,
+                       help='probability that a packet is held back so that '
+                            'later packets overtake it')
+    group.add_argument('--reorder-gap', type=float, default=0.02,
+                       help='seconds a reordered packet is held back')
+    group.add_argument('--impair-seed', type=int, default=0,
+                       help='seed of the impairment decisions')
+    group.add_argument('--rate', type=float, default=0,
+                       help='bytes per second of a bottleneck link')
+    group.add_argument('--queue', type=int, default=65536,
+                       help='bytes the bottleneck link queues before it '
+                            'drops packets')
+
+
+def from_arguments(args):
+    """
+    Returns the Impairment described by the options of add_arguments().
+    """
+    return Impairment(args.loss, args.delay, args.jitter, args.duplicate,
+                      args.reorder, args.reorder_gap, args.impair_seed,
+                      args.rate, args.queue)
+
+
+def parse_address(text):
+    ip, port = text.rsplit(':', 1)
+    return ip, int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='UDP proxy that impairs TFTP traffic.')
+    parser.add_argument('--server', type=parse_address, required=True,
+                        metavar='IP:PORT', help='address of the TFTP server')
+    parser.add_argument('--listen', type=parse_address,
+                        default=('127.0.0.1', 6969), metavar='IP:PORT',
+                        help='address clients send their requests to '
+                             '(default: 127.0.0.1:6969)')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    proxy = ImpairmentProxy(args.server, from_arguments(args), args.listen)
+    proxy.start()
+    print('Forwarding {}:{} to {}:{}'.format(*proxy.address, *args.server))
+    try:
+        while True:
+            time.sleep(10)
+            print(proxy.stats())
+    except KeyboardInterrupt:
+        proxy.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
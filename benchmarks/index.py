@@ -0,0 +1,120 @@
+"""
+Benchmark of the file index of apts on a large tftp root.
+
+Creates a tree of empty files laid out like a PXE root, one configuration
+file per MAC address under pxelinux.cfg and images spread over
+directories, then reports how long a scan of the tree takes, the memory
+the index holds and the lookups per second, for names in the wrong case.
+
+Examples:
+    python3 -m benchmarks.index --files 100000
+    python3 -m benchmarks.index --root /srv/tftp
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from apts.index import FileIndex
+
+from .e2e import format_value, git_revision
+
+
+def make_tree(root, files, seed=1):
+    """
+    Creates files empty files in root, and returns their relative paths.
+    """
+    rng = random.Random(seed)
+    paths = []
+    os.makedirs(os.path.join(root, 'pxelinux.cfg'))
+    for n in range(files):
+        if n % 2:
+            mac = '-'.join('{:02x}'.format(rng.randrange(256))
+                           for _ in range(6))
+            path = 'pxelinux.cfg/01-' + mac
+        else:
+            path = 'images/Distro{}/Release{}/vmlinuz-{}'.format(
+                    n % 50, n % 7, n)
+        os.makedirs(os.path.dirname(os.path.join(root, path)),
+                    exist_ok=True)
+        open(os.path.join(root, path), 'wb').close()
+        paths.append(path)
+    return paths
+
+
+def run(args):
+    tftp_root = args.root
+    if tftp_root is None:
+        tftp_root = tempfile.mkdtemp(prefix='apts-index-')
+    try:
+        if args.root is None:
+            paths = make_tree(tftp_root, args.files)
+        else:
+            index = FileIndex(tftp_root, case_fold=False)
+            paths = list(index.files.values())
+
+        # The first scan warms the dentry cache, as on a running server,
+        # and the last one runs apart as tracing allocations slows it down.
+        FileIndex(tftp_root)
+        start = time.perf_counter()
+        index = FileIndex(tftp_root)
+        scan_seconds = time.perf_counter() - start
+        tracemalloc.start()
+        traced = FileIndex(tftp_root)
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del traced
+
+        names = [path.upper().replace('/', '\\') for path in paths]
+        start = time.perf_counter()
+        found = sum(index.lookup(name) is not None for name in names)
+        lookup_seconds = time.perf_counter() - start
+    finally:
+        if args.root is None:
+            shutil.rmtree(tftp_root, ignore_errors=True)
+
+    return {
+        'revision': git_revision(),
+        'files': len(index.files),
+        'scan_ms': scan_seconds * 1000,
+        'index_bytes': index.size,
+        'allocated_bytes': allocated,
+        'bytes_per_file': allocated / max(len(index.files), 1),
+        'lookups_per_s': len(names) / lookup_seconds,
+        'found': found,
+    }
+
+
+def report(result, out=sys.stdout):
+    for key in ('files', 'scan_ms', 'index_bytes', 'allocated_bytes',
+                'bytes_per_file', 'lookups_per_s', 'found'):
+        print('{:<16} {:>12}'.format(key, format_value(result[key])),
+              file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Measure the scan and lookups of the file index.')
+    parser.add_argument('-n', '--files', type=int, default=100000,
+                        help='number of files in the generated tree')
+    parser.add_argument('--root',
+                        help='index an existing tree instead')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Building blocks of the benchmarks: a TFTP server running in a child
+process, and helpers to generate a TFTP root and to compute statistics.
+The benchmarks drive the server with the client of apts.client.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import subprocess
+
+from apts.client import TftpClient
+from apts.errors import TftpTransferError
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    """
+    Parses a size such as 512, 64K or 10M and returns the number of bytes.
+    """
+    text = text.strip().upper()
+    unit = text[-1] if text[-1] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0 <= p <= 100) of values, by the nearest
+    rank method.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[rank]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_file(path, size, text=False, seed=0):
+    """
+    Writes a file of size bytes at path, with random binary contents or
+    random text lines.
+    """
+    rng = random.Random(seed)
+    with open(path, 'wb') as f:
+        if text:
+            words = [b'lorem', b'ipsum', b'dolor', b'sit', b'amet', b'\n', b'\r']
+            chunk = b' '.join(rng.choice(words) for _ in range(20000))
+        else:
+            chunk = rng.randbytes(65536)
+        while size > 0:
+            f.write(chunk[:size])
+            size -= len(chunk)
+
+
+class ServerProcess:
+    """
+    An apts server running in a child process on the loopback interface.
+    """
+    def __init__(self, tftp_root, port=None, options=None, log_file=os.devnull,
+                 log_level='INFO', host='127.0.0.1'):
+        """
+        Keyword arguments:
+        tftp_root -- the directory to serve
+        port      -- the port to listen on, a free port if None
+        options   -- dictionary of ServerConfig options to override
+        log_file  -- file the server logs to
+        log_level -- logging level of the server
+        host      -- the address to listen on, e.g. '::' for both IPv6 and
+                     IPv4. Clients use the loopback address of its family.
+        """
+        self.tftp_root = tftp_root
+        self.host = host
+        self.port = port or free_port()
+        self.address = ('::1' if ':' in host else '127.0.0.1', self.port)
+        self.options = options or {}
+        self.log_file = log_file
+        self.log_level = log_level
+        self.process = None
+
+    def start(self, probe=None):
+        """
+        Starts the server and waits until it serves the file probe, or just
+        a second if there is no probe file.
+        """
+        code = (
+            'import json, logging, sys\n'
+            'from apts.config import ServerConfig\n'
+            'from apts.log import setup_logging\n'
+            'from apts.server import TftpServer\n'
+            'config = ServerConfig(**json.loads(sys.argv[1]))\n'
+            'setup_logging(getattr(logging, sys.argv[3]), sys.argv[2],\n'
+            '              config.trace_file)\n'
+            'server = TftpServer(sys.argv[4], writable=True, config=config)\n'
+            'try:\n'
+            '    server.listen(sys.argv[6], int(sys.argv[5]),\n'
+            '                  drop_privileges=False)\n'
+            'except KeyboardInterrupt:\n'
+            '    pass\n'
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        self.process = subprocess.Popen(
+                [sys.executable, '-c', code, json.dumps(self.options),
+                 self.log_file, self.log_level, self.tftp_root, str(self.port),
+                 self.host],
+                env=env)
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('the server exited with code {}'.format(
+                        self.process.returncode))
+            if probe is None:
+                time.sleep(1)
+                return
+            client = TftpClient(*self.address, timeout=0.1, retries=1)
+            try:
+                asyncio.run(client.get(probe))
+                return
+            except (TftpTransferError, OSError):
+                time.sleep(0.05)
+
+        raise RuntimeError('the server did not start')
+
+    def cpu_time(self):
+        """
+        Returns the CPU time in seconds the server has consumed so far.
+        """
+        with open('/proc/{}/stat'.format(self.process.pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime and stime are the 14th and 15th fields of the whole line.
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def peak_rss(self):
+        """
+        Returns the peak resident set size of the server in bytes.
+        """
+        with open('/proc/{}/status'.format(self.process.pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+        return None
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            # SIGINT, unlike SIGTERM, lets the server flush its log and trace.
+            self.process.send_signal(signal.SIGINT)
+            self.process.wait()
@@ -0,0 +1,341 @@
+"""
+Microbenchmarks of the inner loops of apts: the packet codec, the netascii
+conversions, the file readers and writers and the netascii size index.
+
+For each benchmark reports operations per second, nanoseconds per operation
+and bytes allocated per operation, measured with tracemalloc as the peak of
+the memory allocated during a timed call, divided by the operations the
+call performs. Results can be saved as a baseline and later runs compared
+against it; the comparison flags the benchmarks that got slower or allocate
+more than a threshold and exits with status 1 if there is any.
+
+Examples:
+    python3 -m benchmarks.micro --save base.json
+    python3 -m benchmarks.micro --compare base.json --threshold 5
+    python3 -m benchmarks.micro -k netascii
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from apts import netascii
+from apts.file_rw import TftpFileReader, TftpFileWriter
+from apts.textindex import NetasciiIndex, NetasciiLayout, encoded_size
+from apts.packets import (RRQPacket, WRQPacket, DataPacket, ACKPacket,
+                          ErrorPacket, PacketFactory)
+
+from .loadgen import make_file
+
+BENCHMARKS = []
+
+
+def benchmark(name, ops=1):
+    """
+    Registers a benchmark. The decorated function is called once with a
+    scratch directory to set the benchmark up, and returns the function to
+    time. Every call of the timed function counts as ops operations.
+    """
+    def decorator(setup):
+        BENCHMARKS.append((name, setup, ops))
+        return setup
+    return decorator
+
+
+# Packet codec
+
+PACKETS = [
+    ('rrq', RRQPacket(b'pxelinux.cfg/01-52-54-00-12-34-56', b'octet')),
+    ('wrq', WRQPacket(b'uploads/config.txt', b'netascii')),
+    ('data', DataPacket(1234, bytes(512))),
+    ('data_last', DataPacket(1235, bytes(100))),
+    ('ack', ACKPacket(1234)),
+    ('error', ErrorPacket(ErrorPacket.ERR_FILE_NOT_FOUND)),
+]
+
+
+def register_packet_benchmarks():
+    factory = PacketFactory()
+    for name, packet in PACKETS:
+        wire = packet.to_wire()
+        payload = wire[2:]
+
+        benchmark('packets.{}.to_wire'.format(name))(
+                lambda directory, packet=packet: packet.to_wire)
+        benchmark('packets.{}.from_wire'.format(name))(
+                lambda directory, cls=type(packet), payload=payload:
+                        lambda: cls.from_wire(payload))
+        benchmark('packets.{}.create'.format(name))(
+                lambda directory, wire=wire: lambda: factory.create(wire))
+
+register_packet_benchmarks()
+
+
+# Netascii
+
+def text_shape(line_length, rng, separator='\n'):
+    """
+    Returns a block of 512 bytes of text made of lines of line_length
+    characters. A line_length of 0 means no line separators at all.
+    """
+    letters = b'abcdefghijklmnopqrstuvwxyz '
+    out = bytearray()
+    while len(out) < 512:
+        if line_length and len(out) % (line_length + 1) == line_length:
+            out += separator.encode()
+        else:
+            out.append(rng.choice(letters))
+    return bytes(out[:512])
+
+
+def netascii_shapes():
+    rng = random.Random(0)
+    return [
+        ('no_newlines', text_shape(0, rng)),
+        ('lines_80', text_shape(80, rng)),
+        ('lines_8', text_shape(8, rng)),
+        ('only_newlines', b'\n' * 512),
+        ('bare_cr', text_shape(16, rng, '\r')),
+        ('binary', rng.randbytes(512)),
+    ]
+
+
+def register_netascii_benchmarks():
+    for name, data in netascii_shapes():
+        encoded = netascii.encode(data, '\n')
+        benchmark('netascii.encode.{}'.format(name))(
+                lambda directory, data=data:
+                        lambda: netascii.encode(data, '\n'))
+        benchmark('netascii.decode.{}'.format(name))(
+                lambda directory, encoded=encoded:
+                        lambda: netascii.decode(encoded, '\n'))
+        benchmark('netascii.encoded_size.{}'.format(name))(
+                lambda directory, data=data:
+                        lambda: encoded_size(data, '\n'))
+
+register_netascii_benchmarks()
+
+
+# File readers and writers. Every timed call transfers a whole file of
+# FILE_BLOCKS blocks, so the cost of opening the file is spread over them.
+
+FILE_BLOCKS = 128
+FILE_SIZE = FILE_BLOCKS * 512 - 1
+
+
+def read_file(filename, mode):
+    def run():
+        reader = TftpFileReader(filename, mode)
+        while len(reader.get_next_block()) == 512:
+            pass
+    return run
+
+
+@benchmark('file_rw.reader.octet', ops=FILE_BLOCKS)
+def reader_octet(directory):
+    filename = os.path.join(directory, 'binary')
+    make_file(filename, FILE_SIZE)
+    return read_file(filename, 'octet')
+
+
+@benchmark('file_rw.reader.netascii', ops=FILE_BLOCKS)
+def reader_netascii(directory):
+    filename = os.path.join(directory, 'text')
+    make_file(filename, FILE_SIZE, text=True)
+    return read_file(filename, 'netascii')
+
+
+def write_file(mode, blocks):
+    def run():
+        writer = TftpFileWriter(os.devnull, mode)
+        for block in blocks:
+            writer.write_next_block(block)
+    return run
+
+
+@benchmark('file_rw.writer.octet', ops=FILE_BLOCKS)
+def writer_octet(directory):
+    rng = random.Random(0)
+    blocks = [rng.randbytes(512) for _ in range(FILE_BLOCKS - 1)]
+    return write_file('octet', blocks + [b'end'])
+
+
+@benchmark('file_rw.writer.netascii', ops=FILE_BLOCKS)
+def writer_netascii(directory):
+    rng = random.Random(0)
+    blocks = [netascii.encode(text_shape(80, rng), '\n')[:512]
+              for _ in range(FILE_BLOCKS - 1)]
+    return write_file('netascii', blocks + [b'end\r\n'])
+
+
+# Netascii size index. A scan counts as one operation per block of the
+# file, as the reader does.
+
+@benchmark('textindex.scan', ops=FILE_BLOCKS)
+def textindex_scan(directory):
+    filename = os.path.join(directory, 'text')
+    make_file(filename, FILE_SIZE, text=True)
+    return lambda: NetasciiLayout(filename, '\n')
+
+
+@benchmark('textindex.hit')
+def textindex_hit(directory):
+    filename = os.path.join(directory, 'text')
+    make_file(filename, FILE_SIZE, text=True)
+    index = NetasciiIndex(line_separator='\n')
+    index.layout(filename)
+    return lambda: index.layout(filename)
+
+
+# Measurement
+
+def calibrate(function, target):
+    """
+    Returns the number of calls of function that take at least target
+    seconds.
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        if time.perf_counter() - start >= target:
+            return loops
+        loops *= 2
+
+
+def allocated_bytes(function):
+    """
+    Returns the peak number of bytes allocated during a call of function.
+    """
+    function() # warm up caches, e.g. compiled regular expressions
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def measure(function, ops, target=0.1, repeat=5):
+    """
+    Times function and returns a dictionary with the operations per second,
+    nanoseconds per operation and bytes allocated per operation. The time
+    is the best of repeat runs, each about target seconds long.
+    """
+    loops = calibrate(function, target)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        best = min(best, time.perf_counter() - start)
+
+    ns_per_op = best / (loops * ops) * 1e9
+    return {
+        'ops_per_s': 1e9 / ns_per_op,
+        'ns_per_op': ns_per_op,
+        'bytes_per_op': allocated_bytes(function) / ops,
+    }
+
+
+def run(pattern=None, target=0.1, repeat=5, out=sys.stdout):
+    """
+    Runs the benchmarks whose name contains pattern and returns a
+    dictionary of {name: measurement}.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='apts-micro-') as directory:
+        for name, setup, ops in BENCHMARKS:
+            if pattern and pattern not in name:
+                continue
+            results[name] = measure(setup(directory), ops, target, repeat)
+            print(format_row(name, results[name]), file=out, flush=True)
+    return results
+
+
+def format_row(name, result):
+    return '{:<36} {:>14,.0f} {:>12.1f} {:>12.1f}'.format(
+            name, result['ops_per_s'], result['ns_per_op'],
+            result['bytes_per_op'])
+
+
+def compare(base, new, threshold, out=sys.stdout):
+    """
+    Prints the change of ns/op and bytes/op of every benchmark present in
+    both base and new, and returns the names of the benchmarks that got
+    worse by more than threshold percent.
+    """
+    regressions = []
+    print('{:<36} {:>12} {:>12} {:>9} {:>10}'.format(
+            'benchmark', 'base ns/op', 'new ns/op', 'time', 'bytes'),
+          file=out)
+    for name in new:
+        if name not in base:
+            continue
+        changes = []
+        for key in ('ns_per_op', 'bytes_per_op'):
+            old, cur = base[name][key], new[name][key]
+            changes.append((cur - old) / old * 100 if old else 0)
+
+        flag = ''
+        if any(change > threshold for change in changes):
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<36} {:>12.1f} {:>12.1f} {:>+8.1f}% {:>+9.1f}%{}'.format(
+                name, base[name]['ns_per_op'], new[name]['ns_per_op'],
+                changes[0], changes[1], flag), file=out)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Microbenchmarks of the packet codec, netascii and '
+                        'the file readers and writers of apts.')
+    parser.add_argument('-k', '--filter', metavar='PATTERN',
+                        help='only run the benchmarks whose name contains '
+                             'PATTERN')
+    parser.add_argument('-t', '--time', type=float, default=0.1,
+                        help='seconds per timed run (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timed runs per benchmark, the best one counts '
+                             '(default: %(default)s)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percentage by which ns/op or bytes/op may grow '
+                             'before it counts as a regression '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    print('{:<36} {:>14} {:>12} {:>12}'.format(
+            'benchmark', 'ops/s', 'ns/op', 'bytes/op'))
+    results = run(args.filter, args.time, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print()
+        regressions = compare(base, results, args.threshold)
+        if regressions:
+            print('\n{} regression(s) beyond {}%'.format(
+                    len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
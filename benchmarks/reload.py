@@ -0,0 +1,175 @@
+"""
+Reload benchmark of apts on the loopback interface.
+
+Starts the apts command, runs transfers from concurrent clients without a
+break, and meanwhile reloads the server a number of times through its
+control socket, as a deploy would. Every reload starts a new server process
+that takes the listening socket over, while the old one finishes its
+transfers. Reports the transfers that failed, which should be none, and the
+time each reload took.
+
+Examples:
+    python3 -m benchmarks.reload --reloads 5 --clients 20
+    python3 -m benchmarks.reload --size 4M -o reload.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from apts.client import TftpClient
+from apts.control import send_command
+from apts.errors import TftpTransferError
+
+from .e2e import format_value, git_revision
+from .loadgen import free_port, make_file, parse_size, percentile
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_exit(pid, timeout=10):
+    """
+    Waits for the process pid, which need not be a child, to exit.
+    """
+    deadline = time.monotonic() + timeout
+    while os.path.exists('/proc/{}'.format(pid)):
+        if time.monotonic() > deadline:
+            raise RuntimeError('server process {} did not exit'.format(pid))
+        time.sleep(0.05)
+
+
+async def transfers(client, clients, stop, results):
+    """
+    Runs clients concurrent loops of downloads until stop is set, and
+    appends the summary or the error of every transfer to results.
+    """
+    async def loop():
+        while not stop.is_set():
+            try:
+                results.append(await client.get('file'))
+            except (TftpTransferError, OSError) as e:
+                results.append(e)
+
+    await asyncio.gather(*[loop() for _ in range(clients)])
+
+
+async def reloads(control_socket, count, interval, stop, pids, times):
+    """
+    Reloads the server count times, every interval seconds, then sets stop.
+    """
+    try:
+        for _ in range(count):
+            await asyncio.sleep(interval)
+            start = time.perf_counter()
+            message = await asyncio.to_thread(send_command, control_socket,
+                                              'reload', 30)
+            times.append(time.perf_counter() - start)
+            pids.append(int(message.split()[2]))
+        await asyncio.sleep(interval)
+    finally:
+        stop.set()
+
+
+def run(args):
+    tftp_root = os.path.realpath(tempfile.mkdtemp(prefix='apts-reload-'))
+    control_socket = os.path.join(tftp_root, 'control.sock')
+    make_file(os.path.join(tftp_root, 'file'), args.size)
+    port = free_port()
+
+    process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'bin', 'apts'),
+             '-c', os.devnull, '-r', tftp_root, '-H', '127.0.0.1',
+             '-p', str(port), '-s', control_socket, '-l', 'WARNING',
+             '--log-file', args.server_log, '--no-drop-privileges'],
+            env=dict(os.environ, PYTHONPATH=ROOT))
+    pids = [process.pid]
+    results, reload_times = [], []
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(control_socket):
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError('the server did not start')
+            time.sleep(0.05)
+
+        async def main():
+            client = TftpClient('127.0.0.1', port, block_size=args.block_size,
+                                timeout=args.timeout, retries=args.retries)
+            stop = asyncio.Event()
+            await asyncio.gather(
+                    transfers(client, args.clients, stop, results),
+                    reloads(control_socket, args.reloads, args.interval, stop,
+                            pids, reload_times))
+
+        start = time.perf_counter()
+        asyncio.run(main())
+        elapsed = time.perf_counter() - start
+    finally:
+        os.kill(pids[-1], signal.SIGTERM)
+        process.wait()
+        for pid in pids[1:]:
+            wait_exit(pid)
+        shutil.rmtree(tftp_root, ignore_errors=True)
+
+    failed = [r for r in results if isinstance(r, Exception)]
+    return {
+        'revision': git_revision(),
+        'reloads': len(reload_times),
+        'transfers': len(results),
+        'failed': len(failed),
+        'errors': sorted({str(e) for e in failed}),
+        'transfers_per_s': len(results) / elapsed,
+        'reload_p50_ms': percentile(reload_times, 50) * 1000
+                         if reload_times else None,
+        'reload_max_ms': max(reload_times) * 1000 if reload_times else None,
+    }
+
+
+def report(result, out=sys.stdout):
+    for key in ('reloads', 'transfers', 'failed', 'transfers_per_s',
+                'reload_p50_ms', 'reload_max_ms'):
+        print('{:<16} {:>12}'.format(key, format_value(result[key])),
+              file=out)
+    for error in result['errors']:
+        print('error: {}'.format(error), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Reload apts under load and count failed transfers.')
+    parser.add_argument('-r', '--reloads', type=int, default=5,
+                        help='number of reloads')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between reloads')
+    parser.add_argument('-c', '--clients', type=int, default=20,
+                        help='number of concurrent clients')
+    parser.add_argument('--size', type=parse_size, default=256 * 1024,
+                        help='size of the downloaded file, e.g. 4M')
+    parser.add_argument('--block-size', type=int, default=1428,
+                        help='block size the clients ask for')
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='seconds before a client resends')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='times a client resends before giving up')
+    parser.add_argument('--server-log', default=os.devnull,
+                        help='file the servers log to')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0 if not result['failed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
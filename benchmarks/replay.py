@@ -0,0 +1,261 @@
+"""
+Replays a request trace recorded by a server (see apts/trace.py) against a
+test server on the loopback interface, at the recorded pace or faster.
+
+The TFTP root of the test server is synthesized from the trace: every file
+that was read gets random contents of its recorded size (text for files
+read in netascii mode), and uploads send random data of the recorded size.
+Every request is started at its recorded arrival time, divided by the
+speed-up, no matter how many transfers are still running, and asks for the
+options (block size, window size, tsize) of the recorded one.
+
+The report compares the completion times, outcomes and throughput of the
+replay with the recorded ones.
+
+Examples:
+    python3 -m benchmarks.replay /var/log/apts.trace
+    python3 -m benchmarks.replay --speed 10 -o replay.json apts.trace
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+from io import BytesIO
+
+from apts.client import TftpClient
+from apts.errors import TftpTransferError, TftpTimeoutError
+from apts.trace import read_trace
+
+from .e2e import option_pair
+from .loadgen import ServerProcess, make_file, percentile
+
+
+def safe_path(tftp_root, filename):
+    """
+    Returns the path of filename under tftp_root, or None if the name
+    points outside of it.
+    """
+    path = os.path.normpath(os.path.join(tftp_root, filename.strip('/')))
+    if not path.startswith(tftp_root + os.sep):
+        return None
+    return path
+
+
+def synthesize_root(tftp_root, entries):
+    """
+    Creates the files read in the trace, and the directories written to.
+    """
+    files = {}
+    for entry in entries:
+        path = safe_path(tftp_root, entry['file'])
+        if path is None:
+            continue
+        if entry['op'] == 'WRQ':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        elif entry['size'] is not None:
+            size, text = files.get(path, (0, False))
+            files[path] = (max(size, entry['size']),
+                           text or entry['mode'] == 'netascii')
+
+    for path, (size, text) in files.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        make_file(path, size, text=text)
+
+
+def entry_client(address, entry, timeout):
+    """
+    Returns a TftpClient that asks for the options of a trace entry.
+    """
+    options = entry.get('options') or {}
+
+    def integer(name):
+        try:
+            return int(options[name])
+        except (KeyError, ValueError):
+            return None
+
+    return TftpClient(*address, block_size=integer('blksize'),
+                      window_size=integer('windowsize'),
+                      tsize='tsize' in options, timeout=timeout)
+
+
+async def replay_entry(address, entry, due, payload, timeout):
+    """
+    Runs the transfer of a trace entry and returns (outcome, seconds,
+    bytes). The time is counted from when the request was due.
+    """
+    client = entry_client(address, entry, timeout)
+    outcome, transferred = 'complete', entry['bytes']
+    try:
+        if entry['op'] == 'RRQ':
+            summary = await client.get(entry['file'], mode=entry['mode'])
+            transferred = summary['bytes']
+        else:
+            await client.put(BytesIO(payload[:entry['size']]), entry['file'],
+                             entry['mode'])
+    except TftpTimeoutError:
+        outcome = 'timeout'
+    except (TftpTransferError, OSError):
+        outcome = 'error'
+    return outcome, time.perf_counter() - due, transferred
+
+
+async def replay(address, entries, payload, args):
+    """
+    Starts the transfer of every entry at its time, with up to
+    args.max_clients of them running at once.
+
+    Returns the list of their outcomes, the time they took altogether and
+    the most a request was started late.
+    """
+    semaphore = asyncio.Semaphore(args.max_clients)
+
+    async def run(entry, due):
+        async with semaphore:
+            return await replay_entry(address, entry, due, payload,
+                                      args.timeout)
+
+    tasks, lateness = [], 0
+    first = entries[0]['time']
+    start = time.perf_counter() + 0.1
+    for entry in entries:
+        due = start + (entry['time'] - first) / args.speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            lateness = max(lateness, -delay)
+        tasks.append(asyncio.create_task(run(entry, due)))
+    outcomes = await asyncio.gather(*tasks)
+    return outcomes, time.perf_counter() - start, lateness
+
+
+def summarize(outcomes, wall_time):
+    """
+    Summarizes a list of (outcome, seconds, bytes) tuples of transfers that
+    took wall_time seconds altogether.
+    """
+    complete = [o for o in outcomes if o[0] == 'complete']
+    times = [o[1] for o in complete]
+    summary = {'transfers': len(outcomes)}
+    for outcome in ('complete', 'error', 'timeout'):
+        summary[outcome] = sum(1 for o in outcomes if o[0] == outcome)
+    for p in (50, 90, 99):
+        value = percentile(times, p)
+        summary['p{}_ms'.format(p)] = value * 1000 if times else None
+    throughputs = [o[2] / o[1] for o in complete if o[1] > 0]
+    summary['mean_throughput'] = (sum(throughputs) / len(throughputs)
+                                  if throughputs else None)
+    summary['throughput'] = (sum(o[2] for o in complete) / wall_time
+                             if wall_time else None)
+    summary['wall_time'] = wall_time
+    return summary
+
+
+def recorded_outcomes(entries):
+    return [(entry['outcome'] or 'error', entry['duration'], entry['bytes'])
+            for entry in entries]
+
+
+def run(args):
+    entries = read_trace(args.trace)
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        raise SystemExit('{}: no requests in the trace'.format(args.trace))
+
+    tftp_root = os.path.realpath(tempfile.mkdtemp(prefix='apts-replay-'))
+    server = None
+    try:
+        synthesize_root(tftp_root, entries)
+        upload_sizes = [e['size'] for e in entries if e['op'] == 'WRQ']
+        payload = os.urandom(max(upload_sizes, default=0))
+
+        server = ServerProcess(tftp_root,
+                               options=dict(args.server_option or []),
+                               log_file=args.server_log)
+        server.start()
+
+        outcomes, wall_time, lateness = asyncio.run(
+                replay(server.address, entries, payload, args))
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(tftp_root, ignore_errors=True)
+
+    first = entries[0]['time']
+    recorded_time = max(e['time'] + e['duration'] for e in entries) - first
+    return {
+        'trace': args.trace,
+        'speed': args.speed,
+        'max_lateness_ms': lateness * 1000,
+        'recorded': summarize(recorded_outcomes(entries), recorded_time),
+        'replay': summarize(outcomes, wall_time),
+    }
+
+
+REPORT_KEYS = ['transfers', 'complete', 'error', 'timeout', 'p50_ms', 'p90_ms',
+               'p99_ms', 'mean_throughput', 'throughput', 'wall_time']
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.3f}'.format(value)
+    return str(value)
+
+
+def report(result, out=sys.stdout):
+    print('{:<16} {:>14} {:>14} {:>9}'.format(
+            '', 'recorded', 'replay x{:g}'.format(result['speed']), 'change'),
+          file=out)
+    for key in REPORT_KEYS:
+        old, new = result['recorded'][key], result['replay'][key]
+        change = ''
+        if old and new is not None:
+            change = '{:+.1f}%'.format((new - old) / old * 100)
+        print('{:<16} {:>14} {:>14} {:>9}'.format(
+                key, format_value(old), format_value(new), change), file=out)
+    print('Requests were started up to {:.1f} ms late.'.format(
+            result['max_lateness_ms']), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Replay a request trace against a test apts server.')
+    parser.add_argument('trace', help='trace file recorded by apts')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='speed-up of the request arrivals '
+                             '(default: %(default)s)')
+    parser.add_argument('--limit', type=int,
+                        help='only replay the first LIMIT requests')
+    parser.add_argument('--max-clients', type=int, default=512,
+                        help='maximum number of concurrent transfers '
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='client retransmission timeout in seconds')
+    parser.add_argument('-O', '--server-option', type=option_pair,
+                        action='append', metavar='KEY=VALUE',
+                        help='override a ServerConfig option of the '
+                             'server')
+    parser.add_argument('--server-log', default=os.devnull,
+                        help='file the server logs to')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Startup benchmark of apts: the time from starting a server until it sends
+the first DATA block of a read request.
+
+Two cases are measured, each a number of times:
+- cold, the apts command in a new Python process, compared with the time
+  the bare interpreter takes to start;
+- embedded, a TftpServer started with start() in this process and stopped
+  again with stop(), as a test suite would do.
+
+Examples:
+    python3 -m benchmarks.startup --runs 20
+    python3 -m benchmarks.startup -o startup.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+from apts.config import ServerConfig
+from apts.errors import PacketParseError
+from apts.packets import RRQPacket, DataPacket, PacketFactory
+from apts.server import TftpServer
+
+from .e2e import format_value, git_revision
+from .loadgen import free_port, percentile
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def first_block(address, start, deadline=10, interval=0.001):
+    """
+    Sends read requests to address every interval seconds, until a DATA
+    block arrives.
+
+    Returns the seconds from start until then.
+    Raises a RuntimeError if no block arrives within deadline seconds.
+    """
+    factory = PacketFactory()
+    request = RRQPacket(b'file', b'octet').to_wire()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(interval)
+        while time.perf_counter() - start < deadline:
+            sock.sendto(request, address)
+            try:
+                data, _ = sock.recvfrom(65536)
+                if isinstance(factory.create(data), DataPacket):
+                    return time.perf_counter() - start
+            except (socket.timeout, ConnectionRefusedError, PacketParseError):
+                pass
+    raise RuntimeError('the server did not answer')
+
+
+def interpreter_start():
+    """
+    Returns the seconds a bare Python interpreter takes to start and exit.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - start
+
+
+def cold_start(tftp_root):
+    """
+    Starts the apts command and returns the seconds until it sends a block.
+    """
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'bin', 'apts'),
+             '-c', os.devnull, '-r', tftp_root, '-H', '127.0.0.1',
+             '-p', str(port), '-l', 'WARNING', '--no-drop-privileges'],
+            env=env)
+    try:
+        return first_block(('127.0.0.1', port), start)
+    finally:
+        # SIGTERM would wait for the transfer of the probe to time out.
+        process.kill()
+        process.wait()
+
+
+def embedded_start(tftp_root):
+    """
+    Starts a TftpServer in this process and returns the seconds until it
+    sends a block.
+    """
+    start = time.perf_counter()
+    server = TftpServer(tftp_root, config=ServerConfig())
+    server.start('127.0.0.1', 0)
+    try:
+        return first_block(server.address, start)
+    finally:
+        server.stop(timeout=1)
+
+
+def summarize(times):
+    return {
+        'p50_ms': percentile(times, 50) * 1000,
+        'min_ms': min(times) * 1000,
+        'max_ms': max(times) * 1000,
+    }
+
+
+def run(args):
+    tftp_root = tempfile.mkdtemp(prefix='apts-startup-')
+    try:
+        with open(os.path.join(tftp_root, 'file'), 'wb') as f:
+            f.write(b'x' * 512)
+        interpreter = [interpreter_start() for _ in range(args.runs)]
+        cold = [cold_start(tftp_root) for _ in range(args.runs)]
+        embedded = [embedded_start(tftp_root) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(tftp_root)
+
+    return {
+        'revision': git_revision(),
+        'runs': args.runs,
+        'interpreter': summarize(interpreter),
+        'cold': summarize(cold),
+        'embedded': summarize(embedded),
+    }
+
+
+def report(result, out=sys.stdout):
+    print('{:<12} {:>10} {:>10} {:>10}'.format('', 'p50 ms', 'min ms',
+                                               'max ms'), file=out)
+    for case in ('interpreter', 'cold', 'embedded'):
+        stats = result[case]
+        print('{:<12} {:>10} {:>10} {:>10}'.format(
+                case, format_value(stats['p50_ms']),
+                format_value(stats['min_ms']), format_value(stats['max_ms'])),
+              file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Measure the time until a new server serves a block.')
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help='number of times each case is measured')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
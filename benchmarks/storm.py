@@ -0,0 +1,272 @@
+"""
+Boot storm benchmark of apts on the loopback interface.
+
+Many machines that power on at once send their first read request within
+a few milliseconds of each other. This benchmark sends a read request from
+each of a number of synthetic machines, each with its own socket, as fast
+as it can, and measures the time until every machine has received its
+first DATA block. Machines that get no answer send their request again
+with an exponential backoff, as PXE firmware does, so requests that the
+server drops show up as long tails.
+
+Each transfer is aborted with an error packet after its first block, so
+that only the handling of the requests is measured.
+
+With --provider, the machines request pxelinux configurations that a
+provider function renders, spread over --files distinct names, to measure
+how a provider copes with the storm.
+
+Examples:
+    python3 -m benchmarks.storm --machines 1000 -o storm.json
+    python3 -m benchmarks.storm -O receive_buffer=8388608
+    python3 -m benchmarks.storm --files 1000 \
+        --provider benchmarks.providers.pxelinux_config
+    python3 -m benchmarks.storm --compare base.json new.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import selectors
+
+from apts.control import send_command
+from apts.packets import RRQPacket, DataPacket, ErrorPacket, PacketFactory
+from apts.errors import PacketParseError
+
+from .e2e import format_value, git_revision, option_pair
+from .loadgen import ServerProcess, make_file, percentile
+
+
+class Machine:
+    """
+    A machine of the storm, waiting for the first DATA block of its file.
+    """
+    def __init__(self, sock, filename):
+        self.socket = sock
+        self.request = RRQPacket(filename.encode(), b'octet').to_wire()
+        self.first_data = None
+        self.retries = 0
+        self.retry_at = None
+
+
+def raise_file_limit(needed):
+    """
+    Raises the soft limit of open files, if needed, to fit a socket for
+    every machine.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        limit = needed if hard == resource.RLIM_INFINITY else min(hard, needed)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+
+def storm(address, machines, timeout, deadline):
+    """
+    Starts a machine for each socket of machines at once, and waits until
+    all of them have received a DATA block, or for deadline seconds.
+
+    Returns the list of seconds until each machine got its first block,
+    None for machines that got none, and the number of retries.
+    """
+    factory = PacketFactory()
+    abort = ErrorPacket(ErrorPacket.ERR_NOT_DEFINED, b'storm').to_wire()
+    selector = selectors.DefaultSelector()
+    for machine in machines:
+        selector.register(machine.socket, selectors.EVENT_READ, machine)
+
+    start = time.perf_counter()
+    for machine in machines:
+        machine.socket.sendto(machine.request, address)
+        machine.retry_at = start + timeout
+
+    waiting = len(machines)
+    end = start + deadline
+    while waiting:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        retry_at = min(m.retry_at for m in machines if m.first_data is None)
+        for key, _ in selector.select(max(0, min(retry_at, end) - now)):
+            machine = key.data
+            data, server = machine.socket.recvfrom(65536)
+            try:
+                packet = factory.create(data)
+            except PacketParseError:
+                continue
+            if not isinstance(packet, DataPacket):
+                continue
+            if machine.first_data is None:
+                machine.first_data = time.perf_counter() - start
+                waiting -= 1
+            # Every session of the request, also those started by retries,
+            # is aborted.
+            machine.socket.sendto(abort, server)
+
+        now = time.perf_counter()
+        for machine in machines:
+            if machine.first_data is None and machine.retry_at <= now:
+                machine.retries += 1
+                machine.socket.sendto(machine.request, address)
+                machine.retry_at = now + timeout * 2 ** machine.retries
+
+    selector.close()
+    return ([m.first_data for m in machines],
+            sum(m.retries for m in machines))
+
+
+def server_counters(control_socket):
+    """
+    Returns the listener counters of the server, read from its metrics.
+    """
+    counters = {}
+    for line in send_command(control_socket, 'metrics').splitlines():
+        if line.startswith('apts_listener_'):
+            name, value = line.split()
+            counters[name[len('apts_listener_'):]] = float(value)
+    return counters
+
+
+def run(args):
+    tftp_root = os.path.realpath(tempfile.mkdtemp(prefix='apts-storm-'))
+    control_socket = os.path.join(tftp_root, 'control.sock')
+    make_file(os.path.join(tftp_root, 'pxelinux.0'), args.size)
+
+    options = dict(args.server_option or [])
+    options['control_socket'] = control_socket
+    filenames = ['pxelinux.0']
+    if args.provider:
+        options['providers'] = [[r'^pxelinux\.cfg/01-([0-9a-f-]+)$',
+                                 args.provider]]
+        filenames = ['pxelinux.cfg/01-' + '-'.join(
+                '{:02x}'.format(n >> shift & 0xff)
+                for shift in (40, 32, 24, 16, 8, 0))
+                for n in range(args.files)]
+    server = ServerProcess(tftp_root, options=options,
+                           log_file=args.server_log, log_level='WARNING')
+    raise_file_limit(args.machines + 64)
+    machines = []
+    try:
+        server.start(probe='pxelinux.0')
+        for n in range(args.machines):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            machines.append(Machine(sock, filenames[n % len(filenames)]))
+
+        times, retries = storm(server.address, machines, args.timeout,
+                               args.deadline)
+        counters = server_counters(control_socket)
+    finally:
+        for machine in machines:
+            machine.socket.close()
+        server.stop()
+        shutil.rmtree(tftp_root, ignore_errors=True)
+
+    served = [t for t in times if t is not None]
+    result = {
+        'revision': git_revision(),
+        'machines': args.machines,
+        'served': len(served),
+        'retries': retries,
+        'retried_machines': sum(1 for m in machines if m.retries),
+        'kernel_drops': counters.get('kernel_drops'),
+        'batches': counters.get('batches'),
+        'last_ms': max(served) * 1000 if served else None,
+    }
+    for p in (50, 90, 99):
+        value = percentile(served, p)
+        result['p{}_ms'.format(p)] = value * 1000 if served else None
+    return result
+
+
+# (key, label, higher is better) of the reported values.
+REPORT_KEYS = [
+    ('machines', 'machines', True),
+    ('served', 'served', True),
+    ('retried_machines', 'retried', False),
+    ('retries', 'retries', False),
+    ('kernel_drops', 'kernel drops', False),
+    ('batches', 'batches', False),
+    ('p50_ms', 'p50 ms', False),
+    ('p90_ms', 'p90 ms', False),
+    ('p99_ms', 'p99 ms', False),
+    ('last_ms', 'last ms', False),
+]
+
+
+def report(result, out=sys.stdout):
+    for key, label, _ in REPORT_KEYS:
+        print('{:<14} {:>14}'.format(label, format_value(result[key])),
+              file=out)
+
+
+def compare(base, new, out=sys.stdout):
+    """
+    Prints the relative change of each reported value between two runs.
+    """
+    print('{:<14} {:>14} {:>14} {:>9}'.format(
+            '', base.get('revision') or 'base', new.get('revision') or 'new',
+            'change'), file=out)
+    for key, label, higher_is_better in REPORT_KEYS:
+        old, cur = base.get(key), new.get(key)
+        change = ''
+        if old and cur is not None:
+            delta = (cur - old) / old * 100
+            better = delta > 0 if higher_is_better else delta < 0
+            change = '{:+.1f}%{}'.format(delta, '' if better or not delta
+                                         else ' !')
+        print('{:<14} {:>14} {:>14} {:>9}'.format(
+                label, format_value(old), format_value(cur), change), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Boot storm benchmark of apts.')
+    parser.add_argument('-m', '--machines', type=int, default=1000,
+                        help='number of machines that start at once')
+    parser.add_argument('--size', type=int, default=42 * 1024,
+                        help='size of the requested file in bytes')
+    parser.add_argument('--provider', metavar='FUNCTION',
+                        help='dotted path of a provider function that '
+                             'renders the requested files')
+    parser.add_argument('--files', type=int, default=1,
+                        help='number of distinct files that the provider '
+                             'renders')
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='seconds before a machine first retries, '
+                             'doubled on every retry')
+    parser.add_argument('--deadline', type=float, default=60,
+                        help='seconds to wait for all the machines')
+    parser.add_argument('-O', '--server-option', type=option_pair,
+                        action='append', metavar='KEY=VALUE',
+                        help='override a ServerConfig option of the '
+                             'server, the value is parsed as JSON if '
+                             'possible')
+    parser.add_argument('--server-log', default=os.devnull,
+                        help='file the server logs to')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two saved results and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return 0
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
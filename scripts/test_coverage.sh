@@ -2,5 +2,5 @@
 # run tests and display coverage report
 
 cd ..
-coverage run --source='apts' --omit=apts/__init__.py,apts/config.py -m unittest
+coverage run --source='apts' --omit=apts/__init__.py -m unittest
 coverage report
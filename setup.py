@@ -7,7 +7,7 @@ from distutils.core import setup
 setup(
     name = apts.__name__,
     packages = [apts.__name__],
-    scripts = ['bin/apts'],
+    scripts = ['bin/apts', 'bin/apts-top', 'bin/apts-client'],
     version = apts.__version__,
     description = apts.__description__,
     author = apts.__author__,
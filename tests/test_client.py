@@ -0,0 +1,206 @@
+import os
+import shutil
+import socket
+import asyncio
+import argparse
+import unittest
+import threading
+from io import BytesIO
+from tempfile import mkdtemp
+
+from apts import netascii
+from apts.client import TftpClient, build_jobs, format_size
+from apts.config import ServerConfig
+from apts.errors import TftpTransferError, TftpTimeoutError
+from apts.packets import (DataPacket, ErrorPacket, OACKPacket, RRQPacket,
+                          PacketFactory)
+from apts.server import TftpServer
+
+
+class TestTftpClient(unittest.TestCase):
+    def test_request_options(self):
+        client = TftpClient('localhost')
+        self.assertEqual(client.request_options(), {})
+
+        client = TftpClient('localhost', block_size=1428, window_size=8)
+        self.assertEqual(client.request_options(tsize=0), {
+            b'blksize': b'1428', b'windowsize': b'8', b'tsize': b'0'})
+
+    def test_build_jobs(self):
+        args = argparse.Namespace(op='get', files=['a', 'dir/b'], list=None,
+                                  directory='/tmp', remote_directory=None)
+        self.assertEqual(build_jobs(args), [('get', 'a', '/tmp/a'),
+                                            ('get', 'dir/b', '/tmp/b')])
+
+        args.directory = None
+        self.assertEqual(build_jobs(args)[0], ('get', 'a', None))
+
+        args.op, args.remote_directory = 'put', 'uploads/'
+        self.assertEqual(build_jobs(args), [('put', 'uploads/a', 'a'),
+                                            ('put', 'uploads/b', 'dir/b')])
+
+    def test_format_size(self):
+        self.assertEqual(format_size(100), '100.0 B')
+        self.assertEqual(format_size(1536), '1.5 KB')
+        self.assertEqual(format_size(3 * 1024 ** 2), '3.0 MB')
+
+
+class TestTransfers(unittest.TestCase):
+    """
+    Round trips of the client against a server on loopback.
+    """
+    def setUp(self):
+        self.tftp_root = mkdtemp()
+        self.data = os.urandom(5000)
+        with open(os.path.join(self.tftp_root, 'file'), 'wb') as f:
+            f.write(self.data)
+        self.server = TftpServer(self.tftp_root, config=ServerConfig())
+        self.server.start('127.0.0.1', 0)
+
+    def tearDown(self):
+        self.server.stop(timeout=5)
+        shutil.rmtree(self.tftp_root)
+
+    def client(self, **options):
+        return TftpClient(*self.server.address, timeout=0.5, retries=2,
+                          **options)
+
+    def test_get(self):
+        local = BytesIO()
+        summary = asyncio.run(self.client().get('file', local))
+        self.assertEqual(local.getvalue(), self.data)
+        self.assertEqual((summary['bytes'], summary['block_size']),
+                         (5000, 512))
+
+    def test_get_window(self):
+        sizes = []
+        local = BytesIO()
+        client = self.client(block_size=100, window_size=4, tsize=True)
+        summary = asyncio.run(client.get('file', local,
+                                         on_start=sizes.append))
+        self.assertEqual(local.getvalue(), self.data)
+        self.assertEqual(sizes, [5000])
+        self.assertEqual((summary['block_size'], summary['window_size']),
+                         (100, 4))
+        self.assertEqual(summary['retransmits'], 0)
+
+    def test_put(self):
+        data = b'line\n' * 300
+        client = self.client(block_size=1000, window_size=2)
+        summary = asyncio.run(client.put(BytesIO(data), 'up/../new',
+                                         mode='netascii'))
+        self.assertEqual(summary['bytes'], len(netascii.encode(data)))
+        with open(os.path.join(self.tftp_root, 'new'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_concurrent(self):
+        async def run():
+            client = self.client(window_size=8)
+            return await asyncio.gather(*[client.get('file', local)
+                                          for local in locals])
+
+        locals = [BytesIO() for _ in range(5)]
+        asyncio.run(run())
+        for local in locals:
+            self.assertEqual(local.getvalue(), self.data)
+
+    def test_error(self):
+        with self.assertRaises(TftpTransferError) as cm:
+            asyncio.run(self.client().get('missing'))
+        self.assertEqual(cm.exception.error_code,
+                         ErrorPacket.ERR_FILE_NOT_FOUND)
+
+
+class TestOptionNegotiation(unittest.TestCase):
+    """
+    The client rejects an OACK that grants options it did not ask for, or
+    larger sizes than it asked for.
+    """
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+
+    def tearDown(self):
+        self.server.close()
+
+    def answer(self, options, received):
+        data, address = self.server.recvfrom(2048)
+        received.append(PacketFactory().create(data))
+        self.server.sendto(OACKPacket(options).to_wire(), address)
+        data, address = self.server.recvfrom(2048)
+        received.append(PacketFactory().create(data))
+
+    def get(self, options, **client_options):
+        received = []
+        thread = threading.Thread(target=self.answer,
+                                  args=(options, received))
+        thread.start()
+        client = TftpClient(*self.server.getsockname(), timeout=0.5,
+                            retries=0, **client_options)
+        try:
+            with self.assertRaises(TftpTransferError) as cm:
+                asyncio.run(client.get('file'))
+        finally:
+            thread.join(5)
+        self.assertIsInstance(received[0], RRQPacket)
+        self.assertIsInstance(received[1], ErrorPacket)
+        self.assertEqual(received[1].error_code,
+                         ErrorPacket.ERR_OPTION_NEGOTIATION)
+        self.assertEqual(cm.exception.error_code,
+                         ErrorPacket.ERR_OPTION_NEGOTIATION)
+
+    def test_unrequested_option(self):
+        self.get({b'windowsize': b'4'}, block_size=1024)
+
+    def test_larger_block_size(self):
+        self.get({b'blksize': b'2048'}, block_size=1024)
+
+    def test_larger_window_size(self):
+        self.get({b'windowsize': b'16'}, window_size=8)
+
+    def test_invalid_value(self):
+        self.get({b'blksize': b'large'}, block_size=1024)
+
+    def test_timeout(self):
+        client = TftpClient(*self.server.getsockname(), timeout=0.05,
+                            retries=1)
+        with self.assertRaises(TftpTimeoutError):
+            asyncio.run(client.get('file'))
+
+
+class TestRetransmissions(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+
+    def tearDown(self):
+        self.server.close()
+
+    def serve(self, acks):
+        factory = PacketFactory()
+        _, address = self.server.recvfrom(2048)
+        # Answers must come at once, not on a timeout of the client.
+        self.server.settimeout(0.5)
+        for packet in [DataPacket(1, b'a' * 512)] * 3 + [DataPacket(2, b'b')]:
+            self.server.sendto(packet.to_wire(), address)
+            data, address = self.server.recvfrom(2048)
+            acks.append(factory.create(data).blockn)
+
+    def test_lost_acks(self):
+        """
+        Every retransmission of the last block received is acknowledged
+        again, however many of the ACKs are lost.
+        """
+        acks = []
+        thread = threading.Thread(target=self.serve, args=(acks,))
+        thread.start()
+        local = BytesIO()
+        client = TftpClient(*self.server.getsockname(), timeout=2, retries=0)
+        try:
+            asyncio.run(client.get('file', local))
+        finally:
+            thread.join(5)
+        self.assertEqual(acks, [1, 1, 1, 2])
+        self.assertEqual(local.getvalue(), b'a' * 512 + b'b')
@@ -0,0 +1,78 @@
+import os
+import logging
+import unittest
+from tempfile import mkstemp
+
+from apts.config import ServerConfig
+from apts.errors import ParseConfigError
+
+
+class TestServerConfig(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def test_defaults(self):
+        config = ServerConfig(port=6969)
+        self.assertEqual((config.port, config.tftp_root), (6969, '/srv/tftp/'))
+        self.assertIsNot(config.subnet_rates, ServerConfig().subnet_rates)
+        self.assertRaises(TypeError, ServerConfig, prot=6969)
+
+    def test_from_file(self):
+        self.write('[SERVER]\n'
+                   'port = 6969\n'
+                   'writable = False\n'
+                   'path_mtu = False\n'
+                   'transfer_ports = 50000-50099\n'
+                   '[LOGGING]\n'
+                   'level = debug\n'
+                   '[SHAPING]\n'
+                   'subnet_rates = 10.0.0.0/8=1000\n'
+                   '[RELAY]\n'
+                   'upstream = tftp.example.com\n'
+                   '[INDEX]\n'
+                   'enabled = True\n'
+                   'aliases =\n'
+                   '    ^pxelinux\\.0$ boot/pxelinux.0\n'
+                   '[PROVIDERS]\n'
+                   'files = ^cfg/ tests.test_providers.pxelinux_config\n'
+                   '[FILE_CLASSES]\n'
+                   'images = 500 *.img *.iso\n')
+        config = ServerConfig.from_file(self.path, port=7000)
+
+        self.assertEqual(config.port, 7000)
+        self.assertFalse(config.writable)
+        self.assertFalse(config.path_mtu)
+        self.assertEqual(config.transfer_ports, (50000, 50099))
+        self.assertEqual(config.log_level, logging.DEBUG)
+        self.assertEqual(config.subnet_rates, [('10.0.0.0/8', 1000)])
+        self.assertEqual(config.relay_upstream, ('tftp.example.com', 69))
+        self.assertTrue(config.file_index)
+        self.assertEqual(config.index_aliases,
+                         [(r'^pxelinux\.0$', 'boot/pxelinux.0')])
+        self.assertEqual(config.providers,
+                         [('^cfg/', 'tests.test_providers.pxelinux_config')])
+        self.assertEqual(config.file_classes,
+                         [('images', 500, ['*.img', '*.iso'])])
+
+    def test_missing_file(self):
+        config = ServerConfig.from_file(self.path + '.missing')
+        self.assertEqual(config.port, 69)
+
+    def test_errors(self):
+        for text in ('[SERVER]\nport = tftp\n',
+                     '[SERVER]\nwritable = yes\n',
+                     '[LOGGING]\nlevel = LOUD\n',
+                     '[INDEX]\naliases = (unclosed x\n',
+                     '[PROVIDERS]\nfiles = ^cfg/ no.such.function\n',
+                     'port = 69\n'):
+            self.write(text)
+            self.assertRaises(ParseConfigError, ServerConfig.from_file,
+                              self.path)
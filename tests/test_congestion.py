@@ -0,0 +1,86 @@
+import unittest
+
+from apts.congestion import (CongestionController, PacedController,
+                             AIMDController, Pacer, load_controller)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestControllers(unittest.TestCase):
+    def test_pacing_interval(self):
+        self.assertEqual(CongestionController().pacing_interval(0.1, 8), 0)
+        paced = PacedController()
+        self.assertEqual(paced.pacing_interval(None, 8), 0)
+        self.assertAlmostEqual(paced.pacing_interval(0.08, 8), 0.0025)
+
+    def test_aimd(self):
+        aimd = AIMDController()
+        self.assertEqual(aimd.cwnd, 4)
+        # Slow start, up to the window size.
+        aimd.on_ack(8, 16)
+        aimd.on_ack(16, 16)
+        self.assertEqual(aimd.cwnd, 16)
+
+        aimd.on_loss()
+        self.assertEqual((aimd.cwnd, aimd.ssthresh), (8, 8))
+        aimd.on_ack(16, 16)
+        aimd.on_ack(16, 16)
+        self.assertEqual(aimd.cwnd, 10)
+        # Fewer blocks per round trip mean longer gaps.
+        self.assertAlmostEqual(aimd.pacing_interval(0.08, 16), 0.002)
+
+        aimd.on_timeout()
+        self.assertEqual((aimd.cwnd, aimd.ssthresh), (1, 5))
+        aimd.on_ack(16, 16)
+        self.assertEqual(aimd.cwnd, 2)
+
+    def test_load_controller(self):
+        self.assertIs(load_controller('aimd'), AIMDController)
+        self.assertIs(load_controller('apts.congestion.PacedController'),
+                      PacedController)
+        for name in ('cubic', 'apts.congestion.Cubic', 'no.such.Module'):
+            self.assertRaises(ValueError, load_controller, name)
+
+
+class TestPacer(unittest.TestCase):
+    def test_wait(self):
+        clock = FakeClock()
+        pacer = Pacer(clock, clock.sleep)
+        for _ in range(3):
+            pacer.wait(0.002)
+        self.assertEqual(clock.slept, [0.002, 0.002])
+
+    def test_short_intervals(self):
+        """
+        Intervals shorter than the quantum go out as bursts.
+        """
+        clock = FakeClock()
+        pacer = Pacer(clock, clock.sleep)
+        for _ in range(5):
+            pacer.wait(0.0004)
+        self.assertEqual(len(clock.slept), 1)
+        self.assertAlmostEqual(clock.now, 0.0012)
+
+    def test_idle(self):
+        """
+        A pause gives no credit for a burst afterwards.
+        """
+        clock = FakeClock()
+        pacer = Pacer(clock, clock.sleep)
+        pacer.wait(0.002)
+        clock.now = 10
+        pacer.wait(0.002)
+        pacer.wait(0.002)
+        self.assertEqual(len(clock.slept), 1)
+        self.assertAlmostEqual(clock.slept[0], 0.002)
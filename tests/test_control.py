@@ -0,0 +1,80 @@
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+
+from apts.control import ControlServer, inherited_control_socket, send_command
+
+
+class TestControlServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'apts.sock')
+        self.server = ControlServer(self.path)
+        self.server.register('echo', lambda *args: ' '.join(args) + '\n')
+        self.server.register('fail', lambda: 1 / 0)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.assertEqual(send_command(self.path, 'echo a  b'), 'a b\n')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_errors(self):
+        self.assertEqual(send_command(self.path, 'nope'),
+                         'error: unknown command nope\n')
+        self.assertEqual(send_command(self.path, ''), '')
+        with self.assertLogs(level='ERROR'):
+            response = send_command(self.path, 'fail')
+        self.assertEqual(response, 'error: division by zero\n')
+        # Wrong arguments fail the command, not the server.
+        with self.assertLogs(level='ERROR'):
+            response = send_command(self.path, 'fail x')
+        self.assertTrue(response.startswith('error: '))
+        self.assertEqual(send_command(self.path, 'echo ok'), 'ok\n')
+
+    def test_stop(self):
+        """
+        The socket is removed on stop, unless another server has bound a new
+        one at the same path.
+        """
+        self.server.stop()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertRaises(OSError, send_command, self.path, 'echo')
+
+        self.server = ControlServer(self.path)
+        self.server.start()
+        other = ControlServer(self.path)
+        other.register('echo', lambda: 'other\n')
+        other.start()
+        self.server.stop()
+        self.server = other
+        self.assertEqual(send_command(self.path, 'echo'), 'other\n')
+
+    def test_hand_over(self):
+        """
+        A socket handed over to another server keeps its path, and is
+        served by the other server alone.
+        """
+        fd = os.dup(self.server.fileno())
+        with mock.patch.dict(os.environ, APTS_CONTROL_FD=str(fd)):
+            sock = inherited_control_socket(self.path)
+            self.assertNotIn('APTS_CONTROL_FD', os.environ)
+        other = ControlServer(self.path, sock)
+        other.register('echo', lambda: 'other\n')
+        other.start()
+        self.server.hand_over()
+        self.server = other
+        self.assertEqual(send_command(self.path, 'echo'), 'other\n')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_inherited_other_path(self):
+        fd = os.dup(self.server.fileno())
+        with mock.patch.dict(os.environ, APTS_CONTROL_FD=str(fd)):
+            self.assertIsNone(inherited_control_socket(self.path + '.new'))
+        self.assertRaises(OSError, os.fstat, fd)
+        self.assertIsNone(inherited_control_socket(self.path))
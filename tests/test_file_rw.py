@@ -3,6 +3,7 @@ import math
 import random
 import string
 import unittest
+from io import BytesIO
 from tempfile import NamedTemporaryFile
 
 from apts import netascii
@@ -42,6 +43,45 @@ class TestTftpFileReader(unittest.TestCase):
         self._test_read_from_closed_file('netascii')
         self._test_read_from_closed_file('octet')
 
+    def test_block_size(self):
+        fr = TftpFileReader(BytesIO(LOREM_IPSUM), 'octet', block_size=100)
+        self.assertEqual(fr.get_next_block(), LOREM_IPSUM[:100])
+        self.assertEqual(read_whole_file(fr), LOREM_IPSUM[100:])
+
+        fr = TftpFileReader(BytesIO(LOREM_IPSUM), 'netascii', block_size=100)
+        self.assertEqual(read_whole_file(fr), netascii.encode(LOREM_IPSUM))
+
+    def test_file_object(self):
+        """
+        File objects are read from, but not closed.
+        """
+        f = BytesIO(LOREM_IPSUM)
+        fr = TftpFileReader(f, 'octet')
+        self.assertEqual(read_whole_file(fr), LOREM_IPSUM)
+        self.assertFalse(f.closed)
+
+    def test_netascii_block_boundary(self):
+        """
+        An encoded file that ends on a block boundary ends with an empty
+        block.
+        """
+        fr = TftpFileReader(BytesIO(b'a' * 1024), 'netascii')
+        self.assertEqual(fr.get_next_block(), b'a' * 512)
+        self.assertEqual(fr.get_next_block(), b'a' * 512)
+        self.assertEqual(fr.get_next_block(), b'')
+        self.assertRaises(TftpIOError, fr.get_next_block)
+
+    def test_seek(self):
+        encoded = netascii.encode(LOREM_IPSUM)
+        for offset in (0, 100, 512, len(encoded)):
+            fr = TftpFileReader(BytesIO(LOREM_IPSUM), 'netascii')
+            fr.seek(offset)
+            self.assertEqual(read_whole_file(fr), encoded[offset:])
+
+        fr = TftpFileReader(BytesIO(LOREM_IPSUM), 'octet')
+        fr.seek(300)
+        self.assertEqual(read_whole_file(fr), LOREM_IPSUM[300:])
+
     def _test_read_from_closed_file(self, mode):
         """
         When trying to read from a closed file, a TftpIOError should be raised.
@@ -86,6 +126,19 @@ class TestTftpFileWriter(unittest.TestCase):
         self._test_write_to_closed_file('netascii')
         self._test_write_to_closed_file('octet')
 
+    def test_netascii_cr_across_blocks(self):
+        """
+        A CR at the end of a block is decoded with the start of the next one.
+        """
+        data = b'a' * 99 + b'\r\nb' + b'\r\x00' * 60 + b'c'
+        f = BytesIO()
+        fw = TftpFileWriter(f, 'netascii', block_size=100)
+        write_whole_file(fw, data)
+
+        self.assertTrue(fw.closed)
+        self.assertFalse(f.closed)
+        self.assertEqual(f.getvalue(), netascii.decode(data))
+
     def _test_write_to_closed_file(self, mode):
         """
         When trying to write to a closed file, a TftpIOError should be raised.
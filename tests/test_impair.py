@@ -0,0 +1,50 @@
+import unittest
+
+from benchmarks.impair import Impairment
+
+
+class TestImpairment(unittest.TestCase):
+    def decisions(self, seed):
+        impairment = Impairment(loss=0.2, jitter=0.01, duplicate=0.1,
+                                reorder=0.1, seed=seed)
+        return [impairment.delays(512, n * 0.001) for n in range(1000)], \
+            impairment.stats()
+
+    def test_seed(self):
+        """
+        The same seed impairs the same packets in the same way.
+        """
+        self.assertEqual(self.decisions(1), self.decisions(1))
+        self.assertNotEqual(self.decisions(1), self.decisions(2))
+
+        delays, stats = self.decisions(1)
+        self.assertEqual(stats['dropped'], delays.count([]))
+        self.assertEqual(stats['duplicated'],
+                         sum(len(copies) == 2 for copies in delays))
+        self.assertTrue(all(0 <= delay for copies in delays
+                            for delay in copies))
+
+    def test_no_impairment(self):
+        impairment = Impairment()
+        self.assertFalse(impairment)
+        self.assertEqual(impairment.delays(512, 10), [0])
+
+    def test_bottleneck(self):
+        """
+        Packets queue behind each other at the rate of the bottleneck, and
+        are dropped once they overflow its queue.
+        """
+        impairment = Impairment(rate=1000, queue=1500)
+        self.assertTrue(impairment)
+        # A burst of three packets of 500 bytes at once fills the queue.
+        self.assertEqual([impairment.delays(500, 0) for _ in range(3)],
+                         [[0.5], [1.0], [1.5]])
+        # The tail of the burst is dropped.
+        self.assertEqual(impairment.delays(500, 0), [])
+        self.assertEqual(impairment.stats()['overflowed'], 1)
+
+        # Once the queue has drained, packets go through again.
+        self.assertEqual(impairment.delays(500, 1), [1.0])
+        delay, = impairment.delays(100, 10)
+        self.assertAlmostEqual(delay, 0.1)
+        self.assertEqual(impairment.stats()['forwarded'], 5)
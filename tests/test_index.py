@@ -0,0 +1,66 @@
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from apts.index import FileIndex
+from apts.memory import MemoryAccountant
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tftp_root = os.path.realpath(mkdtemp())
+        for path in ('pxelinux.0', 'BOOT/EFI/grubx64.efi',
+                     'pxelinux.cfg/default', 'pxelinux.cfg/Default'):
+            self.create(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tftp_root)
+
+    def create(self, path):
+        path = os.path.join(self.tftp_root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x')
+
+    def test_lookup(self):
+        index = FileIndex(self.tftp_root)
+        self.assertEqual(index.lookup('/pxelinux.0'), 'pxelinux.0')
+        self.assertEqual(index.lookup('boot\\efi\\GRUBX64.EFI'),
+                         'BOOT/EFI/grubx64.efi')
+        self.assertEqual(index.lookup('BOOT//./EFI/../EFI/grubx64.efi'),
+                         'BOOT/EFI/grubx64.efi')
+        # Of files that differ only in case, the one in lower case wins.
+        self.assertEqual(index.lookup('PXELINUX.CFG/DEFAULT'),
+                         'pxelinux.cfg/default')
+        self.assertIsNone(index.lookup('../pxelinux.0/x'))
+        self.assertIsNone(index.lookup('pxelinux.cfg'))
+        self.assertEqual((index.hits, index.misses), (4, 2))
+
+    def test_no_normalization(self):
+        index = FileIndex(self.tftp_root, case_fold=False, backslashes=False)
+        self.assertEqual(index.lookup('pxelinux.cfg/Default'),
+                         'pxelinux.cfg/Default')
+        self.assertIsNone(index.lookup('boot/efi/grubx64.efi'))
+        self.assertIsNone(index.lookup('BOOT\\EFI\\grubx64.efi'))
+
+    def test_aliases(self):
+        index = FileIndex(self.tftp_root, aliases=[
+                (r'^(.*)\.efi$', r'boot/efi/\1.efi'),
+                (r'^pxelinux\.cfg/01-.*$', 'pxelinux.cfg/default'),
+                (r'\.efi$', 'never.applies')])
+        self.assertEqual(index.lookup('grubx64.efi'), 'BOOT/EFI/grubx64.efi')
+        self.assertEqual(index.lookup('pxelinux.cfg/01-aa-bb-cc-dd-ee-ff'),
+                         'pxelinux.cfg/default')
+
+    def test_rescan(self):
+        memory = MemoryAccountant()
+        index = FileIndex(self.tftp_root, memory=memory)
+        self.assertEqual(memory.usage(), {'file_index': index.size})
+
+        self.create('new/FILE')
+        self.assertIsNone(index.lookup('new/file'))
+        index.rescan()
+        self.assertEqual(index.lookup('new/file'), 'new/FILE')
+        self.assertEqual(index.stats()['files'], 4)
+        self.assertEqual(memory.usage(), {'file_index': index.size})
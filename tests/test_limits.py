@@ -0,0 +1,55 @@
+import unittest
+
+from apts.limits import SessionLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSessionLimiter(unittest.TestCase):
+    def test_session_rate(self):
+        clock = FakeClock()
+        limiter = SessionLimiter(rate=2, clock=clock)
+
+        self.assertTrue(limiter.admit('10.0.0.1'))
+        self.assertTrue(limiter.admit('10.0.0.1'))
+        self.assertFalse(limiter.admit('10.0.0.1'))
+        # Other sources have their own bucket.
+        self.assertTrue(limiter.admit('10.0.0.2'))
+
+        clock.now += 0.5
+        self.assertTrue(limiter.admit('10.0.0.1'))
+
+        stats = limiter.stats()
+        self.assertEqual(stats['admitted'], 4)
+        self.assertEqual(stats['dropped_rate'], 1)
+
+    def test_max_sessions(self):
+        limiter = SessionLimiter(max_sessions=2)
+
+        self.assertTrue(limiter.admit('10.0.0.1'))
+        self.assertTrue(limiter.admit('10.0.0.1'))
+        self.assertFalse(limiter.admit('10.0.0.1'))
+        self.assertEqual(limiter.stats()['active'], 2)
+
+        limiter.release('10.0.0.1')
+        self.assertTrue(limiter.admit('10.0.0.1'))
+        self.assertEqual(limiter.stats()['dropped_sessions'], 1)
+
+    def test_prune(self):
+        clock = FakeClock()
+        limiter = SessionLimiter(rate=1, clock=clock)
+        limiter.max_sources = 2
+
+        for ip in ('10.0.0.1', '10.0.0.2'):
+            limiter.admit(ip)
+            limiter.release(ip)
+        clock.now += 10
+
+        limiter.admit('10.0.0.3')
+        self.assertEqual(list(limiter._buckets), ['10.0.0.3'])
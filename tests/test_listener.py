@@ -0,0 +1,114 @@
+import socket
+import threading
+import unittest
+
+from apts.listener import (RequestListener, RequestDispatcher, client_ip,
+                           format_address)
+
+
+def ipv6_available():
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.bind(('::1', 0))
+        return True
+    except OSError:
+        return False
+
+
+class TestRequestListener(unittest.TestCase):
+    def setUp(self):
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.client.close()
+
+    def send(self, listener, datagrams):
+        address = listener.socket.getsockname()
+        for data in datagrams:
+            self.client.sendto(data, address)
+
+    def test_batch(self):
+        listener = RequestListener('127.0.0.1', 0)
+        self.addCleanup(listener.close)
+        requests = [str(i).encode() for i in range(10)]
+        self.send(listener, requests)
+
+        batch = listener.receive()
+        self.assertEqual([data for data, _ in batch], requests)
+        self.assertEqual(batch[0][1], self.client.getsockname())
+        self.assertEqual(listener.stats()['batches'], 1)
+        self.assertEqual(listener.stats()['received'], 10)
+
+    def test_batch_size(self):
+        listener = RequestListener('127.0.0.1', 0)
+        self.addCleanup(listener.close)
+        listener.batch_size = 4
+        self.send(listener, [b'x'] * 6)
+        self.assertEqual(len(listener.receive()), 4)
+        self.assertEqual(len(listener.receive()), 2)
+
+    def test_kernel_drops(self):
+        listener = RequestListener('127.0.0.1', 0, receive_buffer=4096)
+        self.addCleanup(listener.close)
+        if not listener.track_drops:
+            self.skipTest('SO_RXQ_OVFL is not supported')
+
+        self.send(listener, [b'x' * 1000] * 200)
+        received = len(listener.receive())
+        # The drops are reported with the next datagram.
+        self.send(listener, [b'x'])
+        listener.receive()
+        self.assertGreater(listener.kernel_drops, 0)
+        self.assertEqual(received + listener.kernel_drops, 200)
+
+
+    @unittest.skipUnless(ipv6_available(), 'IPv6 is not available')
+    def test_dual_stack(self):
+        listener = RequestListener('::', 0)
+        self.addCleanup(listener.close)
+        port = listener.socket.getsockname()[1]
+        self.client.sendto(b'4', ('127.0.0.1', port))
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as client6:
+            client6.sendto(b'6', ('::1', port))
+            received = []
+            while len(received) < 2:
+                received += listener.receive()
+        received.sort()
+        self.assertEqual([client_ip(address) for _, address in received],
+                         ['127.0.0.1', '::1'])
+
+        listener = RequestListener('::', 0, ipv6_only=True)
+        self.addCleanup(listener.close)
+        self.assertEqual(listener.socket.getsockopt(
+                socket.IPPROTO_IPV6, socket.IPV6_V6ONLY), 1)
+
+    def test_client_ip(self):
+        self.assertEqual(client_ip(('10.0.0.1', 69)), '10.0.0.1')
+        self.assertEqual(client_ip(('::ffff:10.0.0.1', 69, 0, 0)), '10.0.0.1')
+        self.assertEqual(client_ip(('2001:db8::1', 69, 0, 0)), '2001:db8::1')
+        self.assertEqual(format_address(('10.0.0.1', 69)), '10.0.0.1:69')
+        self.assertEqual(format_address(('2001:db8::1', 69, 0, 0)),
+                         '[2001:db8::1]:69')
+
+class TestRequestDispatcher(unittest.TestCase):
+    def test_dispatch(self):
+        handled = []
+        done = threading.Event()
+
+        def handler(data, address):
+            handled.append((data, address))
+            if len(handled) == 3:
+                done.set()
+
+        dispatcher = RequestDispatcher(handler)
+        dispatcher.start()
+        for i in range(3):
+            dispatcher.dispatch(bytes([i]), ('10.0.0.1', i))
+        self.assertTrue(done.wait(5))
+        dispatcher.stop()
+        dispatcher.join(5)
+
+        self.assertEqual(handled, [(bytes([i]), ('10.0.0.1', i))
+                                   for i in range(3)])
+        self.assertEqual(dispatcher.stats()['queued'], 0)
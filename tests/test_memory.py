@@ -0,0 +1,61 @@
+import unittest
+
+from apts.memory import MemoryAccountant
+
+
+class FakeCache:
+    def __init__(self, sizes):
+        self.sizes = list(sizes)
+
+    def usage(self):
+        return sum(self.sizes)
+
+    def evict(self, nbytes):
+        evicted = 0
+        while self.sizes and evicted < nbytes:
+            evicted += self.sizes.pop(0)
+        return evicted
+
+
+class TestMemoryAccountant(unittest.TestCase):
+    def test_usage(self):
+        memory = MemoryAccountant()
+        cache = FakeCache([100, 200])
+        memory.add_cache('cache', cache.usage, cache.evict)
+        memory.charge('sessions', 50)
+        memory.charge('sessions', 30)
+        memory.release('sessions', 50)
+        self.assertEqual(memory.usage(), {'sessions': 30, 'cache': 300})
+
+        # Without a budget, nothing is evicted or refused.
+        self.assertTrue(memory.reserve('sessions', 10 ** 9))
+        self.assertEqual(cache.sizes, [100, 200])
+
+    def test_evict_caches_first(self):
+        memory = MemoryAccountant(1000)
+        first, second = FakeCache([300, 300]), FakeCache([200])
+        memory.add_cache('first', first.usage, first.evict)
+        memory.add_cache('second', second.usage, second.evict)
+
+        self.assertTrue(memory.reserve('sessions', 400))
+        self.assertEqual((first.sizes, second.sizes), ([300], [200]))
+        self.assertTrue(memory.reserve('sessions', 500))
+        self.assertEqual((first.sizes, second.sizes), ([], []))
+
+        # Nothing is left to evict, so new sessions are refused.
+        self.assertFalse(memory.reserve('sessions', 200))
+        self.assertEqual(memory.stats(), {'used': 900, 'budget': 1000,
+                                          'evicted': 800, 'refused': 1})
+        memory.release('sessions', 400)
+        self.assertTrue(memory.reserve('sessions', 200))
+
+    def test_charge_over_budget(self):
+        """
+        Buffers that grow are charged even over the budget, after evicting
+        what the caches can give.
+        """
+        memory = MemoryAccountant(100)
+        cache = FakeCache([50])
+        memory.add_cache('cache', cache.usage, cache.evict)
+        memory.charge('sessions', 150)
+        self.assertEqual(memory.usage(), {'sessions': 150, 'cache': 0})
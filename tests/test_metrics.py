@@ -0,0 +1,117 @@
+import os
+import time
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import Mock
+
+from apts.metrics import MetricsRegistry, ServerMetrics, PrometheusFileWriter
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_counter_and_gauge(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('requests_total', 'Requests.', ('op',))
+        gauge = registry.gauge('active', 'Active sessions.')
+        computed = registry.gauge('computed', 'Computed value.')
+
+        counter.labels('RRQ').inc()
+        counter.labels('RRQ').inc(2)
+        counter.labels('WRQ').inc()
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        computed.set_function(lambda: 42)
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{op="RRQ"} 3',
+            'requests_total{op="WRQ"} 1',
+            '# HELP active Active sessions.',
+            '# TYPE active gauge',
+            'active 1',
+            '# HELP computed Computed value.',
+            '# TYPE computed gauge',
+            'computed 42',
+        ]) + '\n')
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('rtt', 'Round-trip time.', (1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.samples(), [
+            ('rtt_bucket', [('le', '1')], 2),
+            ('rtt_bucket', [('le', '5')], 3),
+            ('rtt_bucket', [('le', '+Inf')], 4),
+            ('rtt_sum', [], 14.5),
+            ('rtt_count', [], 4),
+        ])
+
+
+class TestServerMetrics(unittest.TestCase):
+    def finished(self, opname, outcome, bytes_sent, transferred):
+        protocol = Mock(opname=opname, bytes_sent=bytes_sent,
+                        transferred=transferred)
+        protocol.summary.return_value = {'outcome': outcome, 'duration': 2,
+                                         'throughput': 1000}
+        return protocol
+
+    def test_transfer_finished(self):
+        metrics = ServerMetrics()
+        metrics.transfer_finished(self.finished('RRQ', 'complete', 1500, 1000))
+        metrics.transfer_finished(self.finished('RRQ', 'timeout', 100, 200))
+        metrics.transfer_finished(self.finished('WRQ', 'complete', 0, 5000))
+
+        self.assertEqual(metrics.transfers.labels('complete').value, 2)
+        self.assertEqual(metrics.transfers.labels('timeout').value, 1)
+        # Only sent file data counts as resent.
+        self.assertEqual(metrics.resent_bytes.value, 500)
+        self.assertIn(('apts_transfer_duration_seconds_count', [], 2),
+                      metrics.duration.samples())
+        self.assertIn(('apts_transfer_throughput_bytes_per_second_sum', [],
+                       2000), metrics.throughput.samples())
+
+
+class TestPrometheusFileWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'apts.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('requests_total', 'Requests.')
+        writer = PrometheusFileWriter(registry, self.path)
+        writer.write()
+        counter.inc()
+        writer.write()
+
+        with open(self.path) as f:
+            self.assertEqual(f.read(), registry.render())
+        self.assertEqual(os.listdir(self.directory), ['apts.prom'])
+
+    def test_thread(self):
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Requests.')
+        writer = PrometheusFileWriter(registry, self.path, interval=0.01)
+        writer.start()
+        for _ in range(500):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.01)
+        writer.stop()
+        writer.join(1)
+        self.assertFalse(writer.is_alive())
+        with open(self.path) as f:
+            self.assertIn('requests_total 0', f.read())
+
+    def test_error(self):
+        writer = PrometheusFileWriter(MetricsRegistry(),
+                                      os.path.join(self.path, 'missing'))
+        with self.assertLogs(level='ERROR'):
+            writer.write()
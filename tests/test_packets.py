@@ -2,7 +2,7 @@ import struct
 import unittest
 
 from apts.packets import (RQPacket, RRQPacket, WRQPacket, DataPacket,
-                          ACKPacket, ErrorPacket, PacketFactory)
+                          ACKPacket, ErrorPacket, OACKPacket, PacketFactory)
 from apts.errors import (DataSizeError, OpcodeExtractError, PayloadParseError,
                          InvalidOpcodeError, InvalidErrorcodeError, UnsupportedModeError)
 
@@ -16,6 +16,19 @@ class TestRQPacket(unittest.TestCase):
         self.assertEqual(filename, packet.filename)
         self.assertEqual(mode, packet.mode)
 
+    def test_options(self):
+        raw_data = b'file\x00octet\x00BLKSIZE\x001428\x00tsize\x000\x00'
+        packet = RQPacket.from_wire(raw_data)
+        self.assertEqual(packet.options, {b'blksize': b'1428', b'tsize': b'0'})
+
+        packet = RRQPacket(b'file', b'octet', {b'blksize': b'1428'})
+        self.assertEqual(packet.to_wire()[2:],
+                         b'file\x00octet\x00blksize\x001428\x00')
+
+        # An option without a value is ignored.
+        packet = RQPacket.from_wire(b'file\x00octet\x00blksize\x00')
+        self.assertEqual(packet.options, {})
+
     def test_from_wire_bad_input(self):
         raw_data = 'blahblahblahblah'.encode()
 
@@ -104,6 +117,15 @@ class TestDataPacket(unittest.TestCase):
             data = ('d' * 552).encode()
             packet = DataPacket(1, data)
 
+    def test_block_size(self):
+        packet = DataPacket(1, b'd' * 1024, block_size=1428)
+        self.assertTrue(packet.is_last)
+        packet = DataPacket(1, b'd' * 1428, block_size=1428)
+        self.assertFalse(packet.is_last)
+
+        packet = DataPacket.from_wire(struct.pack('!H', 1) + b'd' * 1428)
+        self.assertEqual(len(packet.data), 1428)
+
 
 class TestACKPacket(unittest.TestCase):
     def test_opcode(self):
@@ -177,6 +199,25 @@ class TestErrorPacket(unittest.TestCase):
         self.assertTrue(packet.error_msg)
 
 
+class TestOACKPacket(unittest.TestCase):
+    def test_opcode(self):
+        """
+        OACK packets opcode must be 6.
+        """
+        packet = OACKPacket({})
+        self.assertEqual(packet.opcode, 6)
+
+    def test_from_wire(self):
+        packet = OACKPacket.from_wire(b'BLKSIZE\x001428\x00tsize\x00100\x00')
+        self.assertEqual(packet.options, {b'blksize': b'1428', b'tsize': b'100'})
+
+    def test_to_wire(self):
+        packet = OACKPacket({b'blksize': b'1428', b'windowsize': b'8'})
+        raw_data = b''.join((struct.pack('!H', 6), b'blksize\x001428\x00',
+                             b'windowsize\x008\x00'))
+        self.assertEqual(packet.to_wire(), raw_data)
+
+
 class TestPacketFactory(unittest.TestCase):
     def test_create_good_input(self):
         factory = PacketFactory()
@@ -189,6 +230,8 @@ class TestPacketFactory(unittest.TestCase):
         self.assertTrue(isinstance(factory.create(p.to_wire()), ACKPacket))
         p = ErrorPacket(1)
         self.assertTrue(isinstance(factory.create(p.to_wire()), ErrorPacket))
+        p = OACKPacket({b'blksize': b'1024'})
+        self.assertTrue(isinstance(factory.create(p.to_wire()), OACKPacket))
 
     def test_create_bad_input(self):
         factory = PacketFactory()
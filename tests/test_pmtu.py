@@ -0,0 +1,65 @@
+import sys
+import unittest
+
+from apts.pmtu import PathMtuCache, path_mtu
+
+from .test_listener import ipv6_available
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPathMtuCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.probed = []
+
+    def probe(self, ip):
+        self.probed.append(ip)
+        return {'10.0.0.1': 1500, '2001:db8::1': 1280}.get(ip)
+
+    def test_block_size(self):
+        cache = PathMtuCache(clock=self.clock, probe=self.probe)
+        self.assertEqual(cache.block_size('10.0.0.1'), 1468)
+        self.assertEqual(cache.block_size('2001:db8::1'), 1228)
+        self.assertIsNone(cache.block_size('10.0.0.2'))
+        self.assertEqual(cache.block_size('10.0.0.1'), 1468)
+        self.assertIsNone(cache.block_size('10.0.0.2'))
+        self.assertEqual(self.probed, ['10.0.0.1', '2001:db8::1', '10.0.0.2'])
+        self.assertEqual(cache.stats(), {'hosts': 3, 'hits': 2, 'misses': 3})
+
+    def test_ttl(self):
+        cache = PathMtuCache(ttl=600, clock=self.clock, probe=self.probe)
+        cache.block_size('10.0.0.1')
+        self.clock.now = 599
+        cache.block_size('10.0.0.1')
+        self.clock.now = 600
+        cache.block_size('10.0.0.1')
+        self.assertEqual(len(self.probed), 2)
+
+    def test_max_hosts(self):
+        cache = PathMtuCache(max_hosts=2, clock=self.clock, probe=self.probe)
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3',
+                   '10.0.0.1', '10.0.0.2'):
+            cache.block_size(ip)
+        self.assertEqual(self.probed, ['10.0.0.1', '10.0.0.2', '10.0.0.3',
+                                       '10.0.0.2'])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'Linux only')
+    def test_loopback(self):
+        """
+        The path MTU of loopback is the MTU of lo, within the largest IPv4
+        packet.
+        """
+        with open('/sys/class/net/lo/mtu') as f:
+            mtu = int(f.read())
+        self.assertEqual(path_mtu('127.0.0.1'), min(mtu, 65535))
+        self.assertEqual(PathMtuCache().block_size('127.0.0.1'),
+                         min(mtu, 65535) - 32)
+        if ipv6_available():
+            self.assertEqual(path_mtu('::1'), mtu)
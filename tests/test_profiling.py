@@ -0,0 +1,110 @@
+import os
+import shutil
+import threading
+import unittest
+from collections import Counter
+from tempfile import mkdtemp
+from unittest import mock
+
+from apts.metrics import MetricsRegistry
+from apts.packets import RRQPacket, ACKPacket
+from apts.profiling import PhaseTimers, SamplingProfiler
+from apts.protocol import TftpProtocol
+
+
+class StepClock:
+    """
+    A clock that advances by one second on every reading.
+    """
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class TestPhaseTimers(unittest.TestCase):
+    def setUp(self):
+        self.tftp_root = os.path.realpath(mkdtemp())
+        with open(os.path.join(self.tftp_root, 'file'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tftp_root)
+
+    def test_protocol_phases(self):
+        registry = MetricsRegistry()
+        timers = PhaseTimers(registry, clock=StepClock())
+        protocol = TftpProtocol(self.tftp_root, False, phase_timers=timers)
+        protocol.receive(RRQPacket(b'file', b'octet').to_wire(), 0)
+        protocol.receive(ACKPacket(1).to_wire(), 1)
+
+        parse, read = timers.histograms['parse'], timers.histograms['read']
+        self.assertEqual((sum(parse.counts), parse.sum), (2, 2))
+        self.assertEqual((sum(read.counts), read.sum), (2, 2))
+        self.assertEqual(sum(timers.histograms['write'].counts), 0)
+        self.assertIn('apts_phase_seconds_count{phase="read"} 2',
+                      registry.render())
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sample(self):
+        stop = threading.Event()
+
+        def session_work():
+            stop.wait(5)
+
+        thread = threading.Thread(target=session_work)
+        thread.start()
+        try:
+            profiler = SamplingProfiler(lambda: [thread], self.directory)
+            stacks = Counter()
+            self.assertEqual(profiler.sample(stacks), 1)
+        finally:
+            stop.set()
+            thread.join()
+
+        (stack, count), = stacks.items()
+        self.assertEqual(count, 1)
+        frames = stack.split(';')
+        self.assertTrue(frames[0].startswith('_bootstrap '))
+        self.assertIn('session_work (test_profiling.py:', stack)
+
+        path = os.path.join(self.directory, 'profile.txt')
+        profiler.write(path, stacks)
+        with open(path) as f:
+            self.assertEqual(f.read(), '{} 1\n'.format(stack))
+
+    def test_start(self):
+        profiler = SamplingProfiler(lambda: [], self.directory,
+                                    interval=0.001)
+        self.assertRaises(ValueError, profiler.start, '0')
+        path = profiler.start('0.05')
+        self.assertTrue(path.startswith(self.directory))
+        self.assertRaises(RuntimeError, profiler.start, 1)
+
+        profiler.thread.join(5)
+        self.assertTrue(os.path.exists(path))
+
+    def test_start_link(self):
+        """
+        A profile never follows a link left in the directory.
+        """
+        target = os.path.join(self.directory, 'target')
+        profiler = SamplingProfiler(lambda: [], self.directory,
+                                    interval=0.001)
+        with mock.patch('time.strftime', return_value='now'):
+            for name in ('apts-profile-now.txt', 'apts-profile-now-.txt'):
+                os.symlink(target, os.path.join(self.directory, name))
+            path = profiler.start('0.01')
+        profiler.thread.join(5)
+        self.assertFalse(os.path.islink(path))
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
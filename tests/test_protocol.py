@@ -0,0 +1,442 @@
+import os
+import shutil
+import unittest
+from io import BytesIO
+from tempfile import mkdtemp
+from unittest.mock import Mock
+
+from apts.index import FileIndex
+from apts.protocol import TftpProtocol
+from apts.textindex import NetasciiIndex
+from apts.providers import Provider, ProviderCache
+from apts.packets import (RRQPacket, WRQPacket, DataPacket, ACKPacket,
+                          ErrorPacket, OACKPacket)
+
+
+class TestTftpProtocol(unittest.TestCase):
+    def setUp(self):
+        self.tftp_root = os.path.realpath(mkdtemp())
+        with open(os.path.join(self.tftp_root, 'file'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tftp_root)
+
+    def test_read_request(self):
+        protocol = TftpProtocol(self.tftp_root, False)
+        now = 100
+
+        packets = protocol.receive(RRQPacket(b'file', b'octet').to_wire(), now)
+        self.assertEqual(len(packets), 1)
+        self.assertEqual((packets[0].blockn, len(packets[0].data)), (1, 512))
+        self.assertEqual(protocol.deadline, now + protocol.timeout_values[0])
+
+        packets = protocol.receive(ACKPacket(1).to_wire(), now + 1)
+        self.assertEqual((packets[0].blockn, len(packets[0].data)), (2, 488))
+
+        self.assertEqual(protocol.receive(ACKPacket(2).to_wire(), now + 2), [])
+        self.assertTrue(protocol.closed)
+        self.assertIsNone(protocol.deadline)
+
+    def test_summary(self):
+        protocol = TftpProtocol(self.tftp_root, False)
+        protocol.receive(RRQPacket(b'file', b'octet').to_wire(), 10)
+        protocol.expire(protocol.deadline)
+        protocol.receive(ACKPacket(1).to_wire(), 14)
+        protocol.receive(ACKPacket(2).to_wire(), 15)
+
+        summary = protocol.summary()
+        self.assertEqual(summary['outcome'], 'complete')
+        self.assertEqual(summary['bytes'], 1000)
+        self.assertEqual(summary['duration'], 5)
+        self.assertEqual(summary['throughput'], 200)
+        self.assertEqual(summary['retransmits'], 1)
+        self.assertEqual(protocol.bytes_sent, 1512)
+
+    def test_rtt(self):
+        """
+        The round-trip time is measured, except for retransmitted packets.
+        """
+        protocol = TftpProtocol(self.tftp_root, False)
+        protocol.receive(RRQPacket(b'file', b'octet').to_wire(), 10)
+        protocol.receive(ACKPacket(1).to_wire(), 10.25)
+        self.assertEqual(protocol.last_rtt, 0.25)
+
+        protocol.expire(protocol.deadline)
+        protocol.receive(ACKPacket(2).to_wire(), protocol.deadline)
+        self.assertIsNone(protocol.last_rtt)
+
+    def test_read_missing_file(self):
+        protocol = TftpProtocol(self.tftp_root, False)
+        packets = protocol.receive(RRQPacket(b'nofile', b'octet').to_wire(), 0)
+
+        self.assertIsInstance(packets[0], ErrorPacket)
+        self.assertEqual(packets[0].error_code, ErrorPacket.ERR_FILE_NOT_FOUND)
+        self.assertTrue(protocol.closed)
+
+    def test_read_index(self):
+        index = FileIndex(self.tftp_root)
+        protocol = TftpProtocol(self.tftp_root, False, index=index)
+        packets = protocol.receive(RRQPacket(b'\\FILE', b'octet').to_wire(), 0)
+        self.assertEqual((packets[0].blockn, len(packets[0].data)), (1, 512))
+        self.assertEqual(protocol.filename, '\\FILE')
+
+        # Files missing from the index are found by their exact name.
+        with open(os.path.join(self.tftp_root, 'new'), 'wb') as f:
+            f.write(b'x')
+        protocol = TftpProtocol(self.tftp_root, False, index=index)
+        packets = protocol.receive(RRQPacket(b'new', b'octet').to_wire(), 0)
+        self.assertEqual(packets[0].data, b'x')
+
+    def test_read_index_exact_name(self):
+        """
+        Of files that differ only in case, each is served by its own name.
+        """
+        for name in ('foo', 'FOO'):
+            with open(os.path.join(self.tftp_root, name), 'wb') as f:
+                f.write(name.encode())
+        index = FileIndex(self.tftp_root)
+        for name in (b'foo', b'FOO', b'Foo'):
+            protocol = TftpProtocol(self.tftp_root, False, index=index)
+            packets = protocol.receive(RRQPacket(name, b'octet').to_wire(), 0)
+            expected = b'foo' if name == b'Foo' else name
+            self.assertEqual(packets[0].data, expected)
+
+    def test_netascii_tsize(self):
+        """
+        The tsize of a netascii RRQ is the size of the encoded file.
+        """
+        with open(os.path.join(self.tftp_root, 'text'), 'wb') as f:
+            f.write(b'line\n' * 100)
+        index = NetasciiIndex()
+        for mode, tsize in ((b'octet', b'500'), (b'netascii', b'600'),
+                            (b'netascii', b'600')):
+            protocol = TftpProtocol(self.tftp_root, False,
+                                    netascii_index=index)
+            packets = protocol.receive(RRQPacket(
+                    b'text', mode, {b'tsize': b'0'}).to_wire(), 0)
+            self.assertEqual(packets[0].options, {b'tsize': tsize})
+        self.assertEqual((index.hits, index.misses), (1, 1))
+
+        protocol = TftpProtocol(self.tftp_root, False)
+        packets = protocol.receive(RRQPacket(
+                b'text', b'netascii', {b'tsize': b'0'}).to_wire(), 0)
+        self.assertEqual(packets[0].options, {b'tsize': b'600'})
+
+    def test_relay_netascii_tsize(self):
+        """
+        No tsize is offered for a netascii RRQ of the relay, whose encoded
+        size is unknown.
+        """
+        for mode, options in ((b'octet', {b'tsize': b'500'}),
+                              (b'netascii', None)):
+            relay = Mock()
+            relay.open.return_value = (BytesIO(b'line\n' * 100), 500)
+            protocol = TftpProtocol(self.tftp_root, False, relay=relay)
+            packets = protocol.receive(RRQPacket(
+                    b'text', mode, {b'tsize': b'0'}).to_wire(), 0)
+            if options is None:
+                self.assertEqual(packets[0].blockn, 1)
+            else:
+                self.assertEqual(packets[0].options, options)
+
+    def test_max_block_size(self):
+        """
+        The block size is capped, e.g. by the path MTU to the client.
+        """
+        protocol = TftpProtocol(self.tftp_root, False, max_block_size=468)
+        packets = protocol.receive(RRQPacket(
+                b'file', b'octet', {b'blksize': b'1468'}).to_wire(), 0)
+        self.assertEqual(packets[0].options, {b'blksize': b'468'})
+        packets = protocol.receive(ACKPacket(0).to_wire(), 0)
+        self.assertEqual(len(packets[0].data), 468)
+
+        protocol = TftpProtocol(self.tftp_root, False, max_block_size=468)
+        packets = protocol.receive(RRQPacket(
+                b'file', b'octet', {b'blksize': b'256'}).to_wire(), 0)
+        self.assertEqual(packets[0].options, {b'blksize': b'256'})
+
+    def test_read_provider(self):
+        def hello(match, client_ip):
+            return 'hello {} at {}\n'.format(match.group(1), client_ip)
+
+        providers = ProviderCache([Provider(r'^hello/(\w+)$', hello)])
+        protocol = TftpProtocol(self.tftp_root, False, providers=providers,
+                                client_ip='10.0.0.1')
+        packets = protocol.receive(
+                RRQPacket(b'/hello/world', b'netascii').to_wire(), 0)
+        self.assertEqual(packets[0].data, b'hello world at 10.0.0.1\r\n')
+
+        # Names that no provider matches are files of the tftp root.
+        protocol = TftpProtocol(self.tftp_root, False, providers=providers)
+        packets = protocol.receive(RRQPacket(b'file', b'octet').to_wire(), 0)
+        self.assertEqual(len(packets[0].data), 512)
+
+    def test_retransmissions(self):
+        """
+        The last sent packet is retransmitted every time the deadline expires,
+        until the timeout values are exhausted.
+        """
+        protocol = TftpProtocol(self.tftp_root, False)
+        now = 0
+        sent = protocol.receive(RRQPacket(b'file', b'octet').to_wire(), now)
+
+        for timeout in protocol.timeout_values[1:]:
+            now = protocol.deadline
+            self.assertEqual(protocol.expire(now), sent)
+            self.assertEqual(protocol.deadline, now + timeout)
+
+        self.assertEqual(protocol.expire(protocol.deadline), [])
+        self.assertTrue(protocol.closed)
+
+    def test_write_request(self):
+        protocol = TftpProtocol(self.tftp_root, True)
+
+        packets = protocol.receive(WRQPacket(b'new', b'octet').to_wire(), 0)
+        self.assertEqual(packets[0].blockn, 0)
+
+        packets = protocol.receive(DataPacket(1, b'y' * 512).to_wire(), 1)
+        self.assertEqual(packets[0].blockn, 1)
+        packets = protocol.receive(DataPacket(2, b'y' * 10).to_wire(), 2)
+        self.assertEqual(packets[0].blockn, 2)
+
+        # After the last block, wait for the deadline but do not retransmit.
+        self.assertFalse(protocol.closed)
+        self.assertEqual(protocol.expire(protocol.deadline), [])
+        self.assertTrue(protocol.closed)
+        self.assertEqual(protocol.summary()['duration'], 2)
+
+        with open(os.path.join(self.tftp_root, 'new'), 'rb') as f:
+            self.assertEqual(f.read(), b'y' * 522)
+
+    def test_write_request_read_only(self):
+        protocol = TftpProtocol(self.tftp_root, False)
+        packets = protocol.receive(WRQPacket(b'new', b'octet').to_wire(), 0)
+
+        self.assertEqual(packets[0].error_code, ErrorPacket.ERR_ACCESS_VIOLATION)
+        self.assertTrue(protocol.closed)
+
+    def test_bad_packet(self):
+        protocol = TftpProtocol(self.tftp_root, False)
+        packets = protocol.receive(b'\x00\x09garbage', 0)
+
+        self.assertEqual(packets[0].error_code, ErrorPacket.ERR_ILLEGAL_OPERATION)
+        self.assertTrue(protocol.closed)
+
+    def test_option_negotiation(self):
+        """
+        Supported options are acknowledged with an OACK, and the transfer
+        starts with the ACK of block 0.
+        """
+        protocol = TftpProtocol(self.tftp_root, False)
+        options = {b'blksize': b'100000', b'tsize': b'0', b'windowsize': b'4',
+                   b'unknown': b'1'}
+        packets = protocol.receive(
+                RRQPacket(b'file', b'octet', options).to_wire(), 0)
+
+        self.assertIsInstance(packets[0], OACKPacket)
+        self.assertEqual(packets[0].options, {
+            b'blksize': str(DataPacket.max_block_size).encode(),
+            b'tsize': b'1000', b'windowsize': b'4'})
+
+        packets = protocol.receive(ACKPacket(0).to_wire(), 1)
+        self.assertEqual([len(packet.data) for packet in packets], [1000])
+        self.assertEqual(protocol.receive(ACKPacket(1).to_wire(), 2), [])
+        self.assertEqual(protocol.outcome(), 'complete')
+
+    def test_invalid_options(self):
+        """
+        Options that are not UTF-8 are answered with an error.
+        """
+        for request in (b'\x00\x01file\x00octet\x00blksize\x00\xff\xfe\x00',
+                        b'\x00\x02new\x00octet\x00\xe9\x00512\x00'):
+            protocol = TftpProtocol(self.tftp_root, True)
+            packets = protocol.receive(request, 0)
+            self.assertEqual(packets[0].error_code,
+                             ErrorPacket.ERR_OPTION_NEGOTIATION)
+            self.assertTrue(protocol.closed)
+
+    def test_read_window(self):
+        protocol = TftpProtocol(self.tftp_root, False)
+        options = {b'blksize': b'100', b'windowsize': b'4'}
+        protocol.receive(RRQPacket(b'file', b'octet', options).to_wire(), 0)
+
+        packets = protocol.receive(ACKPacket(0).to_wire(), 1)
+        self.assertEqual([packet.blockn for packet in packets], [1, 2, 3, 4])
+
+        # An ACK in the middle of the window means the blocks after it were
+        # lost, they are sent again along with new ones.
+        packets = protocol.receive(ACKPacket(2).to_wire(), 2)
+        self.assertEqual([packet.blockn for packet in packets], [3, 4, 5, 6])
+        self.assertEqual(protocol.resent, 2)
+
+        # A duplicate ACK that arrives right after the window is ignored.
+        self.assertEqual(protocol.receive(ACKPacket(2).to_wire(), 2), [])
+
+        packets = protocol.receive(ACKPacket(6).to_wire(), 3)
+        self.assertEqual([packet.blockn for packet in packets], [7, 8, 9, 10])
+        self.assertEqual(protocol.resent, 0)
+
+        # The timeout retransmits the whole window.
+        self.assertEqual(protocol.expire(protocol.deadline), packets)
+        self.assertEqual(protocol.resent, 4)
+
+        packets = protocol.receive(ACKPacket(10).to_wire(), 10)
+        self.assertEqual([len(packet.data) for packet in packets], [0])
+        self.assertEqual(protocol.receive(ACKPacket(11).to_wire(), 11), [])
+        self.assertEqual(protocol.outcome(), 'complete')
+        self.assertEqual(protocol.transferred, 1000)
+
+    def test_congestion_events(self):
+        congestion = Mock()
+        protocol = TftpProtocol(self.tftp_root, False, congestion=congestion)
+        options = {b'blksize': b'100', b'windowsize': b'4'}
+        protocol.receive(RRQPacket(b'file', b'octet', options).to_wire(), 0)
+        protocol.receive(ACKPacket(0).to_wire(), 1)
+
+        protocol.receive(ACKPacket(4).to_wire(), 2)
+        congestion.on_ack.assert_called_once_with(4, 4)
+        protocol.receive(ACKPacket(5).to_wire(), 3)
+        congestion.on_loss.assert_called_once_with()
+        protocol.expire(protocol.deadline)
+        congestion.on_timeout.assert_called_once_with()
+
+    def test_sent(self):
+        """
+        The round trip and the retransmission timer of shaped or paced
+        packets start once the last one is sent.
+        """
+        protocol = TftpProtocol(self.tftp_root, False)
+        protocol.receive(RRQPacket(b'file', b'octet').to_wire(), 0)
+        protocol.sent(0.5)
+        self.assertEqual(protocol.deadline, 0.5 + protocol.timeout_values[0])
+        protocol.receive(ACKPacket(1).to_wire(), 1)
+        self.assertEqual(protocol.last_rtt, 0.5)
+
+        # A window held back longer than the timeout is not resent at once.
+        protocol = TftpProtocol(self.tftp_root, False)
+        protocol.receive(RRQPacket(b'file', b'octet').to_wire(), 0)
+        protocol.sent(10)
+        self.assertEqual(protocol.deadline, 10 + protocol.timeout_values[0])
+        packets = protocol.receive(ACKPacket(1).to_wire(), 11)
+        self.assertEqual(packets[0].blockn, 2)
+        self.assertEqual(protocol.total_retransmissions, 0)
+
+    def test_read_window_client_timeout(self):
+        """
+        A duplicate ACK that arrives long after the window was sent means
+        the client timed out waiting for it, and the window is sent again.
+        """
+        protocol = TftpProtocol(self.tftp_root, False)
+        options = {b'blksize': b'100', b'windowsize': b'2'}
+        protocol.receive(RRQPacket(b'file', b'octet', options).to_wire(), 0)
+        protocol.receive(ACKPacket(0).to_wire(), 0.01)
+        packets = protocol.receive(ACKPacket(2).to_wire(), 0.02)
+
+        self.assertEqual(protocol.receive(ACKPacket(2).to_wire(), 0.03), [])
+        self.assertEqual(protocol.receive(ACKPacket(2).to_wire(), 1), packets)
+        self.assertEqual(protocol.total_retransmissions, 1)
+        self.assertEqual(protocol.resent, 2)
+
+    def test_block_number_wraparound(self):
+        with open(os.path.join(self.tftp_root, 'large'), 'wb') as f:
+            f.write(b'x' * 8 * 65540)
+        protocol = TftpProtocol(self.tftp_root, False)
+        options = {b'blksize': b'8', b'windowsize': b'64'}
+        protocol.receive(RRQPacket(b'large', b'octet', options).to_wire(), 0)
+
+        packets = protocol.receive(ACKPacket(0).to_wire(), 1)
+        while packets[-1].blockn != 0:
+            packets = protocol.receive(ACKPacket(packets[-1].blockn).to_wire(), 1)
+
+        # The window holds blocks 65473 to 65535, then 0.
+        self.assertEqual([packet.blockn for packet in packets[-2:]], [65535, 0])
+        packets = protocol.receive(ACKPacket(0).to_wire(), 1)
+        self.assertEqual([packet.blockn for packet in packets], [1, 2, 3, 4, 5])
+        self.assertEqual(len(packets[-1].data), 0)
+        self.assertEqual(protocol.receive(ACKPacket(5).to_wire(), 1), [])
+        self.assertEqual(protocol.transferred, 8 * 65540)
+
+    def test_write_window(self):
+        protocol = TftpProtocol(self.tftp_root, True)
+        options = {b'blksize': b'10', b'windowsize': b'3', b'tsize': b'25'}
+        packets = protocol.receive(
+                WRQPacket(b'new', b'octet', options).to_wire(), 0)
+        self.assertEqual(packets[0].options, options)
+        self.assertEqual(protocol.file_size, 25)
+
+        # Only the last block of a window is acknowledged.
+        self.assertEqual(protocol.receive(DataPacket(1, b'a' * 10).to_wire(), 1),
+                         [])
+        # A block after a lost one acknowledges the last one received.
+        packets = protocol.receive(DataPacket(3, b'c' * 5).to_wire(), 2)
+        self.assertEqual(packets[0].blockn, 1)
+
+        self.assertEqual(protocol.receive(DataPacket(2, b'b' * 10).to_wire(), 3),
+                         [])
+        packets = protocol.receive(DataPacket(3, b'c' * 5).to_wire(), 4)
+        self.assertEqual(packets[0].blockn, 3)
+        self.assertEqual(protocol.outcome(), 'complete')
+
+        with open(os.path.join(self.tftp_root, 'new'), 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 10 + b'b' * 10 + b'c' * 5)
+
+    def test_write_window_gap(self):
+        """
+        A gap is acknowledged once, not once for every block after it,
+        unless the client starts over from an earlier block.
+        """
+        protocol = TftpProtocol(self.tftp_root, True)
+        options = {b'blksize': b'10', b'windowsize': b'4'}
+        protocol.receive(WRQPacket(b'new', b'octet', options).to_wire(), 0)
+        protocol.receive(DataPacket(1, b'a' * 10).to_wire(), 1)
+
+        packets = protocol.receive(DataPacket(3, b'c' * 10).to_wire(), 1)
+        self.assertEqual(packets[0].blockn, 1)
+        for blockn in (4, 4):
+            self.assertEqual(protocol.receive(
+                    DataPacket(blockn, b'd' * 10).to_wire(), 1), [])
+
+        # The ACK was lost, and the client sends the window again.
+        packets = protocol.receive(DataPacket(1, b'a' * 10).to_wire(), 2)
+        self.assertEqual(packets[0].blockn, 1)
+        self.assertEqual(protocol.receive(
+                DataPacket(3, b'c' * 10).to_wire(), 2), [])
+
+        # Once the gap is filled, the next gap is acknowledged again.
+        protocol.receive(DataPacket(2, b'b' * 10).to_wire(), 3)
+        packets = protocol.receive(DataPacket(4, b'd' * 10).to_wire(), 3)
+        self.assertEqual(packets[0].blockn, 2)
+
+    def test_write_lost_acks(self):
+        """
+        Without a window, every retransmission of the last block received
+        is acknowledged again, however many of our ACKs are lost.
+        """
+        protocol = TftpProtocol(self.tftp_root, True)
+        protocol.receive(WRQPacket(b'new', b'octet').to_wire(), 0)
+        protocol.receive(DataPacket(1, b'a' * 512).to_wire(), 1)
+        protocol.expire(protocol.deadline)
+        for now in (2, 3, 4):
+            data = DataPacket(1, b'a' * 512).to_wire()
+            packets = protocol.receive(data, now)
+            self.assertEqual(packets[0].blockn, 1)
+            self.assertEqual(protocol.retransmissions, 0)
+            self.assertEqual(protocol.deadline, now + 3)
+
+        packets = protocol.receive(DataPacket(2, b'b').to_wire(), 5)
+        self.assertEqual(packets[0].blockn, 2)
+        self.assertTrue(protocol.complete)
+
+    def test_write_window_timeout(self):
+        """
+        On a timeout, the last block received in order is acknowledged.
+        """
+        protocol = TftpProtocol(self.tftp_root, True)
+        options = {b'windowsize': b'4'}
+        protocol.receive(WRQPacket(b'new', b'octet', options).to_wire(), 0)
+        protocol.receive(DataPacket(1, b'a' * 512).to_wire(), 1)
+        protocol.receive(DataPacket(2, b'b' * 512).to_wire(), 1)
+
+        packets = protocol.expire(protocol.deadline)
+        self.assertEqual(packets[0].blockn, 2)
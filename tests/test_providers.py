@@ -0,0 +1,169 @@
+import threading
+import unittest
+
+from apts.errors import TftpTransferError
+from apts.memory import MemoryAccountant
+from apts.providers import Provider, ProviderCache, load_function
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def pxelinux_config(match):
+    return 'APPEND hostname={}\n'.format(match.group(1))
+
+
+class TestProvider(unittest.TestCase):
+    def test_arguments(self):
+        def by_client(filename, client_ip):
+            return '{} {}'.format(filename, client_ip)
+
+        def anything(**kwargs):
+            return sorted(kwargs)
+
+        provider = Provider(r'^cfg/(.*)$', pxelinux_config)
+        match = provider.pattern.search('cfg/host1')
+        self.assertFalse(provider.per_client)
+        self.assertEqual(provider.render('cfg/host1', match, '10.0.0.1'),
+                         b'APPEND hostname=host1\n')
+
+        provider = Provider('x', by_client)
+        self.assertTrue(provider.per_client)
+        self.assertEqual(provider.render('x', None, '10.0.0.1'),
+                         b'x 10.0.0.1')
+        provider = Provider('x', anything)
+        self.assertEqual(provider.render('x', None, '10.0.0.1'),
+                         ['client_ip', 'filename', 'match'])
+
+    def test_load_function(self):
+        self.assertIs(load_function('tests.test_providers.pxelinux_config'),
+                      pxelinux_config)
+        for name in ('pxelinux_config', 'tests.test_providers.FakeClock.now',
+                     'no.such.function', 'tests.test_providers.unittest'):
+            self.assertRaises(ValueError, load_function, name)
+
+
+class TestProviderCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = []
+
+    def provider(self, pattern, content=b'data', per_client=False):
+        def function(filename, client_ip):
+            self.calls.append((filename, client_ip))
+            return content
+
+        provider = Provider(pattern, function)
+        provider.per_client = per_client
+        return provider
+
+    def read(self, cache, filename, client_ip='10.0.0.1'):
+        opened = cache.open(filename, client_ip)
+        if opened is None:
+            return None
+        source, size = opened
+        data = source.read()
+        self.assertEqual(len(data), size)
+        return data
+
+    def test_memoized(self):
+        cache = ProviderCache([self.provider('^a$', b'A'),
+                               self.provider('^a|b$', b'B')], ttl=10,
+                              clock=self.clock)
+        self.assertEqual(self.read(cache, 'a'), b'A')
+        self.assertEqual(self.read(cache, 'a', '10.0.0.2'), b'A')
+        self.assertEqual(self.read(cache, 'b'), b'B')
+        self.assertIsNone(self.read(cache, 'c'))
+        self.assertEqual(len(self.calls), 2)
+
+        # Rendered again after ttl.
+        self.clock.now = 10
+        self.assertEqual(self.read(cache, 'a'), b'A')
+        self.assertEqual(len(self.calls), 3)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (1, 3, 1))
+
+    def test_per_client(self):
+        cache = ProviderCache([self.provider('a', per_client=True)])
+        for client_ip in ('10.0.0.1', '10.0.0.2', '10.0.0.1'):
+            self.read(cache, 'a', client_ip)
+        self.assertEqual(self.calls, [('a', '10.0.0.1'), ('a', '10.0.0.2')])
+
+    def test_fall_through(self):
+        """
+        A provider that returns None leaves the file to the tftp root.
+        """
+        cache = ProviderCache([self.provider('a', None)])
+        self.assertIsNone(cache.open('a', '10.0.0.1'))
+        self.assertIsNone(cache.open('a', '10.0.0.1'))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_error(self):
+        def broken(filename):
+            self.calls.append(filename)
+            raise KeyError(filename)
+
+        cache = ProviderCache([Provider('a', broken)])
+        with self.assertLogs(level='ERROR'):
+            for _ in range(2):
+                self.assertRaises(TftpTransferError, cache.open, 'a', None)
+        self.assertEqual(self.calls, ['a', 'a'])
+        self.assertEqual(cache.stats()['errors'], 2)
+
+    def test_invalid_content(self):
+        """
+        Content of another type than bytes, str or None fails the request,
+        and those that share the rendering, instead of leaving them waiting.
+        """
+        cache = ProviderCache([self.provider('a', 42)])
+        with self.assertLogs(level='ERROR'):
+            self.assertRaises(TftpTransferError, cache.open, 'a', None)
+        self.assertEqual(cache.stats()['errors'], 1)
+        self.assertEqual(cache.stats()['files'], 0)
+
+    def test_shared_rendering(self):
+        started, finish = threading.Event(), threading.Event()
+
+        def slow(filename):
+            self.calls.append(filename)
+            started.set()
+            finish.wait(5)
+            return b'slow'
+
+        cache = ProviderCache([Provider('a', slow)])
+        results = []
+        threads = [threading.Thread(
+                target=lambda: results.append(self.read(cache, 'a')))
+                for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while cache.stats()['shared'] < 4:
+            finish.wait(0.01)
+        finish.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b'slow'] * 5)
+        self.assertEqual(self.calls, ['a'])
+
+    def test_max_size(self):
+        memory = MemoryAccountant(10)
+        cache = ProviderCache([self.provider('.', b'x' * 4)], max_size=8,
+                              memory=memory)
+        for name in 'abc':
+            self.read(cache, name)
+        self.assertEqual(cache.stats()['files'], 2)
+        self.assertEqual(memory.usage(), {'providers': 8})
+
+        # The oldest files make room for sessions.
+        self.assertTrue(memory.reserve('sessions', 6))
+        self.assertEqual(memory.usage(), {'providers': 4, 'sessions': 6})
+        self.read(cache, 'c')
+        self.assertEqual(len(self.calls), 3)
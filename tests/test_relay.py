@@ -0,0 +1,248 @@
+import os
+import shutil
+import threading
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+
+from apts.errors import TftpTransferError
+from apts.memory import MemoryAccountant
+from apts.packets import ErrorPacket
+from apts.relay import CachedFile, RelayCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ManualRelayCache(RelayCache):
+    """
+    A RelayCache whose downloads are fed by the test instead of an
+    upstream server.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(('upstream', 69), *args, **kwargs)
+        self.downloads = []
+        self.started = threading.Semaphore(0)
+
+    def download(self, cached_file):
+        feed = Feed()
+        self.downloads.append((cached_file.name, feed))
+        self.started.release()
+        for item in iter(feed.get, None):
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, int):
+                cached_file.start(item)
+            else:
+                cached_file.write(item)
+
+    def next_download(self):
+        if not self.started.acquire(timeout=5):
+            raise AssertionError('no download was started')
+        return self.downloads[-1][1]
+
+
+class Feed:
+    def __init__(self):
+        self.items = []
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        with self.condition:
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.items)
+            return self.items.pop(0)
+
+
+class TestRelayCache(unittest.TestCase):
+    def test_streaming_and_single_fetch(self):
+        cache = ManualRelayCache()
+
+        # The first open waits until the upstream server starts sending.
+        results = []
+        opener = threading.Thread(target=lambda:
+                                  results.append(cache.open('image')))
+        opener.start()
+        feed = cache.next_download()
+        feed.put(8)
+        opener.join(5)
+        reader, size = results[0]
+        self.assertEqual(size, 8)
+
+        # The data are read as they arrive, and a concurrent request shares
+        # the fetch.
+        feed.put(b'abcd')
+        self.assertEqual(reader.read(4), b'abcd')
+        other, _ = cache.open('image')
+        feed.put(b'efgh')
+        feed.put(None)
+        self.assertEqual(reader.read(512), b'efgh')
+        self.assertEqual(other.read(512), b'abcdefgh')
+        reader.close()
+        other.close()
+
+        # A later request is a hit.
+        hit, size = cache.open('image')
+        self.assertEqual((hit.read(512), size), (b'abcdefgh', 8))
+        hit.close()
+
+        self.assertEqual(len(cache.downloads), 1)
+        stats = cache.stats()
+        self.assertEqual((stats['misses'], stats['shared'], stats['hits']),
+                         (1, 1, 1))
+
+    def test_upstream_error(self):
+        cache = ManualRelayCache()
+        results = []
+
+        def open_file():
+            try:
+                cache.open('missing')
+            except TftpTransferError as e:
+                results.append(e)
+
+        opener = threading.Thread(target=open_file)
+        opener.start()
+        cache.next_download().put(TftpTransferError(
+                'File not found', ErrorPacket.ERR_FILE_NOT_FOUND))
+        opener.join(5)
+
+        self.assertEqual(results[0].error_code, ErrorPacket.ERR_FILE_NOT_FOUND)
+        # Failures are not cached.
+        self.assertEqual(cache.stats()['files'], 0)
+        self.assertEqual(cache.stats()['errors'], 1)
+
+    def fill(self, cache, name, data):
+        results = []
+        opener = threading.Thread(target=lambda:
+                                  results.append(cache.open(name)))
+        opener.start()
+        feed = cache.next_download()
+        feed.put(data)
+        feed.put(None)
+        opener.join(5)
+        reader = results[0][0]
+        self.assertEqual(reader.read(len(data) + 1), data)
+        reader.close()
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = ManualRelayCache(ttl=10, clock=clock)
+        self.fill(cache, 'file', b'old')
+
+        clock.now = 9
+        reader, _ = cache.open('file')
+        reader.close()
+        self.assertEqual(len(cache.downloads), 1)
+
+        clock.now = 10
+        self.fill(cache, 'file', b'new')
+        self.assertEqual(len(cache.downloads), 2)
+
+    def test_eviction(self):
+        cache = ManualRelayCache(max_size=10)
+        self.fill(cache, 'a', b'a' * 4)
+        self.fill(cache, 'b', b'b' * 4)
+        reader, _ = cache.open('a')
+        reader.close()
+
+        # The least recently used file is evicted.
+        self.fill(cache, 'c', b'c' * 4)
+        stats = cache.stats()
+        self.assertEqual((stats['files'], stats['evictions']), (2, 1))
+        reader, _ = cache.open('a')
+        reader.close()
+        self.assertEqual(len(cache.downloads), 3)
+
+    def test_memory_budget(self):
+        memory = MemoryAccountant(10)
+        cache = ManualRelayCache(memory=memory)
+        self.fill(cache, 'a', b'a' * 4)
+        self.fill(cache, 'b', b'b' * 4)
+        self.assertEqual(memory.usage(), {'relay_cache': 8})
+
+        # Sessions take precedence over the least recently used files.
+        self.assertTrue(memory.reserve('sessions', 6))
+        self.assertEqual(memory.usage(), {'relay_cache': 4, 'sessions': 6})
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertFalse(memory.reserve('sessions', 6))
+
+
+class TestDiskRelayCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def close(self, cache):
+        """
+        Closes the files that cache keeps open on disk.
+        """
+        for cached_file in list(cache._files.values()):
+            cached_file.discard()
+
+    def test_disk_cache(self):
+        clock = FakeClock()
+        cache = ManualRelayCache(cache_dir=self.cache_dir, ttl=10, clock=clock)
+        self.addCleanup(self.close, cache)
+        TestRelayCache.fill(self, cache, 'a', b'old')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # An expired file that is being read is only removed once it is
+        # closed.
+        reader, _ = cache.open('a')
+        clock.now = 10
+        TestRelayCache.fill(self, cache, 'a', b'new')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertEqual(reader.read(10), b'old')
+        reader.close()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # A new cache picks up the complete files.
+        cache = ManualRelayCache(cache_dir=self.cache_dir)
+        self.addCleanup(self.close, cache)
+        reader, size = cache.open('a')
+        self.assertEqual((reader.read(10), size), (b'new', 3))
+        reader.close()
+        self.assertEqual(cache.downloads, [])
+
+    def test_discard_during_read(self):
+        """
+        A file discarded while it is being read is closed once the read is
+        over, and later reads fail.
+        """
+        cached_file = CachedFile('key', 'a', os.path.join(self.cache_dir, 'a'))
+        cached_file.write(b'data')
+        reading, proceed = threading.Event(), threading.Event()
+        pread = os.pread
+
+        def slow_pread(*args):
+            reading.set()
+            proceed.wait(5)
+            return pread(*args)
+
+        results = []
+        with mock.patch('os.pread', slow_pread):
+            reader = threading.Thread(target=lambda:
+                                      results.append(cached_file.read(0, 4)))
+            reader.start()
+            self.assertTrue(reading.wait(5))
+            cached_file.discard()
+            self.assertFalse(cached_file._file.closed)
+            proceed.set()
+            reader.join(5)
+
+        self.assertEqual(results, [b'data'])
+        self.assertTrue(cached_file._file.closed)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertRaises(TftpTransferError, cached_file.read, 0, 4)
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import shutil
+import signal
+import time
+import socket
+import asyncio
+import unittest
+import threading
+from tempfile import mkdtemp
+from unittest import mock
+
+from apts.client import TftpClient
+from apts.config import ServerConfig
+from apts.control import send_command
+from apts.errors import TftpRootError, TftpTransferError
+from apts.packets import RRQPacket, ACKPacket, PacketFactory
+from apts.server import TftpServer, build_parser
+
+from .test_listener import ipv6_available
+
+
+class TestTftpServer(unittest.TestCase):
+    def setUp(self):
+        self.tftp_root = mkdtemp()
+        with open(os.path.join(self.tftp_root, 'file'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tftp_root)
+
+    def test_start_stop(self):
+        server = TftpServer(self.tftp_root, config=ServerConfig(writable=False))
+        server.start('127.0.0.1', 0)
+        try:
+            client = TftpClient(*server.address, timeout=0.5, retries=2)
+            summary = asyncio.run(client.get('file', os.devnull))
+            self.assertEqual(summary['bytes'], 1000)
+        finally:
+            server.stop(timeout=5)
+
+        self.assertFalse(server.thread.is_alive())
+        self.assertEqual(server.sessions, set())
+        self.assertEqual(server.listener.stats()['received'], 1)
+
+    @unittest.skipUnless(ipv6_available(), 'IPv6 is not available')
+    def test_dual_stack(self):
+        server = TftpServer(self.tftp_root, config=ServerConfig(writable=False))
+        server.start('::', 0)
+        # The transfers are logged by the sessions, which the server waits
+        # for when it stops.
+        with self.assertLogs(level='INFO') as logs:
+            try:
+                for host in ('127.0.0.1', '::1'):
+                    client = TftpClient(host, server.address[1], timeout=0.5,
+                                        retries=2)
+                    summary = asyncio.run(client.get('file', os.devnull))
+                    self.assertEqual(summary['bytes'], 1000)
+            finally:
+                server.stop(timeout=5)
+
+        clients = [line.split('client=')[1].split()[0]
+                   for line in logs.output if 'client=' in line]
+        # A session logs its transfer after the last ACK, so the second one
+        # may finish first.
+        self.assertEqual(sorted(clients), ['127.0.0.1', '::1'])
+
+    def test_path_mtu(self):
+        """
+        The block size is capped by the path MTU, which is looked up by the
+        session rather than by the thread that starts sessions.
+        """
+        server = TftpServer(self.tftp_root, config=ServerConfig(writable=False))
+        threads = []
+
+        def probe(ip):
+            threads.append(threading.current_thread())
+            return 1200
+
+        server.path_mtu.probe = probe
+        server.start('127.0.0.1', 0)
+        try:
+            client = TftpClient(*server.address, block_size=8192,
+                                timeout=0.5, retries=2)
+            summary = asyncio.run(client.get('file', os.devnull))
+        finally:
+            server.stop(timeout=5)
+        self.assertEqual(summary['block_size'], 1168)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], server.dispatcher)
+
+    def test_list_sessions(self):
+        server = TftpServer(self.tftp_root, config=ServerConfig(writable=False))
+        server.start('127.0.0.1', 0)
+        factory = PacketFactory()
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(5)
+                sock.sendto(RRQPacket(b'file', b'octet').to_wire(),
+                            server.address)
+                data, session_address = sock.recvfrom(2048)
+                self.assertEqual(factory.create(data).blockn, 1)
+
+                sessions = json.loads(server.list_sessions())
+                self.assertEqual(len(sessions), 1)
+                self.assertEqual(sessions[0]['client'], '127.0.0.1:{}'.format(
+                        sock.getsockname()[1]))
+                self.assertEqual(sessions[0]['tid'], session_address[1])
+                self.assertEqual(
+                        (sessions[0]['op'], sessions[0]['file'],
+                         sessions[0]['mode'], sessions[0]['block'],
+                         sessions[0]['bytes'], sessions[0]['size']),
+                        ('RRQ', 'file', 'octet', 1, 512, 1000))
+
+                sock.sendto(ACKPacket(1).to_wire(), session_address)
+                sock.recvfrom(2048)
+                sock.sendto(ACKPacket(2).to_wire(), session_address)
+        finally:
+            server.stop(timeout=5)
+        self.assertEqual(json.loads(server.list_sessions()), [])
+
+    def test_handoff(self):
+        old = TftpServer(self.tftp_root, config=ServerConfig(writable=False))
+        old.start('127.0.0.1', 0)
+        factory = PacketFactory()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(5)
+            sock.sendto(RRQPacket(b'file', b'octet').to_wire(), old.address)
+            data, session_address = sock.recvfrom(2048)
+            self.assertEqual(factory.create(data).blockn, 1)
+
+            # What reload() does, within a single process.
+            new = TftpServer(self.tftp_root,
+                             config=ServerConfig(writable=False))
+            new.start(sock=socket.socket(
+                    fileno=os.dup(old.listener.socket.fileno())))
+            old.listener.interrupt()
+            old.thread.join(5)
+            self.assertFalse(old.thread.is_alive())
+            try:
+                client = TftpClient(*old.address, timeout=0.5, retries=2)
+                summary = asyncio.run(client.get('file', os.devnull))
+                self.assertEqual(summary['bytes'], 1000)
+                self.assertEqual(new.listener.stats()['received'], 1)
+            finally:
+                new.stop(timeout=5)
+
+            # The transfer in flight goes on with the old server.
+            sock.sendto(ACKPacket(1).to_wire(), session_address)
+            data, _ = sock.recvfrom(2048)
+            self.assertEqual(len(factory.create(data).data), 488)
+            sock.sendto(ACKPacket(2).to_wire(), session_address)
+            self.assertEqual(old.stop(timeout=5), 0)
+
+    def test_stop_queued_requests(self):
+        """
+        Requests that are still queued when the server stops are served to
+        the end before stop() returns.
+        """
+        server = TftpServer(self.tftp_root, config=ServerConfig(writable=False))
+        start_session = server.start_session
+
+        def slow_start_session(*args):
+            time.sleep(0.05)
+            start_session(*args)
+
+        server.dispatcher.handler = slow_start_session
+        server.start('127.0.0.1', 0)
+
+        clients = []
+        for _ in range(5):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.addCleanup(sock.close)
+            sock.settimeout(5)
+            sock.bind(('127.0.0.1', 0))
+            clients.append(sock)
+            server.dispatcher.dispatch(RRQPacket(b'file', b'octet').to_wire(),
+                                       sock.getsockname())
+
+        received = []
+
+        def download():
+            factory = PacketFactory()
+            for sock in clients:
+                size = 0
+                while True:
+                    data, address = sock.recvfrom(2048)
+                    packet = factory.create(data)
+                    size += len(packet.data)
+                    if packet.is_last:
+                        received.append(size)
+                    sock.sendto(ACKPacket(packet.blockn).to_wire(), address)
+                    if packet.is_last:
+                        break
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        self.assertEqual(server.stop(timeout=10), 0)
+        self.assertEqual(received, [1000] * 5)
+        thread.join(5)
+
+    def test_reload(self):
+        control_socket = os.path.join(self.tftp_root, 'apts.sock')
+        server = TftpServer(self.tftp_root, config=ServerConfig(
+                control_socket=control_socket))
+        server.start('127.0.0.1', 0)
+        try:
+            self.assertRaises(RuntimeError, server.reload,
+                              [sys.executable, '-c', 'pass'])
+            self.assertFalse(server.listener.interrupted)
+
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            command = [sys.executable, '-c',
+                       'import sys; from apts.server import main; '
+                       'sys.exit(main(sys.argv[1:]))',
+                       '-c', os.devnull, '-r', self.tftp_root,
+                       '-s', control_socket, '-l', 'WARNING',
+                       '--no-drop-privileges']
+            with mock.patch.dict(os.environ, PYTHONPATH=root):
+                message = server.reload(command)
+            pid = int(message.split()[2])
+            self.assertTrue(server.listener.interrupted)
+            try:
+                client = TftpClient(*server.address, timeout=0.5, retries=2)
+                summary = asyncio.run(client.get('file', os.devnull))
+                self.assertEqual(summary['bytes'], 1000)
+                self.assertEqual(server.listener.stats()['received'], 0)
+
+                # The new process serves the control socket that it took
+                # over.
+                self.assertIsNone(server.control_server)
+                sessions = json.loads(send_command(control_socket,
+                                                   'sessions'))
+                self.assertIsInstance(sessions, list)
+            finally:
+                os.kill(pid, signal.SIGTERM)
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+        finally:
+            server.stop(timeout=5)
+
+    def test_memory_budget(self):
+        server = TftpServer(self.tftp_root, config=ServerConfig(
+                memory_budget=1))
+        server.start('127.0.0.1', 0)
+        try:
+            client = TftpClient(*server.address, timeout=0.2, retries=1)
+            self.assertRaises(TftpTransferError, asyncio.run,
+                              client.get('file', os.devnull))
+            self.assertIn('apts_memory_refused 2', server.metrics.render())
+        finally:
+            server.stop(timeout=5)
+        self.assertEqual(server.memory.usage(), {'socket_buffers': 0})
+
+    def test_stop_not_started(self):
+        server = TftpServer(self.tftp_root, config=ServerConfig())
+        self.assertEqual(server.stop(), 0)
+
+    def test_tftp_root_error(self):
+        self.assertRaises(TftpRootError, TftpServer,
+                          os.path.join(self.tftp_root, 'file'))
+
+    def test_parser(self):
+        args = build_parser().parse_args(['-p', '6969', '--read-only'])
+        self.assertEqual((args.port, args.read_only, args.root),
+                         (6969, True, None))
@@ -0,0 +1,146 @@
+import time
+import threading
+import unittest
+
+from apts.shaping import TokenBucket, PriorityGate, FileClass, BandwidthScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_consume(self):
+        bucket = TokenBucket(rate=1000)
+        self.assertEqual(bucket.consume(1000, 0), 0)
+        # The bucket is empty, so we must wait until 500 tokens are refilled.
+        self.assertAlmostEqual(bucket.consume(500, 0), 0.5)
+        # Half a second later the debt is paid off.
+        self.assertEqual(bucket.consume(0, 0.5), 0)
+
+    def test_burst(self):
+        """
+        Tokens never accumulate above the burst size.
+        """
+        bucket = TokenBucket(rate=1000, burst=100)
+        self.assertAlmostEqual(bucket.consume(200, 10), 0.1)
+        self.assertTrue(bucket.is_full(20))
+
+
+class TestPriorityGate(unittest.TestCase):
+    def test_priority_order(self):
+        """
+        While the gate is busy, waiting sessions queue up and are served in
+        order of priority rank, not of arrival.
+        """
+        served = self._serve([(0, 3), (0, 1), (0, 2)], aging=60)
+        self.assertEqual(served, [1, 2, 3])
+
+    def test_aging(self):
+        """
+        A low priority session that waited long enough goes first.
+        """
+        served = self._serve([(0, 2), (3, 0)], aging=1)
+        self.assertEqual(served, [2, 0])
+
+    def _serve(self, arrivals, aging):
+        """
+        Keeps the gate busy while sessions arrive at the given
+        (time, rank) pairs, then returns the ranks in the order they were
+        served.
+        """
+        clock = FakeClock()
+        release = threading.Event()
+        gate = PriorityGate(TokenBucket(rate=1000), aging, clock=clock,
+                            sleep=lambda seconds: release.wait())
+        served = []
+
+        def acquire(rank):
+            gate.acquire(1000, rank)
+            served.append(rank)
+
+        # The first session empties the bucket and then the next one blocks
+        # in sleep() until we release it, keeping the gate busy.
+        gate.acquire(1000)
+        holder = threading.Thread(target=gate.acquire, args=(1000,))
+        holder.start()
+        while not gate._busy:
+            time.sleep(0.001)
+
+        threads = []
+        for arrival, rank in arrivals:
+            clock.now = arrival
+            threads.append(threading.Thread(target=acquire, args=(rank,)))
+            threads[-1].start()
+            while len(gate._queue) < len(threads):
+                time.sleep(0.001)
+
+        release.set()
+        for thread in [holder] + threads:
+            thread.join()
+        return served
+
+
+class TestBandwidthScheduler(unittest.TestCase):
+    def test_global_rate(self):
+        clock = FakeClock()
+        scheduler = BandwidthScheduler(rate=1024, clock=clock, sleep=clock.sleep)
+        file_class = scheduler.classify('file')
+
+        for _ in range(10):
+            scheduler.throttle('10.0.0.1', file_class, 512)
+        # 1024 bytes of burst and then 1024 bytes per second.
+        self.assertAlmostEqual(clock.now, 4)
+
+    def test_rank(self):
+        scheduler = BandwidthScheduler(small_file_size=1024,
+                                       priority_paths=['pxelinux.cfg/*'])
+
+        self.assertEqual(scheduler.rank('menu', 1000), 0)
+        self.assertEqual(scheduler.rank('initrd', 1024 * 1024), 11)
+        self.assertEqual(scheduler.rank('pxelinux.cfg/big', 1024 * 1024), 0)
+        self.assertLess(scheduler.rank('small.img', 4096),
+                        scheduler.rank('large.img', 4096 * 1024))
+
+    def test_client_and_subnet_rates(self):
+        clock = FakeClock()
+        scheduler = BandwidthScheduler(client_rate=1000,
+                                       subnet_rates=[('10.0.0.0/8', 1500)],
+                                       clock=clock, sleep=clock.sleep)
+        file_class = scheduler.classify('file')
+
+        self.assertEqual(scheduler.reserve('10.0.0.1', file_class, 1000), 0)
+        self.assertAlmostEqual(scheduler.reserve('10.0.0.1', file_class, 500),
+                               0.5)
+        # The client has its own bucket, but shares the subnet one.
+        self.assertAlmostEqual(scheduler.reserve('10.0.0.2', file_class, 500),
+                               1 / 3)
+        # Other subnets are only limited per client.
+        self.assertEqual(scheduler.reserve('192.168.0.1', file_class, 1000), 0)
+
+    def test_file_classes(self):
+        clock = FakeClock()
+        images = FileClass('images', ['*.img'], rate=100)
+        scheduler = BandwidthScheduler(file_classes=[images], clock=clock,
+                                       sleep=clock.sleep)
+
+        self.assertIs(scheduler.classify('boot/linux.img'), images)
+        self.assertIs(scheduler.classify('pxelinux.cfg'),
+                      scheduler.default_class)
+
+        scheduler.throttle('10.0.0.1', images, 300)
+        scheduler.throttle('10.0.0.1', scheduler.default_class, 300)
+        self.assertAlmostEqual(clock.now, 2)
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['images']['bytes'], 300)
+        self.assertAlmostEqual(stats['images']['deferred'], 2)
+        self.assertAlmostEqual(stats['images']['throughput'], 150)
+        self.assertEqual(stats['default']['bytes'], 300)
@@ -0,0 +1,118 @@
+import socket
+import unittest
+
+from apts.sockpool import TransferSocketPool
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTransferSocketPool(unittest.TestCase):
+    def test_reuse(self):
+        clock = FakeClock()
+        pool = TransferSocketPool('127.0.0.1', max_idle=1, clock=clock)
+
+        sock, port = pool.acquire()
+        self.assertEqual(sock.getsockname(), ('127.0.0.1', port))
+        pool.release(sock, port)
+        clock.now = pool.quarantine
+        self.assertEqual(pool.acquire(), (sock, port))
+
+        stats = pool.stats()
+        self.assertEqual((stats['created'], stats['reused']), (1, 1))
+        pool.release(sock, port)
+        pool.close()
+
+    def test_drain(self):
+        """
+        Datagrams left on a released socket, or sent to it while it is idle,
+        don't reach the next session.
+        """
+        clock = FakeClock()
+        pool = TransferSocketPool('127.0.0.1', clock=clock)
+        sock, port = pool.acquire()
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.sendto(b'stale', ('127.0.0.1', port))
+        pool.release(sock, port)
+        sender.sendto(b'delayed', ('127.0.0.1', port))
+        sender.close()
+
+        clock.now = pool.quarantine
+        self.assertEqual(pool.acquire(), (sock, port))
+        sock.settimeout(0.05)
+        with self.assertRaises(socket.timeout):
+            sock.recvfrom(16)
+        sock.close()
+
+    def test_quarantine(self):
+        """
+        Released sockets are reused oldest first, and not before their
+        quarantine is over.
+        """
+        clock = FakeClock()
+        pool = TransferSocketPool('127.0.0.1', quarantine=8, clock=clock)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(*first)
+        clock.now = 1
+        pool.release(*second)
+
+        clock.now = 7
+        third = pool.acquire()
+        self.assertNotIn(third, (first, second))
+        clock.now = 9
+        self.assertEqual(pool.acquire(), first)
+        self.assertEqual(pool.acquire(), second)
+        for sock, port in (first, second, third):
+            sock.close()
+
+    def test_quarantine_port_range(self):
+        """
+        Once the range is used up, a quarantined socket is reused rather
+        than failing the session.
+        """
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        first = probe.getsockname()[1]
+        probe.close()
+
+        pool = TransferSocketPool('127.0.0.1', (first, first),
+                                  clock=FakeClock())
+        sock, port = pool.acquire()
+        pool.release(sock, port)
+        self.assertEqual(pool.acquire(), (sock, port))
+        sock.close()
+
+    def test_port_range(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        first = probe.getsockname()[1]
+        probe.close()
+
+        pool = TransferSocketPool('127.0.0.1', (first, first + 1), max_idle=0)
+        sockets = [pool.acquire(), pool.acquire()]
+        self.assertEqual(sorted(port for _, port in sockets),
+                         [first, first + 1])
+        with self.assertRaises(OSError):
+            pool.acquire()
+
+        # Closed sockets give their port back to the range.
+        pool.release(*sockets.pop())
+        sockets.append(pool.acquire())
+        for sock, port in sockets:
+            pool.release(sock, port)
+        self.assertEqual(pool.stats()['closed'], 3)
+
+    def test_shrink(self):
+        pool = TransferSocketPool('127.0.0.1', min_idle=1, idle_timeout=-1)
+        sockets = [pool.acquire() for _ in range(3)]
+        for sock, port in sockets:
+            pool.release(sock, port)
+
+        self.assertEqual(pool.stats()['idle'], 1)
+        pool.close()
@@ -0,0 +1,85 @@
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from apts import netascii
+from apts.file_rw import TftpFileReader
+from apts.textindex import NetasciiIndex, NetasciiLayout, encoded_size
+
+from .test_file_rw import read_whole_file
+
+
+class TestNetasciiIndex(unittest.TestCase):
+    def setUp(self):
+        self.tftp_root = os.path.realpath(mkdtemp())
+        # Lines and CRs across three checkpoints.
+        self.data = b'line\n' * 30000 + b'cr\r' * 5000
+        self.path = self.create('text', self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tftp_root)
+
+    def create(self, name, data):
+        path = os.path.join(self.tftp_root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_encoded_size(self):
+        for data in (b'', b'abc', b'a\nb\r\n\r', self.data):
+            self.assertEqual(encoded_size(data, '\n'),
+                             len(netascii.encode(data, '\n')))
+        self.assertEqual(encoded_size(b'a\r\nb\n', '\r\n'),
+                         len(netascii.encode(b'a\r\nb\n', '\r\n')))
+
+    def test_layout(self):
+        layout = NetasciiLayout(self.path, '\n')
+        encoded = netascii.encode(self.data, '\n')
+        self.assertEqual(layout.encoded_size, len(encoded))
+        self.assertEqual(len(layout.checkpoints), 3)
+
+        for offset in (0, 1, 65535, 70000, 140000, len(encoded)):
+            start, skip = layout.locate(offset)
+            self.assertEqual(start % layout.interval, 0)
+            self.assertEqual(len(netascii.encode(self.data[:start], '\n')) +
+                             skip, offset)
+
+        layout = NetasciiLayout(self.create('empty', b''))
+        self.assertEqual(layout.encoded_size, 0)
+        self.assertEqual(layout.locate(0), (0, 0))
+
+    def test_seek(self):
+        """
+        A reader restarts at any block from the nearest checkpoint.
+        """
+        layout = NetasciiLayout(self.path)
+        encoded = netascii.encode(self.data)
+        for blockn in (1, 128, 150, 300):
+            reader = TftpFileReader(self.path, 'netascii')
+            reader.seek(blockn * 512, layout)
+            self.assertEqual(read_whole_file(reader), encoded[blockn * 512:])
+
+    def test_invalidation(self):
+        index = NetasciiIndex()
+        self.assertIs(index.layout(self.path), index.layout(self.path))
+        self.assertEqual(index.stats(), {'files': 1, 'hits': 1, 'misses': 1})
+
+        # A change of size or modification time invalidates the layout.
+        with open(self.path, 'ab') as f:
+            f.write(b'\n')
+        self.assertEqual(index.layout(self.path).encoded_size,
+                         encoded_size(self.data + b'\n'))
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        index.layout(self.path)
+        self.assertEqual(index.misses, 3)
+
+    def test_max_files(self):
+        index = NetasciiIndex(max_files=2)
+        paths = [self.create(name, b'x\n') for name in 'abc']
+        for path in paths:
+            index.layout(path)
+        index.layout(paths[0])
+        self.assertEqual(index.stats(), {'files': 2, 'hits': 0, 'misses': 4})
+        self.assertRaises(OSError, index.layout, 'missing')
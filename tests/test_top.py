@@ -0,0 +1,68 @@
+import io
+import unittest
+from contextlib import redirect_stderr
+
+from apts.top import format_size, format_table, sort_sessions, main
+
+
+def session(client, **values):
+    snapshot = {
+        'client': client, 'tid': 50000, 'op': 'RRQ', 'file': 'pxelinux.0',
+        'mode': 'octet', 'block': 10, 'bytes': 5120, 'size': 26000,
+        'elapsed': 2.5, 'throughput': 2048, 'rtt': 0.0012, 'retransmits': 0,
+    }
+    snapshot.update(values)
+    return snapshot
+
+
+class TestTop(unittest.TestCase):
+    def test_format_size(self):
+        self.assertEqual([format_size(n) for n in (0, 1023, 1024, 1536,
+                                                   3 * 1024 ** 3, 1024 ** 4)],
+                         ['0', '1023', '1K', '2K', '3G', '1T'])
+
+    def test_sort_sessions(self):
+        sessions = [session('a', rtt=0.5), session('b', rtt=None),
+                    session('c', rtt=0.1)]
+        self.assertEqual([s['client'] for s in sort_sessions(sessions, 'rtt')],
+                         ['b', 'c', 'a'])
+        self.assertEqual([s['client'] for s in
+                          sort_sessions(sessions, 'rtt', reverse=True)],
+                         ['a', 'c', 'b'])
+        self.assertEqual([s['client'] for s in
+                          sort_sessions(sessions, 'client', reverse=True)],
+                         ['c', 'b', 'a'])
+
+    def test_format_table(self):
+        sessions = [
+            session('10.0.0.1:1024'),
+            session('[2001:db8::1]:1024', file='images/' + 'x' * 40,
+                    rtt=None, throughput=3 * 1024 ** 2),
+        ]
+        lines = format_table(sessions, 'throughput', reverse=True)
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('CLIENT'))
+        self.assertIn('RATE/s▼', lines[0])
+        self.assertIn('RATE/s▲', format_table(sessions, 'throughput')[0])
+
+        # Sorted by throughput, the largest first.
+        self.assertTrue(lines[1].startswith('[2001:db8::1]:1024'))
+        self.assertEqual(lines[1].split()[3], 'images/' + 'x' * 20 + '…')
+        self.assertIn(' 3M ', lines[1])
+        self.assertEqual(lines[2].split(), [
+                '10.0.0.1:1024', '50000', 'RRQ', 'pxelinux.0', 'octet',
+                '10', '5K', '2K', '1.20', '0', '2.5s'])
+        # No RTT sample yet.
+        self.assertEqual(lines[1].split()[8], '-')
+
+        # Columns line up with the header.
+        self.assertEqual(lines[0].index('FILE'), lines[2].index('pxelinux'))
+        header, = format_table([], 'client')
+        self.assertTrue(header.startswith('CLIENT▲ '))
+
+    def test_missing_socket(self):
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            self.assertEqual(main(['-s', '/nonexistent/apts.sock', '--once']),
+                             1)
+        self.assertIn('control_socket', stderr.getvalue())
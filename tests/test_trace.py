@@ -0,0 +1,53 @@
+import os
+import shutil
+import logging
+import unittest
+from tempfile import mkdtemp
+
+from apts.trace import TraceHandler, read_trace
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.filename = os.path.join(self.directory, 'trace')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, created, transfer=True, **summary):
+        record = logging.LogRecord('apts', logging.INFO, __file__, 0,
+                                   'transfer', None, None)
+        record.created = created
+        if transfer:
+            record.transfer = dict({
+                'tid': 1, 'client': '10.0.0.1', 'op': 'RRQ',
+                'filename': 'file', 'mode': 'octet', 'options': {},
+                'size': 1000, 'outcome': 'complete', 'error_code': None,
+                'bytes': 1000, 'duration': 2, 'linger': 0, 'throughput': 500,
+                'retransmits': 0}, **summary)
+        return record
+
+    def test_handler(self):
+        handler = TraceHandler(self.filename)
+        handler.handle(self.record(110, filename='late'))
+        handler.handle(self.record(105))
+        handler.handle(self.record(106, op='WRQ', size=None, bytes=30,
+                                   linger=3))
+        handler.handle(self.record(107, transfer=False))
+        handler.close()
+
+        with open(self.filename) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        entries = read_trace(self.filename)
+        self.assertEqual([entry['time'] for entry in entries], [101, 103, 108])
+        self.assertEqual(entries[0]['size'], 30)
+        self.assertEqual(entries[1]['size'], 1000)
+        self.assertEqual(entries[2]['file'], 'late')
+
+    def test_unparsed_requests_are_skipped(self):
+        handler = TraceHandler(self.filename)
+        handler.handle(self.record(100, op=None, filename=None, mode=None))
+        handler.close()
+        self.assertEqual(read_trace(self.filename), [])